@@ -1,8 +1,24 @@
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 from astropy.io import fits
 from astropy.convolution import convolve_fft
 from photutils.psf import create_matching_kernel, SplitCosineBellWindow
+from scipy import fft as sp_fft
+
+from ..images.img_utils import iter_tiles
+from ..logging.logger_config import setup_logger
+from .kernel_cache import kernel_key
+
+logger = setup_logger()
+
+# approximate bytes held per padded pixel while convolving one tile
+# (real slab, its half-spectrum, the product spectrum and the real result)
+_BYTES_PER_TILE_PIXEL = 48
 
-def create_kernels(target_psf, source_psf, alpha=0.5, beta=0.0):
+def create_kernels(target_psf, source_psf, alpha=0.5, beta=0.0, cache=None):
     """
     Create a kernel to match the PSFs of two images.
 
@@ -16,17 +32,30 @@ def create_kernels(target_psf, source_psf, alpha=0.5, beta=0.0):
         The alpha parameter of the SplitCosineBellWindow.
     beta : float
         The beta parameter of the SplitCosineBellWindow.
-    
+    cache : KernelCache, optional
+        On-disk kernel cache. A kernel already built from the same PSFs and
+        window parameters is loaded (memory-mapped) instead of recomputed.
+
     Returns
     -------
     kernel : np.ndarray
         The kernel that will match the PSFs of the two images.
     """
+    if cache is not None:
+        key = kernel_key(target_psf, source_psf, alpha, beta, window=SplitCosineBellWindow.__name__)
+        kernel = cache.load(key)
+        if kernel is not None:
+            logger.verbose(f"Loaded the matching kernel {key} from the cache.")
+            return kernel
+
     window = SplitCosineBellWindow(alpha=alpha, beta=beta)
     kernel = create_matching_kernel(target_psf=target_psf, source_psf=source_psf, window=window)
+
+    if cache is not None:
+        cache.store(key, kernel)
     return kernel
 
-def convolve_image(image, kernel, multithread=False):
+def convolve_image(image, kernel, multithread=False, threads=6, tiled=False, **tile_kwargs):
     """
     Convolve an image with a kernel.
 
@@ -36,26 +65,433 @@ def convolve_image(image, kernel, multithread=False):
         The image to convolve.
     kernel : np.ndarray
         The kernel to convolve with.
+    multithread : bool
+        Use pyfftw's multithreaded FFTs, if it is installed.
+    threads : int
+        Number of pyfftw threads. Default is 6.
+    tiled : bool
+        Use `convolve_image_tiled` instead of a single `convolve_fft` call on the
+        full image. `tile_kwargs` (tile_size, memory_budget, workers, out,
+        convolver) are passed on to it.
     
     Returns
     -------
     convolved : np.ndarray
         The convolved image.
     """
+    if tiled:
+        return convolve_image_tiled(image, kernel, **tile_kwargs)
 
     if multithread:
-        import pyfftw
+        try:
+            import pyfftw
+            import pyfftw.interfaces.numpy_fft
+        except ImportError:
+            logger.error("pyfftw is not installed; convolving with numpy's FFT instead.")
+            return convolve_fft(image, kernel, normalize_kernel=True, allow_huge=True)
 
-        pyfftw.config.NUM_THREADS = 6
+        pyfftw.config.NUM_THREADS = threads or os.cpu_count() or 1
         pyfftw.config.PLANNER_EFFORT = 'FFTW_MEASURE'
 
         pyfftw.interfaces.cache.enable()
         pyfftw.interfaces.cache.set_keepalive_time(300)
 
-
-
         return convolve_fft(image, kernel, normalize_kernel=True, allow_huge=True,
                             fftn=pyfftw.interfaces.numpy_fft.fftn,
                             ifftn=pyfftw.interfaces.numpy_fft.ifftn,)
 
-    return convolve_fft(image, kernel, normalize_kernel=True, allow_huge=True)
\ No newline at end of file
+    return convolve_fft(image, kernel, normalize_kernel=True, allow_huge=True)
+
+
+def choose_tile_size(kernel_shape, memory_budget, workers):
+    """
+    Largest square tile whose padded FFT working set fits `memory_budget` bytes
+    for `workers` tiles convolved at the same time.
+    """
+    per_worker = memory_budget / max(workers, 1) / _BYTES_PER_TILE_PIXEL
+    padded = int(np.sqrt(per_worker))
+    tile_size = padded - max(kernel_shape) + 1
+    if tile_size < max(kernel_shape):
+        logger.error(f"A memory budget of {memory_budget} bytes is too small for a {kernel_shape} kernel.")
+        raise ValueError(f"A memory budget of {memory_budget} bytes is too small for a {kernel_shape} kernel.")
+    return tile_size
+
+
+class Convolver:
+    """
+    Convolve many images with one kernel, reusing the kernel's transform.
+
+    The kernel is transformed once per padded FFT shape and kept, so convolving
+    N same-shape images (or the tiles of one mosaic) costs a single kernel FFT.
+    pyfftw is used when it is installed, with its plans reused through the
+    interface cache and FFTW wisdom optionally saved to disk between runs;
+    otherwise `scipy.fft` is used.
+
+    Parameters
+    ----------
+    kernel : np.ndarray
+        The kernel to convolve with. It is normalized to unit sum.
+    threads : int, optional
+        Number of threads per FFT. Default is the number of CPUs.
+    backend : str
+        'auto' (pyfftw if installed, else scipy), 'pyfftw' or 'scipy'.
+    wisdom_file : str, optional
+        File to load FFTW wisdom from and save it to (pyfftw only).
+    planner_effort : str
+        FFTW planner effort. Default is 'FFTW_MEASURE'.
+    """
+
+    def __init__(self, kernel, threads=None, backend='auto', wisdom_file=None, planner_effort='FFTW_MEASURE'):
+        kernel = np.asarray(kernel, dtype=float)
+        self.kernel = kernel / kernel.sum()
+        self.threads = threads or os.cpu_count() or 1
+        self.wisdom_file = wisdom_file
+        self.planner_effort = planner_effort
+        self._kernel_ft = {}
+
+        self._fftw = None
+        if backend in ('auto', 'pyfftw'):
+            try:
+                import pyfftw
+                import pyfftw.interfaces.scipy_fft
+            except ImportError:
+                if backend == 'pyfftw':
+                    logger.error("pyfftw is not installed. Please install it or use backend='scipy'.")
+                    raise ImportError("pyfftw is not installed. Please install it or use backend='scipy'.")
+                logger.verbose("pyfftw is not installed; falling back to scipy.fft")
+            else:
+                self._fftw = pyfftw
+                pyfftw.interfaces.cache.enable()
+                pyfftw.interfaces.cache.set_keepalive_time(300)
+                self.load_wisdom()
+        elif backend != 'scipy':
+            raise ValueError(f"Unknown FFT backend '{backend}'. Use 'auto', 'pyfftw' or 'scipy'.")
+
+    @property
+    def backend(self):
+        return 'pyfftw' if self._fftw is not None else 'scipy'
+
+    def load_wisdom(self):
+        if self._fftw is None or not self.wisdom_file or not os.path.exists(self.wisdom_file):
+            return
+        try:
+            with open(self.wisdom_file, 'rb') as file:
+                self._fftw.import_wisdom(pickle.load(file))
+            logger.verbose(f"Loaded FFTW wisdom from {self.wisdom_file}")
+        except Exception as e:
+            logger.error(f"Failed to load FFTW wisdom from {self.wisdom_file}: {e}")
+
+    def save_wisdom(self):
+        if self._fftw is None or not self.wisdom_file:
+            return
+        with open(self.wisdom_file, 'wb') as file:
+            pickle.dump(self._fftw.export_wisdom(), file)
+        logger.verbose(f"Saved FFTW wisdom to {self.wisdom_file}")
+
+    def rfft2(self, data, shape, threads=None):
+        threads = threads or self.threads
+        if self._fftw is not None:
+            return self._fftw.interfaces.scipy_fft.rfft2(data, s=shape, workers=threads,
+                                                         planner_effort=self.planner_effort)
+        return sp_fft.rfft2(data, s=shape, workers=threads)
+
+    def irfft2(self, data, shape, threads=None):
+        threads = threads or self.threads
+        if self._fftw is not None:
+            return self._fftw.interfaces.scipy_fft.irfft2(data, s=shape, workers=threads,
+                                                          planner_effort=self.planner_effort)
+        return sp_fft.irfft2(data, s=shape, workers=threads)
+
+    def fft_shape(self, shape):
+        """
+        FFT-friendly shape for a linear convolution of an array of `shape` with the kernel.
+        """
+        return tuple(sp_fft.next_fast_len(n + k - 1, real=True) for n, k in zip(shape, self.kernel.shape))
+
+    def kernel_transform(self, fft_shape, squared=False):
+        """
+        The real FFT of the kernel (or of the squared kernel, used to propagate
+        variances) at `fft_shape`, computed on first use and then reused.
+        """
+        key = (tuple(fft_shape), squared)
+        if key not in self._kernel_ft:
+            kernel = self.kernel ** 2 if squared else self.kernel
+            self._kernel_ft[key] = self.rfft2(kernel, key[0])
+        return self._kernel_ft[key]
+
+    def convolve(self, image, out=None):
+        """
+        Convolve a whole image.
+
+        Matches ``convolve_fft(image, kernel, normalize_kernel=True)`` up to
+        floating-point error for images without NaNs; NaN pixels are treated as zero.
+        """
+        ky, kx = self.kernel.shape
+        ny, nx = image.shape
+        fft_shape = self.fft_shape(image.shape)
+
+        data = np.nan_to_num(np.asarray(image, dtype=float), nan=0.0, posinf=0.0, neginf=0.0)
+        conv = self.irfft2(self.rfft2(data, fft_shape) * self.kernel_transform(fft_shape), fft_shape)
+
+        if out is None:
+            out = np.empty(image.shape, dtype=float)
+        out[...] = conv[ky // 2:ky // 2 + ny, kx // 2:kx // 2 + nx]
+        self.save_wisdom()
+        return out
+
+    def _halo_slab(self, array, inner, fill=0.0):
+        # the tile of `array` padded with the kernel halo, filled outside the array
+        ky, kx = self.kernel.shape
+        ny, nx = array.shape
+        ys, ye = inner[0].start - (ky - 1 - ky // 2), inner[0].stop + ky // 2
+        xs, xe = inner[1].start - (kx - 1 - kx // 2), inner[1].stop + kx // 2
+
+        slab = np.full((ye - ys, xe - xs), fill)
+        slab[max(ys, 0) - ys:min(ye, ny) - ys, max(xs, 0) - xs:min(xe, nx) - xs] = \
+            array[max(ys, 0):min(ye, ny), max(xs, 0):min(xe, nx)]
+        return slab
+
+    def _tile_crop(self, inner):
+        # the valid part of the linear convolution of a halo slab
+        ky, kx = self.kernel.shape
+        return (slice(ky - 1, ky - 1 + inner[0].stop - inner[0].start),
+                slice(kx - 1, kx - 1 + inner[1].stop - inner[1].start))
+
+    def convolve_tile(self, image, inner, out, fft_shape, threads=None):
+        """
+        Convolve one tile of an image (overlap-save) and write it to `out[inner]`.
+
+        `fft_shape` is the transform shape of the tile size, from `fft_shape`.
+        Tiles are independent, so many can be convolved in parallel; NaN pixels
+        are treated as zero.
+        """
+        slab = self._halo_slab(image, inner)
+        slab[~np.isfinite(slab)] = 0
+
+        conv = self.irfft2(self.rfft2(slab, fft_shape, threads) * self.kernel_transform(fft_shape), fft_shape, threads)
+        out[inner] = conv[self._tile_crop(inner)]
+
+    def _convolve_planes(self, planes, fft_shape, threads):
+        # one batched forward and inverse transform for the data*weight, weight
+        # and (optionally) variance*weight**2 planes
+        spectra = self.rfft2(planes, fft_shape, threads)
+        spectra[:2] *= self.kernel_transform(fft_shape)
+        if len(planes) > 2:
+            spectra[2] *= self.kernel_transform(fft_shape, squared=True)
+        return self.irfft2(spectra, fft_shape, threads)
+
+    def convolve_normalized(self, image, weight=None, variance=None, min_weight=1e-8, out=None, out_variance=None):
+        """
+        Normalized convolution of a whole image. See `convolve_image_normalized`.
+        """
+        ky, kx = self.kernel.shape
+        ny, nx = image.shape
+        fft_shape = self.fft_shape(image.shape)
+
+        conv = self._convolve_planes(_weighted_planes(image, weight, variance), fft_shape, self.threads)
+        conv = conv[:, ky // 2:ky // 2 + ny, kx // 2:kx // 2 + nx]
+
+        result = _normalize(conv, min_weight, out, out_variance)
+        self.save_wisdom()
+        return result
+
+    def _normalized_tile(self, image, weight, variance, fft_shape, inner, min_weight, out, out_variance, threads):
+        planes = _weighted_planes(self._halo_slab(image, inner, fill=np.nan),
+                                  None if weight is None else self._halo_slab(weight, inner),
+                                  None if variance is None else self._halo_slab(variance, inner))
+        conv = self._convolve_planes(planes, fft_shape, threads)
+        conv = conv[(slice(None),) + self._tile_crop(inner)]
+
+        result, result_var = _normalize(conv, min_weight), None
+        if variance is not None:
+            result, result_var = result
+            out_variance[inner] = result_var
+        out[inner] = result
+
+    def convolve_normalized_tiled(self, image, weight=None, variance=None, min_weight=1e-8, tile_size=None,
+                                  memory_budget=2e9, workers=None, out=None, out_variance=None):
+        """
+        Normalized convolution tile by tile (overlap-save). See `convolve_image_normalized`.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        n_planes = 2 if variance is None else 3
+        if tile_size is None:
+            tile_size = choose_tile_size(self.kernel.shape, memory_budget / n_planes, workers)
+        tile_size = min(tile_size, max(image.shape))
+
+        if out is None:
+            out = np.empty(image.shape, dtype=float)
+        if variance is not None and out_variance is None:
+            out_variance = np.empty(image.shape, dtype=float)
+
+        fft_shape = self.fft_shape((tile_size, tile_size))
+        self.kernel_transform(fft_shape)
+        if variance is not None:
+            self.kernel_transform(fft_shape, squared=True)
+        threads = max(self.threads // workers, 1)
+
+        logger.verbose(f"Normalized convolution of a {image.shape} image in {tile_size} px tiles with {workers} workers")
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._normalized_tile, image, weight, variance, fft_shape, inner,
+                                       min_weight, out, out_variance, threads)
+                       for inner, _, _ in iter_tiles(image.shape, tile_size)]
+            for future in futures:
+                future.result()
+
+        self.save_wisdom()
+        if variance is not None:
+            return out, out_variance
+        return out
+
+    def convolve_tiled(self, image, tile_size=None, memory_budget=2e9, workers=None, out=None):
+        """
+        Convolve an image tile by tile (overlap-save). See `convolve_image_tiled`.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if tile_size is None:
+            tile_size = choose_tile_size(self.kernel.shape, memory_budget, workers)
+        tile_size = min(tile_size, max(image.shape))
+
+        if out is None:
+            out = np.empty(image.shape, dtype=float)
+
+        # every slab is padded to the same shape, so the kernel is transformed once
+        fft_shape = self.fft_shape((tile_size, tile_size))
+        self.kernel_transform(fft_shape)
+
+        # split the threads between the tiles running at the same time
+        threads = max(self.threads // workers, 1)
+
+        logger.verbose(f"Convolving a {image.shape} image in {tile_size} px tiles with {workers} workers")
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.convolve_tile, image, inner, out, fft_shape, threads)
+                       for inner, _, _ in iter_tiles(image.shape, tile_size)]
+            for future in futures:
+                future.result()
+
+        self.save_wisdom()
+        return out
+
+
+def _weighted_planes(image, weight, variance):
+    data = np.asarray(image, dtype=float)
+    finite = np.isfinite(data)
+
+    weight = finite.astype(float) if weight is None else np.where(finite, weight, 0.0)
+    weight[~np.isfinite(weight)] = 0.0
+    if variance is not None:
+        variance = np.asarray(variance, dtype=float)
+        weight[~np.isfinite(variance)] = 0.0
+
+    planes = [np.where(finite, data, 0.0) * weight, weight]
+    if variance is not None:
+        planes.append(np.where(weight > 0, variance, 0.0) * weight ** 2)
+    return np.stack(planes)
+
+
+def _normalize(conv, min_weight, out=None, out_variance=None):
+    numerator, weight = conv[0], conv[1]
+    no_data = weight <= min_weight
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = np.divide(numerator, weight, out=out)
+        result[no_data] = np.nan
+        if len(conv) < 3:
+            return result
+
+        variance = np.divide(conv[2], weight ** 2, out=out_variance)
+        variance[no_data] = np.nan
+    return result, variance
+
+
+def convolve_image_normalized(image, kernel, weight=None, variance=None, min_weight=1e-8, tiled=False,
+                              convolver=None, **tile_kwargs):
+    """
+    Normalized convolution of an image with NaN gaps and/or a weight map.
+
+    The data times the weight and the weight itself are convolved in the same
+    batched real FFT, and the first is divided by the second. NaN pixels (and
+    pixels outside the image) get zero weight, so gaps and edges are filled from
+    the surrounding data instead of being treated as zeros. If a variance map is
+    given, it is propagated by convolving ``variance * weight**2`` with the squared
+    kernel in the same pass::
+
+        result = conv(data * weight, kernel) / conv(weight, kernel)
+        result_variance = conv(variance * weight**2, kernel**2) / conv(weight, kernel)**2
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to convolve. Can contain NaNs.
+    kernel : np.ndarray
+        The kernel to convolve with. It is normalized to unit sum.
+    weight : np.ndarray, optional
+        Weight map (e.g. inverse variance or exposure). Default is 1 for every finite pixel.
+    variance : np.ndarray, optional
+        Variance map to propagate (e.g. the square of the error extension).
+    min_weight : float
+        Output pixels whose convolved weight is at or below this are set to NaN.
+        Default is 1e-8.
+    tiled : bool
+        Convolve tile by tile (overlap-save). `tile_kwargs` (tile_size, memory_budget,
+        workers, out, out_variance) are passed on; without tiling only `out` and
+        `out_variance` are used.
+    convolver : Convolver, optional
+        Convolver holding `kernel`, to reuse its kernel transforms across calls.
+
+    Returns
+    -------
+    convolved : np.ndarray
+        The convolved image, or (convolved, convolved_variance) if `variance` is given.
+    """
+    if convolver is None:
+        convolver = Convolver(kernel)
+    if tiled:
+        return convolver.convolve_normalized_tiled(image, weight=weight, variance=variance, min_weight=min_weight,
+                                                   **tile_kwargs)
+    # the tiling keys (tile_size, memory_budget, workers) do not apply to the whole-image convolution
+    return convolver.convolve_normalized(image, weight=weight, variance=variance, min_weight=min_weight,
+                                         out=tile_kwargs.get('out'), out_variance=tile_kwargs.get('out_variance'))
+
+
+def convolve_image_tiled(image, kernel, tile_size=None, memory_budget=2e9, workers=None, out=None, convolver=None):
+    """
+    Convolve an image with a kernel tile by tile (overlap-save).
+
+    Each output tile is computed from the input tile padded with the kernel halo,
+    so tiles are independent and are written to disjoint parts of `out`. The
+    result matches ``convolve_fft(image, kernel, normalize_kernel=True)`` up to
+    floating-point error for images without NaNs; NaN pixels are treated as zero.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to convolve. Can be a memory-mapped array.
+    kernel : np.ndarray
+        The kernel to convolve with. It is normalized to unit sum.
+    tile_size : int, optional
+        Size of the (square) output tiles. Default is the largest tile that fits
+        `memory_budget`.
+    memory_budget : float
+        Approximate bytes available for the tiles being convolved at the same time.
+        Default is 2 GB.
+    workers : int, optional
+        Number of threads. Default is the number of CPUs.
+    out : np.ndarray, optional
+        Preallocated output array, e.g. a memory-mapped array. Default is a new
+        float64 array.
+    convolver : Convolver, optional
+        Convolver holding `kernel`, to reuse its kernel transform across calls.
+
+    Returns
+    -------
+    convolved : np.ndarray
+        The convolved image.
+    """
+    if convolver is None:
+        convolver = Convolver(kernel)
+    return convolver.convolve_tiled(image, tile_size=tile_size, memory_budget=memory_budget, workers=workers, out=out)
@@ -0,0 +1,300 @@
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord, concatenate
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+from scipy import ndimage as nd
+
+from ..common.parse_ds9_regions import read_ds9_regions
+from ..images.clipping import MAD_TO_STD
+from ..logging.logger_config import setup_logger
+
+logger = setup_logger()
+
+
+def star_positions(stars, wcs, frame='fk5'):
+    """
+    Pixel positions of a list of stars.
+
+    Parameters
+    ----------
+    stars : str, astropy.table.Table or SkyCoord
+        A DS9 region file (the centres of the sky regions are used), a catalogue file
+        readable by `astropy.table.Table.read`, a table with 'ra'/'dec' (in
+        degrees) or 'x'/'y' (0-based pixel) columns, or sky coordinates.
+    wcs : astropy.wcs.WCS
+        WCS of the mosaic.
+    frame : str
+        Frame of the catalogue coordinates (region files set their own). Default is 'fk5'.
+
+    Returns
+    -------
+    x, y : np.ndarray
+        The 0-based pixel positions.
+    """
+    if isinstance(stars, str):
+        if stars.endswith('.reg'):
+            # the centres of all the (sky, non-excluded) regions, in file order
+            tables = [t for t in read_ds9_regions(stars)
+                      if t.shape != 'polygon' and t.frame != 'image' and not t.exclude]
+            index = np.argsort(np.concatenate([t.index for t in tables]))
+            stars = concatenate([SkyCoord(t.lon * u.deg, t.lat * u.deg, frame=t.frame).icrs for t in tables])[index]
+        else:
+            stars = Table.read(stars)
+
+    if isinstance(stars, Table):
+        if 'x' in stars.colnames and 'y' in stars.colnames:
+            return np.asarray(stars['x'], dtype=float), np.asarray(stars['y'], dtype=float)
+        stars = SkyCoord(ra=np.asarray(stars['ra'], dtype=float) * u.deg,
+                         dec=np.asarray(stars['dec'], dtype=float) * u.deg, frame=frame)
+
+    # one vectorized projection for all the stars
+    x, y = wcs.world_to_pixel(stars)
+    return np.atleast_1d(x).astype(float), np.atleast_1d(y).astype(float)
+
+
+def extract_cutouts(data, x, y, size):
+    """
+    Extract square cutouts around many positions in one pass over the image.
+
+    The cutouts are read in row order, so a memory-mapped mosaic is read
+    roughly sequentially. Parts of a cutout outside the image are NaN.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The 2D image. Can be a memory-mapped array.
+    x, y : np.ndarray
+        The 0-based pixel positions.
+    size : int
+        Size of the (odd) cutouts.
+
+    Returns
+    -------
+    cutouts : np.ndarray
+        The (n, size, size) float cube, centred on the nearest pixel to each position.
+    """
+    half = size // 2
+    ny, nx = data.shape
+    cx, cy = np.round(x).astype(int), np.round(y).astype(int)
+    cutouts = np.full((len(x), size, size), np.nan)
+
+    for num in np.argsort(cy, kind='stable'):
+        ys, xs = cy[num] - half, cx[num] - half
+        y0, y1 = max(ys, 0), min(ys + size, ny)
+        x0, x1 = max(xs, 0), min(xs + size, nx)
+        if y0 >= y1 or x0 >= x1:
+            continue
+        cutouts[num, y0 - ys:y1 - ys, x0 - xs:x1 - xs] = data[y0:y1, x0:x1]
+
+    return cutouts
+
+
+def refine_centroids(cutouts, box=5, iters=2):
+    """
+    Sub-pixel centroid offsets of the star in each cutout, from its centre of mass.
+
+    The centre of mass is taken in a `box` x `box` window, which follows the
+    centroid for `iters` iterations.
+
+    Returns
+    -------
+    dx, dy : np.ndarray
+        Offsets from the cutout centres in pixels.
+    """
+    n, size, _ = cutouts.shape
+    half, center = box // 2, size // 2
+    data = np.nan_to_num(cutouts)
+    offsets = np.arange(-half, half + 1)
+    rows = np.arange(n)[:, None, None]
+
+    dx, dy = np.zeros(n), np.zeros(n)
+    for _ in range(iters):
+        ix = np.clip(np.round(center + dx).astype(int), half, size - half - 1)
+        iy = np.clip(np.round(center + dy).astype(int), half, size - half - 1)
+        window = data[rows, (iy[:, None] + offsets)[:, :, None], (ix[:, None] + offsets)[:, None, :]]
+        window = np.clip(window - np.median(window, axis=(1, 2), keepdims=True), 0, None)
+        total = window.sum(axis=(1, 2))
+        good = total > 0
+        dx[good] = (ix + (window.sum(axis=1) @ offsets) / np.where(good, total, 1))[good] - center
+        dy[good] = (iy + (window.sum(axis=2) @ offsets) / np.where(good, total, 1))[good] - center
+
+    return dx, dy
+
+
+def resample_stars(cutouts, dx, dy, oversample, order=3):
+    """
+    Recentre the stars and resample them onto a common oversampled grid.
+
+    All the stars are interpolated in a single `map_coordinates` call. Output
+    pixels that depend on NaN (or out-of-cutout) pixels are NaN.
+
+    Returns
+    -------
+    stars : np.ndarray
+        The (n, size * oversample, size * oversample) resampled stars.
+    """
+    n, size, _ = cutouts.shape
+    n_os = size * oversample
+    # offsets (in detector pixels) of the oversampled pixel centres from the star centre
+    grid = (np.arange(n_os) - (n_os - 1) / 2) / oversample
+
+    center = (size - 1) / 2
+    coords = np.empty((3, n, n_os, n_os))
+    coords[0] = np.arange(n)[:, None, None]
+    coords[1] = center + dy[:, None, None] + grid[None, :, None]
+    coords[2] = center + dx[:, None, None] + grid[None, None, :]
+
+    valid = np.isfinite(cutouts)
+    stars = nd.map_coordinates(np.where(valid, cutouts, 0.0), coords, order=order, mode='constant', cval=0.0)
+    coverage = nd.map_coordinates(valid.astype(float), coords, order=1, mode='constant', cval=0.0)
+    stars[coverage < 1 - 1e-6] = np.nan
+    return stars
+
+
+def clipped_median_stack(stack, sigma=3.0, maxiters=5):
+    """
+    Sigma-clipped median of a stack along its first axis, ignoring NaNs.
+
+    Each pixel is clipped against its own median and MAD-based sigma,
+    vectorized over all the pixels.
+
+    Returns
+    -------
+    median : np.ndarray
+        The clipped median image.
+    n_used : np.ndarray
+        Number of stack values used for each pixel.
+    """
+    stack = np.array(stack, dtype=float)
+    for _ in range(maxiters):
+        median = np.nanmedian(stack, axis=0)
+        spread = MAD_TO_STD * np.nanmedian(np.abs(stack - median), axis=0)
+        with np.errstate(invalid='ignore'):
+            outliers = np.abs(stack - median) > sigma * spread
+        outliers &= spread > 0
+        if not outliers.any():
+            break
+        stack[outliers] = np.nan
+
+    return np.nanmedian(stack, axis=0), np.count_nonzero(np.isfinite(stack), axis=0)
+
+
+def build_empirical_psf(mosaic, stars, size=51, oversample=3, ext=0, wcs=None, frame='fk5', recenter=True,
+                        sigma=3.0, maxiters=5, order=3, min_coverage=0.5, filt=None):
+    """
+    Build an empirical PSF by stacking stars from a mosaic.
+
+    The cutouts of all the stars are read from the (memory-mapped) mosaic in
+    one pass, recentred with sub-pixel shifts and resampled onto an
+    oversampled grid in one interpolation call, normalized to unit flux, and
+    combined with a per-pixel sigma-clipped median.
+
+    Parameters
+    ----------
+    mosaic : str or np.ndarray
+        Path to the FITS mosaic, or the image itself (then `wcs` is required
+        unless the stars are given in pixels).
+    stars : str, astropy.table.Table or SkyCoord
+        The stars; see `star_positions`.
+    size : int
+        Size of the (odd) PSF in detector pixels. Default is 51.
+    oversample : int
+        Odd oversampling factor of the OVERSAMP extension, so that every
+        detector pixel centre falls on an oversampled pixel. Default is 3.
+    ext : int or str
+        The FITS extension of the mosaic. Default is 0.
+    wcs : astropy.wcs.WCS, optional
+        WCS of the mosaic. Default is read from the mosaic header.
+    frame : str
+        Frame of the star coordinates. Default is 'fk5'.
+    recenter : bool
+        Refine the star positions with their centres of mass. Default is True.
+    sigma : float
+        Clipping threshold of the median stack. Default is 3.
+    maxiters : int
+        Maximum number of clipping iterations. Default is 5.
+    order : int
+        Spline order of the resampling. Default is 3.
+    min_coverage : float
+        Stars with less than this fraction of valid pixels are rejected. Default is 0.5.
+    filt : str, optional
+        Filter name written to the headers.
+
+    Returns
+    -------
+    psf : astropy.io.fits.HDUList
+        The PSF with 'OVERSAMP' (primary) and 'DET_SAMP' extensions, each normalized to unit sum.
+        Like the stars it is built from, the PSF includes the detector pixel response.
+    """
+    if size % 2 == 0 or oversample % 2 == 0:
+        raise ValueError(f"The PSF size and oversampling must be odd, got {size} and {oversample}.")
+
+    hdul = None
+    if isinstance(mosaic, str):
+        hdul = fits.open(mosaic, memmap=True)
+        data = hdul[ext].data
+        wcs = wcs or WCS(hdul[ext].header)
+    else:
+        data = mosaic
+
+    try:
+        x, y = star_positions(stars, wcs, frame=frame)
+        # pad by a few pixels so that recentring does not run off the cutouts
+        pad = 3
+        cutouts = extract_cutouts(data, x, y, size + 2 * pad)
+    finally:
+        if hdul is not None:
+            hdul.close()
+
+    # the nearest pixel is the cutout centre; keep the catalogue's sub-pixel offset
+    dx, dy = x - np.round(x), y - np.round(y)
+    if recenter:
+        dx, dy = refine_centroids(cutouts)
+
+    coverage = np.isfinite(cutouts[:, pad:-pad, pad:-pad]).mean(axis=(1, 2))
+    keep = (coverage >= min_coverage) & (np.abs(dx) < pad) & (np.abs(dy) < pad)
+    if not keep.any():
+        logger.error("None of the stars has enough valid pixels to build a PSF.")
+        raise ValueError("None of the stars has enough valid pixels to build a PSF.")
+    logger.verbose(f"Stacking {keep.sum()} of {len(x)} stars into a {size} px PSF")
+
+    # resample on the padded cutouts and crop back to the PSF size
+    stack = resample_stars(cutouts[keep], dx[keep], dy[keep], oversample, order=order)
+    crop = slice(pad * oversample, (size + pad) * oversample)
+    stack = stack[:, crop, crop]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stack /= np.nansum(stack, axis=(1, 2), keepdims=True)
+
+    oversamp, n_used = clipped_median_stack(stack, sigma=sigma, maxiters=maxiters)
+    oversamp = np.nan_to_num(oversamp)
+    oversamp /= oversamp.sum()
+
+    # the stars are already integrated over the detector pixels, so the
+    # detector-sampled PSF is the oversampled one at the pixel centres (binning
+    # it would apply the pixel response twice)
+    detsamp = oversamp[oversample // 2::oversample, oversample // 2::oversample]
+    detsamp = detsamp / detsamp.sum()
+
+    pixscl = float(np.mean(proj_plane_pixel_scales(wcs.celestial)) * 3600) if wcs is not None else None
+    psf = fits.HDUList([fits.PrimaryHDU(oversamp), fits.ImageHDU(detsamp)])
+    # same keyword layout as WebbPSF's OVERSAMP and DET_SAMP extensions
+    psf[0].header['EXTNAME'] = 'OVERSAMP'
+    psf[0].header['OVERSAMP'] = (oversample, 'Oversampling factor of the stacked stars')
+    psf[0].header['DET_SAMP'] = (oversample, 'Oversampling factor relative to the detector pixels')
+    psf[1].header['EXTNAME'] = 'DET_SAMP'
+    psf[1].header['OVERSAMP'] = (1, 'These data are sampled at detector pixels')
+    psf[1].header['CALCSAMP'] = (oversample, 'This much oversampling used in the stack')
+    for hdu, scale in ((psf[0], oversample), (psf[1], 1)):
+        hdu.header['NSTARS'] = (int(keep.sum()), 'Number of stacked stars')
+        hdu.header['MINSTARS'] = (int(n_used.min()), 'Fewest stars used in a pixel after clipping')
+        if pixscl is not None:
+            hdu.header['PIXELSCL'] = (pixscl / scale, 'Pixel scale in arcsec')
+        if filt is not None:
+            hdu.header['FILTER'] = filt
+        hdu.header['COMMENT'] = "Empirical PSF from a sigma-clipped median stack of stars"
+
+    logger.info(f"Built an empirical PSF from {keep.sum()} stars")
+    return psf
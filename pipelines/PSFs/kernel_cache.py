@@ -0,0 +1,149 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from ..logging.logger_config import setup_logger
+
+logger = setup_logger()
+
+
+def array_digest(array):
+    """
+    Hash the content of an array (dtype, shape and values).
+
+    Parameters
+    ----------
+    array : np.ndarray
+        The array to hash.
+
+    Returns
+    -------
+    digest : str
+        Hex digest of the array.
+    """
+    array = np.ascontiguousarray(array)
+    sha = hashlib.sha1()
+    sha.update(f"{array.dtype.str}|{array.shape}|".encode())
+    sha.update(array.view(np.uint8).ravel())
+    return sha.hexdigest()
+
+
+def kernel_key(target_psf, source_psf, alpha, beta, window='SplitCosineBellWindow'):
+    """
+    Build the cache key of a PSF-matching kernel.
+
+    Parameters
+    ----------
+    target_psf, source_psf : np.ndarray
+        The target and source PSF images.
+    alpha, beta : float
+        The window parameters.
+    window : str
+        Name of the window type. Default is 'SplitCosineBellWindow'.
+
+    Returns
+    -------
+    key : str
+        Hex digest identifying the kernel.
+    """
+    params = [window, repr(float(alpha)), repr(float(beta)), array_digest(target_psf), array_digest(source_psf)]
+    return hashlib.sha1('|'.join(params).encode()).hexdigest()
+
+
+class KernelCache:
+    """
+    Content-addressed on-disk cache of PSF-matching kernels.
+
+    Kernels are stored as .npy files named after `kernel_key` and loaded back
+    memory-mapped, so a repeated run skips `create_matching_kernel` entirely.
+    When the files grow beyond `max_bytes`, the least recently used kernels
+    are deleted.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory for the cached kernels.
+    max_bytes : int
+        Maximum total size of the cache in bytes. Default is 1 GB.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1e9):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def load(self, key):
+        """
+        Load a cached kernel, or return None on a miss.
+
+        The kernel is read into a regular (writable) array, the same type
+        `create_kernels` returns when it builds a kernel.
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        try:
+            kernel = np.load(path)
+        except Exception as e:
+            logger.error(f"Failed to load cached kernel {key}: {e}")
+            self.misses += 1
+            return None
+
+        # the modification time doubles as the last access time for the eviction
+        os.utime(path)
+        self.hits += 1
+        return kernel
+
+    def store(self, key, kernel):
+        """
+        Write a kernel to the cache and evict old kernels if it is over budget.
+        """
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(kernel))
+        # rename so that concurrent runs never read a partially written file
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used kernels until the cache fits `max_bytes`.
+        """
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.npy'):
+                    continue
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                logger.verbose(f"Evicting cached kernel {name}")
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self):
+        with self._lock:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.npy'):
+                    os.remove(os.path.join(self.cache_dir, name))
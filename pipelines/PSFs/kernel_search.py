@@ -0,0 +1,171 @@
+import numpy as np
+from astropy.table import Table
+from photutils.psf import SplitCosineBellWindow
+from scipy import fft as sp_fft
+
+from ..logging.logger_config import setup_logger
+
+logger = setup_logger()
+
+
+def _radial_distance(shape):
+    # same centre convention as photutils' windows
+    position = (np.asarray(shape) - 1) / 2.0
+    y = np.arange(shape[0]) - position[0]
+    x = np.arange(shape[1]) - position[1]
+    return np.hypot(*np.meshgrid(y, x, indexing='ij'))
+
+
+def curve_of_growth(psfs, radii):
+    """
+    Enclosed flux of one or a stack of PSFs within circular apertures around the centre.
+
+    Parameters
+    ----------
+    psfs : np.ndarray
+        A PSF image (ny, nx) or a stack of them (n, ny, nx).
+    radii : np.ndarray
+        Aperture radii in pixels.
+
+    Returns
+    -------
+    growth : np.ndarray
+        The enclosed flux, with shape (len(radii),) or (n, len(radii)).
+    """
+    psfs = np.asarray(psfs)
+    shape = psfs.shape[-2:]
+    inside = _radial_distance(shape).ravel()[None, :] <= np.asarray(radii)[:, None]
+    return psfs.reshape(psfs.shape[:-2] + (-1,)) @ inside.T.astype(psfs.dtype)
+
+
+def kernel_stack(ratio, windows):
+    """
+    Matching kernels for a stack of windows, from the target/source OTF ratio.
+
+    This is the inverse step of `photutils.psf.create_matching_kernel`, batched
+    over the windows.
+
+    Parameters
+    ----------
+    ratio : np.ndarray
+        The target OTF divided by the source OTF.
+    windows : np.ndarray
+        The (n, ny, nx) stack of evaluated windows.
+
+    Returns
+    -------
+    kernels : np.ndarray
+        The (n, ny, nx) kernels, each normalized to unit sum.
+    """
+    kernels = np.real(sp_fft.fftshift(sp_fft.ifft2(sp_fft.ifftshift(ratio * windows, axes=(-2, -1))),
+                                      axes=(-2, -1)))
+    return kernels / kernels.sum(axis=(-2, -1), keepdims=True)
+
+
+def _matched_stack(source_ft, kernels, shape, fft_shape, workers):
+    # linear (zero-padded) convolution of the source PSF with every kernel, cropped to `shape`
+    kernel_ft = sp_fft.rfft2(kernels, s=fft_shape, workers=workers)
+    full = sp_fft.irfft2(kernel_ft * source_ft, s=fft_shape, workers=workers)
+    y0, x0 = shape[0] // 2, shape[1] // 2
+    return full[:, y0:y0 + shape[0], x0:x0 + shape[1]]
+
+
+def optimize_kernel(target_psf, source_psf, alphas=None, betas=None, radii=None, metric='growth_max',
+                    chunk_size=16, workers=None):
+    """
+    Search a grid of SplitCosineBellWindow parameters for the best PSF-matching kernel.
+
+    Both PSFs are transformed once. The kernels of `chunk_size` window
+    candidates at a time are then built and applied to the source PSF in
+    batched FFTs, and each candidate is scored by how well the matched source
+    PSF reproduces the target PSF.
+
+    Parameters
+    ----------
+    target_psf : np.ndarray
+        The target PSF image.
+    source_psf : np.ndarray
+        The source PSF image, with the same shape and pixel scale as the target.
+    alphas : array_like, optional
+        Candidate alpha values. Default is 0.05 to 1 in steps of 0.05.
+    betas : array_like, optional
+        Candidate beta values. Default is 0 to 0.9 in steps of 0.05.
+    radii : array_like, optional
+        Radii (in pixels) of the curve of growth. Default is every pixel out to the PSF edge.
+    metric : str
+        Score used to pick the best kernel (lower is better):
+        'growth_max' (maximum curve-of-growth difference), 'growth_rms'
+        (RMS curve-of-growth difference) or 'residual_rms' (RMS of the
+        pixel residual, relative to the target peak).
+    chunk_size : int
+        Number of candidates transformed together. Default is 16.
+    workers : int, optional
+        Number of FFT threads. Default is the number of CPUs.
+
+    Returns
+    -------
+    kernel : np.ndarray
+        The best kernel, identical to `create_kernels` with the best alpha and beta.
+    scores : astropy.table.Table
+        One row per candidate with alpha, beta and every score, sorted by `metric`.
+    """
+    metrics = ('growth_max', 'growth_rms', 'residual_rms')
+    if metric not in metrics:
+        raise ValueError(f"Unknown metric '{metric}'. Use one of {metrics}.")
+
+    target_psf = np.asarray(target_psf, dtype=float)
+    source_psf = np.asarray(source_psf, dtype=float)
+    if source_psf.shape != target_psf.shape:
+        logger.error("The source and target PSFs must have the same shape.")
+        raise ValueError("The source and target PSFs must have the same shape.")
+
+    target_psf = target_psf / target_psf.sum()
+    source_psf = source_psf / source_psf.sum()
+    shape = target_psf.shape
+
+    alphas = np.arange(0.05, 1.0001, 0.05) if alphas is None else np.atleast_1d(alphas)
+    betas = np.arange(0.0, 0.9001, 0.05) if betas is None else np.atleast_1d(betas)
+    if radii is None:
+        radii = np.arange(1, (min(shape) - 1) // 2 + 1)
+    candidates = [(float(a), float(b)) for a in alphas for b in betas]
+    logger.verbose(f"Scoring {len(candidates)} matching kernels of shape {shape}.")
+
+    # transform both PSFs once
+    source_otf = sp_fft.fftshift(sp_fft.fft2(source_psf, workers=workers))
+    target_otf = sp_fft.fftshift(sp_fft.fft2(target_psf, workers=workers))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = target_otf / source_otf
+
+    fft_shape = tuple(sp_fft.next_fast_len(2 * n - 1, real=True) for n in shape)
+    source_ft = sp_fft.rfft2(source_psf, s=fft_shape, workers=workers)
+    target_growth = curve_of_growth(target_psf, radii)
+    peak = target_psf.max()
+
+    scores = {name: np.empty(len(candidates)) for name in metrics}
+    for start in range(0, len(candidates), chunk_size):
+        chunk = candidates[start:start + chunk_size]
+        windows = np.stack([SplitCosineBellWindow(alpha=a, beta=b)(shape) for a, b in chunk])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            matched = _matched_stack(source_ft, kernel_stack(ratio, windows), shape, fft_shape, workers)
+            growth_diff = curve_of_growth(matched, radii) - target_growth
+            residual = (matched - target_psf).reshape(len(chunk), -1) / peak
+
+        rows = slice(start, start + len(chunk))
+        scores['growth_max'][rows] = np.abs(growth_diff).max(axis=1)
+        scores['growth_rms'][rows] = np.sqrt(np.mean(growth_diff ** 2, axis=1))
+        scores['residual_rms'][rows] = np.sqrt(np.mean(residual ** 2, axis=1))
+
+    # a window that keeps a zero of the source OTF gives a non-finite kernel
+    for values in scores.values():
+        values[~np.isfinite(values)] = np.inf
+
+    table = Table({'alpha': [a for a, _ in candidates], 'beta': [b for _, b in candidates], **scores})
+    table.sort(metric)
+
+    best_alpha, best_beta = float(table['alpha'][0]), float(table['beta'][0])
+    logger.info(f"Best matching window: alpha={best_alpha:.3f}, beta={best_beta:.3f} "
+                f"({metric}={table[metric][0]:.3e})")
+
+    window = SplitCosineBellWindow(alpha=best_alpha, beta=best_beta)
+    kernel = kernel_stack(ratio, window(shape)[None])[0]
+    return kernel, table
@@ -1,16 +1,63 @@
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+import numpy as np
 import webbpsf
-from astropy import time
 from astropy.io import fits
 
-from pipelines.common.jwst_utils import get_pixscl
-from pipelines.images.img_utils import imrotate
+from pipelines.common.utils import generate_filename
+from pipelines.images.img_utils import block_sum, imrotate_many
 
 from ..logging.logger_config import setup_logger
+from .psf_library import psf_params
 
 webbpsf.setup_logging()
 logger = setup_logger()
 
-def generate_webbpsf(filter, img_hdu, ext, pixscl, oversample, fov_pixels, fov_arcsec):
+def calc_webbpsf(filter, pixscl, oversample, fov_pixels, fov_arcsec, opd_date, detector=None, detector_position=None):
+    """ Compute a NIRCam WebbPSF with the OPD closest to the given date.
+
+    Parameters:
+    filter : str
+        The filter to generate the WebbPSF for.
+    pixscl : float
+        The pixel scale for the WebbPSF.
+    oversample : int
+        The oversampling factor for the WebbPSF.
+    fov_pixels : int
+        The field of view in pixels for the WebbPSF.
+    fov_arcsec : float
+        The field of view in arcseconds for the WebbPSF.
+    opd_date : str
+        The date (ISO format) of the WSS OPD to load.
+    detector : str, optional
+        The NIRCam detector (e.g. 'NRCA1'). Default is WebbPSF's default for the filter.
+    detector_position : tuple, optional
+        The (x, y) pixel position on the detector. Default is the detector centre.
+
+    Returns:
+    psf : astropy.io.fits.hdu.hdulist.HDUList
+        The WebbPSF HDUList object.
+    """
+    nc = webbpsf.NIRCam()
+    nc.filter = filter
+    nc.pixelscale = pixscl
+    if detector is not None:
+        nc.detector = detector
+    if detector_position is not None:
+        nc.detector_position = tuple(detector_position)
+    nc.load_wss_opd_by_date(opd_date)
+
+    # output format
+    nc.options['output_mode'] = 'both'
+
+    return nc.calc_psf(oversample=oversample, fov_pixels=fov_pixels, fov_arcsec=fov_arcsec)
+
+
+def generate_webbpsf(filter, img_hdu, ext, pixscl, oversample, fov_pixels, fov_arcsec, library=None):
     """ Generate a WebbPSF for the given filter.
     
     Parameters:
@@ -28,6 +75,8 @@ def generate_webbpsf(filter, img_hdu, ext, pixscl, oversample, fov_pixels, fov_a
         The field of view in pixels for the WebbPSF.
     fov_arcsec : float
         The field of view in arcseconds for the WebbPSF.
+    library : pipelines.PSFs.psf_library.PSFLibrary, optional
+        PSF library to load the PSF from, or to store it in after computing it.
     
     Returns:
     psf : astropy.io.fits.hdu.hdulist.HDUList
@@ -36,17 +85,13 @@ def generate_webbpsf(filter, img_hdu, ext, pixscl, oversample, fov_pixels, fov_a
     logger.verbose(f"Generating WebbPSF for filter {filter}")
 
     try:
-        nc = webbpsf.NIRCam()
-        nc.filter = filter
-        nc.pixelscale = pixscl if pixscl else get_pixscl(img_hdu, ext)
-
-        t = time.Time(img_hdu[ext].header['MJD-AVG'], format='mjd')
-        nc.load_wss_opd_by_date(t.iso.replace(' ', 'T'))
-
-        # output format
-        nc.options['output_mode'] = 'both'
-
-        psf = nc.calc_psf(oversample=oversample, fov_pixels=fov_pixels, fov_arcsec=fov_arcsec)
+        params = psf_params(filter, img_hdu, ext, pixscl=pixscl, oversample=oversample,
+                            fov_pixels=fov_pixels, fov_arcsec=fov_arcsec)
+        if library is not None:
+            psf = library.get(params)
+        else:
+            psf = calc_webbpsf(filter=filter, pixscl=params['pixscl'], oversample=oversample, fov_pixels=fov_pixels,
+                               fov_arcsec=fov_arcsec, opd_date=params['opd_date'])
         
         logger.info(f"WebbPSF generated for filter {filter}")
         logger.info(f"Pixscale for the oversampled PSF: {psf['OVERSAMP'].header['PIXELSCL']}")
@@ -59,7 +104,7 @@ def generate_webbpsf(filter, img_hdu, ext, pixscl, oversample, fov_pixels, fov_a
         return None
     
 
-def rotate_webbpsf(psf, img_hdu=None, ext=None, pa=None):
+def rotate_webbpsf(psf, img_hdu=None, ext=None, pa=None, bin_detsamp=False):
     """ Rotate the WebbPSF by the given position angle.
     
     Parameters:
@@ -69,29 +114,241 @@ def rotate_webbpsf(psf, img_hdu=None, ext=None, pa=None):
         The image HDUList object.
     ext : int
         The FITS extension to extract the pixel scale from.
-    pa : float
-        The position angle in degrees.
+    pa : float or list
+        The position angle in degrees. A list of angles (e.g. for a multi-PA
+        mosaic) adds one ROTATED_OVERSAMP and ROTATED_DET_SAMP extension per
+        angle, numbered with EXTVER 1, 2, ...
+    bin_detsamp : bool
+        Rotate only the oversampled PSF and derive the rotated detector-sampled
+        PSF from it by flux-conserving block summation, instead of rotating the
+        (coarser) detector-sampled PSF directly. Default is False.
         
     Returns:
     psf : astropy.io.fits.hdu.hdulist.HDUList
         The rotated WebbPSF HDUList object.
     """
 
+    angle = pa
     try:
-        angle = pa if pa else img_hdu[ext].header['PA_APER']
+        angle = pa if pa is not None else img_hdu[ext].header['PA_APER']
+        angles = np.atleast_1d(angle).astype(float)
         logger.verbose(f"Rotating WebbPSF by PA={angle}")
-        rotated_psf_oversamp = imrotate(psf['OVERSAMP'].data, angle, reshape=False)
-        rotated_psf_detsamp = imrotate(psf['DET_SAMP'].data, angle, reshape=False)
 
-        # add these two files to the hdu list
-        psf.append(fits.ImageHDU(data=rotated_psf_oversamp, name='ROTATED_OVERSAMP', header=psf['OVERSAMP'].header.copy()))
-        psf.append(fits.ImageHDU(data=rotated_psf_detsamp, name='ROTATED_DET_SAMP', header=psf['DET_SAMP'].header.copy()))
+        # all the angles share one coordinate grid and one interpolation call
+        rotated_oversamp = imrotate_many(psf['OVERSAMP'].data, angles)
+        if bin_detsamp:
+            factor = psf['OVERSAMP'].data.shape[0] // psf['DET_SAMP'].data.shape[0]
+            rotated_detsamp = block_sum(rotated_oversamp, factor)
+        else:
+            rotated_detsamp = imrotate_many(psf['DET_SAMP'].data, angles)
+
+        for num, (pa_aper, oversamp, detsamp) in enumerate(zip(angles, rotated_oversamp, rotated_detsamp), start=1):
+            # add these two files to the hdu list
+            hdu_over = fits.ImageHDU(data=oversamp, name='ROTATED_OVERSAMP', header=psf['OVERSAMP'].header.copy())
+            hdu_det = fits.ImageHDU(data=detsamp, name='ROTATED_DET_SAMP', header=psf['DET_SAMP'].header.copy())
 
-        # copy the header from the input image HDU to the rotated PSF HDU and add a comment about the rotation
-        psf['ROTATED_OVERSAMP'].header['COMMENT'] = f"Rotated by PA={angle} degrees"
-        psf['ROTATED_DET_SAMP'].header['COMMENT'] = f"Rotated by PA={angle} degrees"
+            # add a comment about the rotation
+            for hdu in (hdu_over, hdu_det):
+                hdu.header['COMMENT'] = f"Rotated by PA={pa_aper:g} degrees"
+                if np.ndim(angle):
+                    hdu.header['EXTVER'] = num
+                    hdu.header['PA_APER'] = pa_aper
+            if bin_detsamp:
+                hdu_det.header['COMMENT'] = f"Binned {factor}x{factor} from ROTATED_OVERSAMP"
+
+            psf.append(hdu_over)
+            psf.append(hdu_det)
 
         return psf
     except Exception as e:
         logger.error(f"Failed to rotate WebbPSF by PA={angle}: {e}", exc_info=True)
         return None
+
+
+def plan_webbpsf_jobs(filters, images, ext=0, pixscl=None, oversample=3, fov_pixels=None, fov_arcsec=None):
+    """ Build the de-duplicated list of WebbPSF calculations for several filters and epochs.
+
+    Parameters:
+    filters : list
+        The filters to generate PSFs for.
+    images : list
+        Paths of the images (one per epoch); only their headers are read.
+    ext : int
+        The FITS extension with the 'MJD-AVG' and 'PA_APER' keywords.
+    pixscl, oversample, fov_pixels, fov_arcsec :
+        See `generate_webbpsf`.
+
+    Returns:
+    jobs : list
+        The unique PSF parameters (see `psf_library.psf_params`).
+    targets : list
+        One (filter, image, job index, position angle) tuple per requested PSF.
+    """
+    jobs, targets, seen = [], [], {}
+    for image in images:
+        with fits.open(image, memmap=True) as img_hdu:
+            pa = img_hdu[ext].header.get('PA_APER')
+            for filt in filters:
+                params = psf_params(filt, img_hdu, ext, pixscl=pixscl, oversample=oversample,
+                                    fov_pixels=fov_pixels, fov_arcsec=fov_arcsec)
+                key = tuple(sorted(params.items()))
+                if key not in seen:
+                    seen[key] = len(jobs)
+                    jobs.append(params)
+                targets.append((filt, image, seen[key], pa))
+
+    logger.info(f"{len(targets)} PSFs requested, {len(jobs)} unique WebbPSF calculations")
+    return jobs, targets
+
+
+_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+@contextmanager
+def _thread_environment(threads):
+    # the BLAS/OpenMP thread pools read these once, when they are loaded, so they
+    # are set in the parent while the spawned workers start and import numpy
+    previous = {name: os.environ.get(name) for name in _THREAD_VARIABLES}
+    os.environ.update({name: str(threads) for name in _THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _init_psf_worker(threads):
+    # keep each worker within its share of the core budget
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+    try:
+        import poppy
+        # poppy's own process pool and pyFFTW (which plans with every CPU) would ignore the limit
+        poppy.conf.use_multiprocessing = False
+        poppy.conf.use_fftw = False
+    except ImportError:
+        pass
+
+
+def _calc_webbpsf_bytes(generator, params):
+    # HDULists are passed back to the parent as serialized FITS files
+    psf = generator(**params)
+    buffer = io.BytesIO()
+    psf.writeto(buffer, output_verify='silentfix')
+    return buffer.getvalue()
+
+
+def generate_webbpsf_batch(filters, images, output_dir, ext=0, pixscl=None, oversample=3, fov_pixels=None,
+                           fov_arcsec=None, max_cores=None, threads_per_job=1, library=None, generator=None,
+                           rotate=True, bin_detsamp=False):
+    """ Generate, rotate and write WebbPSFs for several filters and epochs at once.
+
+    The unique calculations from `plan_webbpsf_jobs` that are not already in
+    `library` run in a pool of ``max_cores // threads_per_job`` spawned worker
+    processes, each limited to `threads_per_job` BLAS/OpenMP threads. Each
+    result is then rotated to the position angle of its image and written to
+    `output_dir`.
+
+    Parameters:
+    filters : list
+        The filters to generate PSFs for.
+    images : list
+        Paths of the images (one per epoch).
+    output_dir : str
+        Directory for the PSF files, named 'psf_{filter}_{image name}_{date}.fits'.
+        Different images with the same name get their index in `images` appended.
+    ext : int
+        The FITS extension of the images.
+    pixscl, oversample, fov_pixels, fov_arcsec :
+        See `generate_webbpsf`.
+    max_cores : int
+        The core budget. Default is the number of CPUs.
+    threads_per_job : int
+        Threads used by each calculation. Default is 1.
+    library : pipelines.PSFs.psf_library.PSFLibrary, optional
+        PSF library to reuse earlier calculations from and to store new ones in.
+    generator : callable, optional
+        Module-level function computing a PSF from the PSF parameters. Default is
+        the generator of `library`, or `calc_webbpsf`.
+    rotate : bool
+        Rotate each PSF to the 'PA_APER' of its image. Default is True.
+    bin_detsamp : bool
+        Derive the rotated detector-sampled PSF from the rotated oversampled
+        one, see `rotate_webbpsf`. Default is False.
+
+    Returns:
+    paths : list
+        The written PSF files, in the order of the targets (None for failed PSFs).
+    """
+    if generator is None:
+        generator = library.generator if library is not None else calc_webbpsf
+    jobs, targets = plan_webbpsf_jobs(filters, images, ext=ext, pixscl=pixscl, oversample=oversample,
+                                      fov_pixels=fov_pixels, fov_arcsec=fov_arcsec)
+
+    results = {}
+    if library is not None:
+        for num, params in enumerate(jobs):
+            psf = library.load(params)
+            if psf is not None:
+                results[num] = psf
+        logger.info(f"{len(results)} of {len(jobs)} PSFs loaded from the library")
+
+    pending = [num for num in range(len(jobs)) if num not in results]
+    if pending:
+        max_cores = max_cores or os.cpu_count() or 1
+        workers = max(1, min(len(pending), max_cores // max(threads_per_job, 1)))
+        logger.info(f"Computing {len(pending)} PSFs with {workers} workers x {threads_per_job} threads")
+
+        with _thread_environment(threads_per_job), \
+                ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=_init_psf_worker, initargs=(threads_per_job,)) as executor:
+            futures = {executor.submit(_calc_webbpsf_bytes, generator, jobs[num]): num for num in pending}
+            for future in as_completed(futures):
+                num = futures[future]
+                try:
+                    psf = fits.open(io.BytesIO(future.result()))
+                    psf = fits.HDUList([hdu.copy() for hdu in psf])
+                except Exception as e:
+                    logger.error(f"Failed to generate WebbPSF for {jobs[num]}: {e}")
+                    continue
+                results[num] = psf
+                if library is not None:
+                    library.store(jobs[num], psf)
+
+    # different images with the same file name would overwrite each other's PSFs
+    first, names = {}, {}
+    for index, image in enumerate(images):
+        first.setdefault(os.path.abspath(image), index)
+    for image, index in first.items():
+        names.setdefault(os.path.splitext(os.path.basename(image))[0], []).append((index, image))
+    image_names = {image: name if len(same) == 1 else f"{name}_{index}"
+                   for name, same in names.items() for index, image in same}
+
+    paths = []
+    for filt, image, num, pa in targets:
+        if num not in results:
+            paths.append(None)
+            continue
+
+        psf = fits.HDUList([hdu.copy() for hdu in results[num]])
+        if rotate:
+            if pa is None:
+                logger.error(f"No PA_APER in {image}; writing the {filt} PSF unrotated.")
+            else:
+                psf = rotate_webbpsf(psf, pa=pa, bin_detsamp=bin_detsamp)
+                if psf is None:
+                    paths.append(None)
+                    continue
+
+        path = generate_filename(f"psf_{filt}_{image_names[os.path.abspath(image)]}", 'fits', output_dir)
+        psf.writeto(path, overwrite=True)
+        paths.append(path)
+
+    logger.info(f"Wrote {sum(path is not None for path in paths)} of {len(targets)} PSFs to {output_dir}")
+    return paths
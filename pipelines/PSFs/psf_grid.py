@@ -0,0 +1,232 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+from ..logging.logger_config import setup_logger
+
+logger = setup_logger()
+
+
+class PSFGrid:
+    """
+    PSFs on a regular grid of detector positions, interpolated to any position.
+
+    The PSFs are kept as one (n, ny, nx) cube. A PSF at an arbitrary position
+    is the bilinear interpolation of the four surrounding grid PSFs (positions
+    outside the grid use the nearest edge), so the flux normalization of the
+    grid PSFs is preserved. Many positions are interpolated in vectorized
+    chunks, and the results are kept in an LRU cache.
+
+    Parameters
+    ----------
+    psfs : np.ndarray
+        The (n, ny, nx) cube of PSFs.
+    positions : np.ndarray
+        The (n, 2) detector (x, y) positions of the PSFs. They must cover a
+        full rectangular grid, in any order.
+    header : astropy.io.fits.Header, optional
+        Header of the PSFs (e.g. PIXELSCL, FILTER), kept when saving the grid.
+    cache_size : int
+        Maximum number of interpolated PSFs kept in memory. Default is 1024.
+    """
+
+    def __init__(self, psfs, positions, header=None, cache_size=1024):
+        psfs = np.asarray(psfs)
+        positions = np.asarray(positions, dtype=float)
+        if psfs.ndim != 3 or positions.shape != (len(psfs), 2):
+            raise ValueError("psfs must be an (n, ny, nx) cube and positions an (n, 2) array of (x, y).")
+
+        self.x_grid = np.unique(positions[:, 0])
+        self.y_grid = np.unique(positions[:, 1])
+
+        # reorder the cube so that PSF (j, i) is at (y_grid[j], x_grid[i])
+        index = np.searchsorted(self.y_grid, positions[:, 1]) * len(self.x_grid) \
+            + np.searchsorted(self.x_grid, positions[:, 0])
+        # every grid position exactly once (no duplicates, none missing)
+        if len(self.x_grid) * len(self.y_grid) != len(psfs) or len(np.unique(index)) != len(psfs):
+            logger.error(f"{len(psfs)} PSFs do not form a regular grid of "
+                         f"{len(self.x_grid)} x {len(self.y_grid)} distinct positions.")
+            raise ValueError("The PSF positions must form a regular grid.")
+        cube = np.empty_like(psfs)
+        cube[index] = psfs
+        self.psfs = cube.reshape(len(self.y_grid), len(self.x_grid), *psfs.shape[1:])
+
+        self.header = header if header is not None else fits.Header()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.psfs.shape[2:]
+
+    @property
+    def positions(self):
+        xx, yy = np.meshgrid(self.x_grid, self.y_grid)
+        return np.column_stack([xx.ravel(), yy.ravel()])
+
+    def __len__(self):
+        return len(self.x_grid) * len(self.y_grid)
+
+    @staticmethod
+    def _axis_weights(grid, values):
+        # lower neighbour and weight of the upper neighbour along one axis, clamped to the grid
+        if len(grid) == 1:
+            return np.zeros(len(values), dtype=int), np.zeros(len(values))
+        values = np.clip(values, grid[0], grid[-1])
+        lower = np.clip(np.searchsorted(grid, values, side='right') - 1, 0, len(grid) - 2)
+        weight = (values - grid[lower]) / (grid[lower + 1] - grid[lower])
+        return lower, weight
+
+    def interpolate(self, x, y, chunk_size=256):
+        """
+        Interpolate the PSF at many positions in vectorized chunks, without the cache.
+
+        Parameters
+        ----------
+        x, y : array_like
+            Detector positions.
+        chunk_size : int
+            Number of positions interpolated at a time, which bounds the
+            temporary arrays to a few `chunk_size` PSFs. Default is 256.
+
+        Returns
+        -------
+        psfs : np.ndarray
+            The (n, ny, nx) interpolated PSFs.
+        """
+        x, y = np.atleast_1d(np.asarray(x, dtype=float)), np.atleast_1d(np.asarray(y, dtype=float))
+        i, wx = self._axis_weights(self.x_grid, x)
+        j, wy = self._axis_weights(self.y_grid, y)
+        i1 = np.minimum(i + 1, len(self.x_grid) - 1)
+        j1 = np.minimum(j + 1, len(self.y_grid) - 1)
+
+        weights = np.stack([(1 - wy) * (1 - wx), (1 - wy) * wx, wy * (1 - wx), wy * wx])
+        out = np.empty((len(x),) + self.shape, dtype=np.result_type(self.psfs, float))
+        for start in range(0, len(x), chunk_size):
+            c = slice(start, start + chunk_size)
+            corners = np.stack([self.psfs[j[c], i[c]], self.psfs[j[c], i1[c]],
+                                self.psfs[j1[c], i[c]], self.psfs[j1[c], i1[c]]])
+            np.einsum('kn,knyx->nyx', weights[:, c], corners, out=out[c])
+        return out
+
+    def __call__(self, x, y, decimals=3):
+        """
+        Get the PSFs at many positions, interpolating only those not in the cache.
+
+        Parameters
+        ----------
+        x, y : array_like
+            Detector positions.
+        decimals : int
+            Positions are rounded to this many decimals for the cache keys. Default is 3.
+
+        Returns
+        -------
+        psfs : np.ndarray
+            The (n, ny, nx) PSFs, or a single (ny, nx) PSF for scalar positions.
+        """
+        scalar = np.ndim(x) == 0 and np.ndim(y) == 0
+        x, y = np.broadcast_arrays(np.round(np.atleast_1d(x).astype(float), decimals),
+                                   np.round(np.atleast_1d(y).astype(float), decimals))
+        keys = list(zip(x.ravel().tolist(), y.ravel().tolist()))
+
+        with self._lock:
+            cached = [key in self._cache for key in keys]
+        self.hits += sum(cached)
+        self.misses += len(keys) - sum(cached)
+
+        missing = sorted({key for key, hit in zip(keys, cached) if not hit})
+        found = {}
+        if missing:
+            mx, my = np.array(missing).T
+            found = dict(zip(missing, self.interpolate(mx, my)))
+
+        out = np.empty((len(keys),) + self.shape, dtype=float)
+        with self._lock:
+            for num, key in enumerate(keys):
+                psf = found.get(key)
+                if psf is None:
+                    psf = self._cache.get(key)
+                if psf is None:
+                    # evicted by another thread in the meantime
+                    psf = self.interpolate(*key)[0]
+                else:
+                    self._cache.pop(key, None)
+                self._cache[key] = psf
+                out[num] = psf
+
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return out[0] if scalar else out
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def save(self, path):
+        """
+        Save the grid as a FITS file with the PSF cube and a table of positions.
+        """
+        cube = fits.PrimaryHDU(data=self.psfs.reshape(len(self), *self.shape), header=self.header.copy())
+        cube.header['EXTNAME'] = 'PSF_GRID'
+        positions = self.positions
+        table = fits.BinTableHDU(Table({'x': positions[:, 0], 'y': positions[:, 1]}), name='POSITIONS')
+        fits.HDUList([cube, table]).writeto(path, overwrite=True)
+        logger.verbose(f"Saved a grid of {len(self)} PSFs to {path}")
+
+    @classmethod
+    def load(cls, path, cache_size=1024):
+        """
+        Load a grid saved with `save`.
+        """
+        with fits.open(path) as hdul:
+            positions = np.column_stack([hdul['POSITIONS'].data['x'], hdul['POSITIONS'].data['y']])
+            return cls(hdul['PSF_GRID'].data.copy(), positions, header=hdul['PSF_GRID'].header.copy(),
+                       cache_size=cache_size)
+
+    @classmethod
+    def from_library(cls, library, params, x_grid, y_grid, ext='DET_SAMP', cache_size=1024):
+        """
+        Build a grid from WebbPSF calculations at every grid position.
+
+        Each PSF is loaded from (or computed into) the library, so a grid is
+        only ever computed once.
+
+        Parameters
+        ----------
+        library : pipelines.PSFs.psf_library.PSFLibrary
+            The PSF library.
+        params : dict
+            The PSF parameters from `psf_params` (without `detector_position`).
+        x_grid, y_grid : array_like
+            The detector x and y positions of the grid.
+        ext : str
+            The PSF extension to use. Default is 'DET_SAMP'.
+        cache_size : int
+            See `PSFGrid`.
+
+        Returns
+        -------
+        grid : PSFGrid
+            The PSF grid.
+        """
+        positions, psfs, header = [], [], None
+        for y in y_grid:
+            for x in x_grid:
+                psf = library.get({**params, 'detector_position': [round(float(x), 3), round(float(y), 3)]})
+                if psf is None:
+                    logger.error(f"Failed to get the {params['filter']} PSF at ({x}, {y}).")
+                    raise RuntimeError(f"Failed to get the {params['filter']} PSF at ({x}, {y}).")
+                psfs.append(psf[ext].data)
+                positions.append((x, y))
+                header = header or psf[ext].header.copy()
+
+        logger.info(f"Built a {len(x_grid)} x {len(y_grid)} {params['filter']} PSF grid")
+        return cls(np.stack(psfs), positions, header=header, cache_size=cache_size)
@@ -0,0 +1,280 @@
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from astropy import time
+from astropy.io import fits
+
+from ..common.jwst_utils import get_pixscl
+from ..logging.logger_config import setup_logger
+
+logger = setup_logger()
+
+INDEX_NAME = 'index.json'
+
+
+def opd_date(img_hdu, ext):
+    """
+    The date of the WSS OPD to load for an image, from its 'MJD-AVG' keyword.
+    """
+    t = time.Time(img_hdu[ext].header['MJD-AVG'], format='mjd')
+    return t.iso.replace(' ', 'T')
+
+
+def psf_params(filter, img_hdu=None, ext=0, pixscl=None, oversample=3, fov_pixels=None, fov_arcsec=None,
+               date=None, detector=None, detector_position=None):
+    """
+    Resolve the parameters of a WebbPSF calculation for an image.
+
+    Parameters
+    ----------
+    filter : str
+        The filter.
+    img_hdu : astropy.io.fits.HDUList, optional
+        The image, used for the pixel scale and OPD date when they are not given.
+    ext : int
+        The FITS extension of the image. Default is 0.
+    pixscl : float, optional
+        The pixel scale in arcseconds. Default is the image's.
+    oversample : int
+        The oversampling factor. Default is 3.
+    fov_pixels : int, optional
+        The field of view in pixels.
+    fov_arcsec : float, optional
+        The field of view in arcseconds.
+    date : str, optional
+        The OPD date (ISO format). Default is the image's 'MJD-AVG'.
+    detector : str, optional
+        The NIRCam detector (e.g. 'NRCA1').
+    detector_position : tuple, optional
+        The (x, y) pixel position on the detector.
+
+    Returns
+    -------
+    params : dict
+        The parameters, which identify the PSF in a `PSFLibrary`.
+    """
+    params = {
+        'filter': filter.upper(),
+        'pixscl': round(float(pixscl if pixscl else get_pixscl(img_hdu, ext)), 8),
+        'oversample': int(oversample),
+        'fov_pixels': None if fov_pixels is None else int(fov_pixels),
+        'fov_arcsec': None if fov_arcsec is None else float(fov_arcsec),
+        'opd_date': date if date else opd_date(img_hdu, ext),
+    }
+    # only added when set, so the keys of field-centre PSFs do not change
+    if detector is not None:
+        params['detector'] = detector.upper()
+    if detector_position is not None:
+        params['detector_position'] = [round(float(p), 3) for p in detector_position]
+    return params
+
+
+def _webbpsf_version():
+    import webbpsf
+    return webbpsf.__version__
+
+
+def _calc_webbpsf(**params):
+    from .makewebbpsf import calc_webbpsf
+    return calc_webbpsf(**params)
+
+
+class PSFLibrary:
+    """
+    Persistent on-disk library of WebbPSF calculations.
+
+    Each PSF is stored as a multi-extension FITS file named after a hash of its
+    parameters (see `psf_params`) and the WebbPSF version. A JSON index maps
+    the keys to their parameters, file size and last access time, and is used
+    to evict the least recently used PSFs once the library exceeds `max_bytes`.
+    Index updates hold a lock file, so several processes (e.g. parallel runs
+    of the PSF scripts) can share a library.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the library.
+    max_bytes : int
+        Maximum total size of the stored PSFs in bytes. Default is 5 GB.
+    generator : callable, optional
+        Function computing a PSF from the keyword arguments of `psf_params`
+        and returning an HDUList. Default is `makewebbpsf.calc_webbpsf`. Pass a
+        stub to use the library without WebbPSF.
+    version : str, optional
+        Version string included in the keys. Default is the installed WebbPSF version.
+    """
+
+    def __init__(self, cache_dir, max_bytes=5e9, generator=None, version=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.generator = generator or _calc_webbpsf
+        self._version = version
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def version(self):
+        if self._version is None:
+            self._version = _webbpsf_version()
+        return self._version
+
+    @property
+    def index_path(self):
+        return os.path.join(self.cache_dir, INDEX_NAME)
+
+    def key(self, params):
+        return hashlib.sha1(json.dumps([self.version, params], sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.fits")
+
+    @contextmanager
+    def _index_lock(self):
+        # threads of this process, then other processes through a lock file
+        with self._lock, open(f"{self.index_path}.lock", 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _entry(self, params, path):
+        return {'params': params, 'version': self.version, 'file': os.path.basename(path),
+                'size': os.path.getsize(path), 'last_access': datetime.now().timestamp()}
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to read the PSF library index {self.index_path}: {e}")
+            return {}
+
+    def _write_index(self, index):
+        tmp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def entries(self):
+        """
+        The index of the library, as {key: entry}.
+        """
+        with self._index_lock():
+            return self._read_index()
+
+    def __contains__(self, params):
+        return os.path.exists(self._path(self.key(params)))
+
+    def load(self, params):
+        """
+        Load a stored PSF into memory, or return None if it is not in the library.
+        """
+        key = self.key(params)
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with fits.open(path, memmap=False) as hdul:
+                psf = fits.HDUList([hdu.copy() for hdu in hdul])
+        except Exception as e:
+            logger.error(f"Failed to load PSF {key} from the library: {e}")
+            return None
+
+        with self._index_lock():
+            index = self._read_index()
+            if key in index:
+                index[key]['last_access'] = datetime.now().timestamp()
+            else:
+                # the file was stored without an index entry (e.g. an index written concurrently)
+                index[key] = self._entry(params, path)
+            self._write_index(index)
+        return psf
+
+    def store(self, params, psf):
+        """
+        Write a PSF to the library and evict old PSFs if it is over budget.
+        """
+        key = self.key(params)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        psf.writeto(tmp_path, overwrite=True, output_verify='silentfix')
+        # rename so that concurrent runs never read a partially written file
+        os.replace(tmp_path, path)
+
+        with self._index_lock():
+            index = self._read_index()
+            index[key] = self._entry(params, path)
+            self._write_index(index)
+        self.evict()
+
+    def get(self, params):
+        """
+        Get a PSF from the library, computing and storing it on a miss.
+
+        Parameters
+        ----------
+        params : dict
+            The PSF parameters from `psf_params`.
+
+        Returns
+        -------
+        psf : astropy.io.fits.HDUList
+            The PSF, or None if the generator failed.
+        """
+        psf = self.load(params)
+        if psf is not None:
+            self.hits += 1
+            logger.verbose(f"Loaded the {params['filter']} PSF from the library.")
+            return psf
+
+        self.misses += 1
+        logger.verbose(f"Computing the {params['filter']} PSF for the library.")
+        psf = self.generator(**params)
+        if psf is not None:
+            self.store(params, psf)
+        return psf
+
+    def evict(self):
+        """
+        Delete the least recently used PSFs until the library fits `max_bytes`.
+        """
+        with self._index_lock():
+            index = self._read_index()
+            # drop entries whose files were removed by hand
+            index = {key: entry for key, entry in index.items() if os.path.exists(self._path(key))}
+
+            total = sum(entry['size'] for entry in index.values())
+            for key in sorted(index, key=lambda k: index[k]['last_access']):
+                if total <= self.max_bytes:
+                    break
+                logger.verbose(f"Evicting PSF {key} ({index[key]['params']['filter']}) from the library")
+                total -= index[key]['size']
+                os.remove(self._path(key))
+                del index[key]
+
+            self._write_index(index)
+
+    def clear(self):
+        with self._index_lock():
+            for key in self._read_index():
+                if os.path.exists(self._path(key)):
+                    os.remove(self._path(key))
+            self._write_index({})
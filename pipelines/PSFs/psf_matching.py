@@ -0,0 +1,227 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+from photutils.psf import SplitCosineBellWindow
+from scipy import fft as sp_fft
+
+from ..common.utils import generate_filename
+from ..images.img_utils import iter_tiles
+from ..logging.logger_config import setup_logger
+from .convolve import Convolver, choose_tile_size
+from .kernel_cache import kernel_key
+from .kernel_search import kernel_stack
+
+logger = setup_logger()
+
+
+def _per_filter(value, filt):
+    return value[filt] if isinstance(value, dict) else value
+
+
+def _otf(psf):
+    psf = np.asarray(psf, dtype=float)
+    return sp_fft.fftshift(sp_fft.fft2(psf / psf.sum()))
+
+
+def matching_kernels(target_psf, source_psfs, alpha=0.5, beta=0.0, cache=None):
+    """
+    Create the kernels matching several PSFs to one target PSF.
+
+    The target PSF is transformed once and shared by all kernels; each kernel
+    is identical to ``create_kernels(target_psf, source_psf, alpha, beta)``.
+
+    Parameters
+    ----------
+    target_psf : np.ndarray
+        The target PSF image.
+    source_psfs : dict
+        {filter: source PSF image}, all with the shape of the target PSF.
+    alpha, beta : float or dict
+        The SplitCosineBellWindow parameters, either shared or as {filter: value}.
+    cache : KernelCache, optional
+        On-disk kernel cache, see `create_kernels`.
+
+    Returns
+    -------
+    kernels : dict
+        {filter: kernel}.
+    """
+    target_psf = np.asarray(target_psf, dtype=float)
+    target_otf = None
+    kernels = {}
+    for filt, source_psf in source_psfs.items():
+        f_alpha, f_beta = _per_filter(alpha, filt), _per_filter(beta, filt)
+        source_psf = np.asarray(source_psf, dtype=float)
+        if source_psf.shape != target_psf.shape:
+            logger.error(f"The {filt} PSF has shape {source_psf.shape}, but the target PSF has {target_psf.shape}.")
+            raise ValueError(f"The {filt} PSF and the target PSF must have the same shape.")
+
+        if cache is not None:
+            key = kernel_key(target_psf, source_psf, f_alpha, f_beta, window=SplitCosineBellWindow.__name__)
+            kernels[filt] = cache.load(key)
+            if kernels[filt] is not None:
+                logger.verbose(f"Loaded the {filt} matching kernel from the cache.")
+                continue
+
+        if target_otf is None:
+            target_otf = _otf(target_psf)
+
+        window = SplitCosineBellWindow(alpha=f_alpha, beta=f_beta)(target_psf.shape)
+        kernels[filt] = kernel_stack(target_otf / _otf(source_psf), window[None])[0]
+        if cache is not None:
+            cache.store(key, kernels[filt])
+
+    return kernels
+
+
+def create_fits_memmap(path, shape, header=None, dtype=np.float32):
+    """
+    Create a FITS file with an empty primary image and open its data as a memory map.
+
+    The file is allocated on disk without building the image in memory, so
+    it can be filled tile by tile.
+
+    Parameters
+    ----------
+    path : str
+        Path of the new FITS file. An existing file is overwritten.
+    shape : tuple
+        Shape (ny, nx) of the image.
+    header : astropy.io.fits.Header, optional
+        Header to copy the non-structural keywords from (e.g. the WCS).
+    dtype : np.dtype
+        Data type of the image. Default is float32.
+
+    Returns
+    -------
+    hdul : astropy.io.fits.HDUList
+        The file opened in update mode; close it to flush the data.
+    """
+    hdu = fits.PrimaryHDU(data=np.zeros((1, 1), dtype=dtype))
+    if header is not None:
+        for card in header.cards:
+            if card.keyword not in ('SIMPLE', 'BITPIX', 'EXTEND', 'BSCALE', 'BZERO', 'EXTNAME', 'XTENSION',
+                                    'PCOUNT', 'GCOUNT', '') and not card.keyword.startswith('NAXIS'):
+                hdu.header.append(card)
+    hdu.header['NAXIS1'] = shape[1]
+    hdu.header['NAXIS2'] = shape[0]
+
+    data_bytes = shape[0] * shape[1] * np.dtype(dtype).itemsize
+    padded = -(-data_bytes // 2880) * 2880
+    hdu.header.tofile(path, overwrite=True)
+    with open(path, 'rb+') as f:
+        f.seek(len(hdu.header.tostring()) + padded - 1)
+        f.write(b'\0')
+
+    return fits.open(path, mode='update', memmap=True)
+
+
+def _open_image(image, img_ext):
+    if isinstance(image, str):
+        hdul = fits.open(image, memmap=True)
+        return hdul, hdul[img_ext].data, hdul[img_ext].header
+    return None, image, None
+
+
+def _copy_tile(image, inner, out):
+    out[inner] = image[inner]
+
+
+def match_psfs(inputs, target_filter, alpha=0.5, beta=0.0, output_dir=None, base_name='psf_matched',
+               img_ext=0, cache=None, memory_budget=4e9, workers=None, tile_size=None):
+    """
+    Match the PSF of every filter to that of a target filter in one pass.
+
+    All kernels are built against a single transform of the target PSF, and
+    the tiles of every image are convolved by one shared thread pool, so at
+    most `workers` tiles (bounded by `memory_budget`) are held at a time. With
+    `output_dir`, each matched mosaic is written straight into a memory-mapped
+    FITS file instead of being built in memory.
+
+    Parameters
+    ----------
+    inputs : dict
+        {filter: (image, psf)}, where image is a 2D array or the path of a FITS
+        mosaic and psf the PSF image of that filter.
+    target_filter : str
+        The filter whose PSF the others are matched to. Its image is copied unchanged.
+    alpha, beta : float or dict
+        The SplitCosineBellWindow parameters, either shared or as {filter: value}.
+    output_dir : str, optional
+        Directory for the matched mosaics. Default is None (return arrays).
+    base_name : str
+        Base name of the output files, which are named
+        '{base_name}_{filter}_to_{target_filter}_{date}.fits'.
+    img_ext : int or str
+        The FITS extension of the images given as paths. Default is 0.
+    cache : KernelCache, optional
+        On-disk kernel cache, see `create_kernels`.
+    memory_budget : float
+        Approximate bytes available for the tiles convolved at the same time. Default is 4 GB.
+    workers : int, optional
+        Number of threads. Default is the number of CPUs.
+    tile_size : int, optional
+        Size of the output tiles. Default is the largest that fits `memory_budget`.
+
+    Returns
+    -------
+    matched : dict
+        {filter: output path} if `output_dir` is given, else {filter: matched image}.
+    """
+    if target_filter not in inputs:
+        logger.error(f"The target filter {target_filter} is not one of the inputs {list(inputs)}.")
+        raise KeyError(f"The target filter {target_filter} is not one of the inputs.")
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    target_psf = inputs[target_filter][1]
+    sources = {filt: psf for filt, (_, psf) in inputs.items() if filt != target_filter}
+    kernels = matching_kernels(target_psf, sources, alpha=alpha, beta=beta, cache=cache)
+    convolvers = {filt: Convolver(kernel, threads=1) for filt, kernel in kernels.items()}
+
+    if tile_size is None:
+        tile_size = choose_tile_size(np.shape(target_psf), memory_budget, workers)
+
+    opened, outputs, matched = [], {}, {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for filt, (image, _) in inputs.items():
+                hdul, data, header = _open_image(image, img_ext)
+                if hdul is not None:
+                    opened.append(hdul)
+
+                if output_dir is not None:
+                    path = generate_filename(f"{base_name}_{filt}_to_{target_filter}", 'fits', output_dir)
+                    out_hdul = create_fits_memmap(path, data.shape, header)
+                    opened.append(out_hdul)
+                    out, matched[filt] = out_hdul[0].data, path
+                else:
+                    out = np.empty(data.shape, dtype=np.float32)
+                    matched[filt] = out
+                outputs[filt] = out
+
+                filt_tile = min(tile_size, max(data.shape))
+                if filt == target_filter:
+                    futures += [executor.submit(_copy_tile, data, inner, out)
+                                for inner, _, _ in iter_tiles(data.shape, filt_tile)]
+                    continue
+
+                convolver = convolvers[filt]
+                fft_shape = convolver.fft_shape((filt_tile, filt_tile))
+                convolver.kernel_transform(fft_shape)
+                logger.verbose(f"Matching {filt} to {target_filter} in {filt_tile} px tiles")
+                futures += [executor.submit(convolver.convolve_tile, data, inner, out, fft_shape, 1)
+                            for inner, _, _ in iter_tiles(data.shape, filt_tile)]
+
+            for future in futures:
+                future.result()
+    finally:
+        for hdul in opened:
+            hdul.close()
+
+    logger.info(f"Matched {len(inputs)} filters to the {target_filter} PSF.")
+    return matched
@@ -1,67 +1,196 @@
+import shutil
+
 import astropy.units as u
 import numpy as np
+from astropy.constants import c
+from astropy.io import fits
+
+from ..logging.logger_config import setup_logger
+
+logger = setup_logger()
+
+# constants, computed once on import
+C_AA_PER_S = c.to(u.AA / u.s).value     # speed of light in Angstroms per second
+AB_ZEROPOINT_CGS = 48.60                # AB zero point for f_nu in ergs/cm^2/s/Hz
+AB_ZEROPOINT_JY = 8.90                  # AB zero point for f_nu in Jy
+MJY_TO_JY = 1e6
+JY_TO_UJY = 1e6
+_MAG_TO_LN = 0.4 * np.log(10)           # 10**(-0.4 * m) == exp(-_MAG_TO_LN * m)
+
+
+def _output(shape, out, dtype):
+    return np.empty(shape, dtype=dtype) if out is None else out
 
 
-def flux_to_abmag(flux_densities, wavelengths):
-    from astropy.constants import c
+def _result(out):
+    # scalar inputs give numpy scalars, like the plain arithmetic did
+    return out[()] if out.ndim == 0 else out
+
+
+def flux_to_abmag(flux_densities, wavelengths, out=None, dtype=np.float64):
     """
     Convert flux densities from ergs/cm^2/s/A to AB magnitudes.
-    
+
     Parameters:
-    - flux_densities: list of flux densities in ergs/cm^2/s/A.
-    - wavelengths: list of wavelengths in Angstroms corresponding to the flux densities.
-    
+    - flux_densities: array of flux densities in ergs/cm^2/s/A.
+    - wavelengths: array of wavelengths in Angstroms corresponding to the flux densities.
+    - out: optional output array (can be `flux_densities` itself).
+    - dtype: working and output dtype.
+
     Returns:
-    - List of AB magnitudes.
+    - Array of AB magnitudes.
     """
-    # Speed of light in Angstroms per second
-    c = c.to(u.AA / u.s).value
-    
-    # Convert flux densities to ergs/cm^2/s/Hz
-    flux_densities_hz = [(f_lambda * ((lambda_value**2) / c)) for f_lambda, lambda_value in zip(flux_densities, wavelengths)]
-    
-    # Calculate AB magnitudes
-    ab_magnitudes = [-2.5 * np.log10(f_nu) - 48.60 for f_nu in flux_densities_hz]
-    
-    return np.array(ab_magnitudes)
-
-
-def abmag_to_jansky(m_ab, m_ab_err=None):
+    f_lambda = np.asarray(flux_densities)
+    wavelengths = np.asarray(wavelengths)
+    out = _output(np.broadcast_shapes(f_lambda.shape, wavelengths.shape), out, dtype)
+
+    # f_nu = f_lambda * lambda**2 / c in ergs/cm^2/s/Hz
+    np.multiply(f_lambda, wavelengths, out=out, dtype=dtype)
+    np.multiply(out, wavelengths, out=out, dtype=dtype)
+    np.divide(out, C_AA_PER_S, out=out, dtype=dtype)
+
+    # AB magnitudes
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.log10(out, out=out, dtype=dtype)
+    np.multiply(out, -2.5, out=out, dtype=dtype)
+    np.subtract(out, AB_ZEROPOINT_CGS, out=out, dtype=dtype)
+    return _result(out)
+
+
+def abmag_to_jansky(m_ab, m_ab_err=None, out=None, dtype=np.float64):
     """
     Convert AB magnitudes to Janskys.
-    
+
     Parameters:
-    - m_ab: list of AB magnitudes.
-    - m_ab_err: list of errors in AB magnitudes.
-    
+    - m_ab: array of AB magnitudes.
+    - m_ab_err: array of errors in AB magnitudes.
+    - out: optional output array for the Janskys.
+    - dtype: working and output dtype.
+
     Returns:
-    - List of Janskys.
+    - Array of Janskys (and of their errors if `m_ab_err` is given).
     """
+    m_ab = np.asarray(m_ab)
+    out = _output(m_ab.shape, out, dtype)
+
     # Convert AB magnitudes to Janskys
-    janskys = 10 ** (-(m_ab - 8.90) / 2.5)
+    np.subtract(m_ab, AB_ZEROPOINT_JY, out=out, dtype=dtype)
+    np.multiply(out, -_MAG_TO_LN, out=out, dtype=dtype)
+    np.exp(out, out=out, dtype=dtype)
 
-    if m_ab_err:
-        # Calculate errors in Janskys
-        janskys_err = janskys * (10 ** (m_ab_err / 2.5) - 1)
-        return janskys, janskys_err
+    if m_ab_err is not None:
+        # Calculate errors in Janskys: janskys * (10 ** (m_ab_err / 2.5) - 1)
+        m_ab_err = np.asarray(m_ab_err, dtype=dtype)
+        janskys_err = np.empty(np.broadcast_shapes(m_ab.shape, m_ab_err.shape), dtype=dtype)
+        np.multiply(m_ab_err, _MAG_TO_LN, out=janskys_err, dtype=dtype)
+        np.expm1(janskys_err, out=janskys_err)
+        np.multiply(janskys_err, out, out=janskys_err)
+        return _result(out), _result(janskys_err)
 
-    return janskys
+    return _result(out)
 
-def mjy_sr_to_ab_mag(flux_mjy_sr, pixar_sr):
+
+def mjy_sr_to_ab_mag(flux_mjy_sr, pixar_sr, out=None, dtype=np.float64):
     """
     Convert flux density from MJy/sr to AB Magnitude.
 
     Parameters:
-    flux_mjy_sr (float): Flux density in MJy/sr
+    flux_mjy_sr (array): Flux density in MJy/sr
     pixar_sr (float): Pixel area in steradians
+    out (array, optional): Output array (can be `flux_mjy_sr` itself)
+    dtype (np.dtype): Working and output dtype
 
     Returns:
-    float: AB Magnitude
+    array: AB Magnitude (NaN for non-positive fluxes)
     """
+    flux_mjy_sr = np.asarray(flux_mjy_sr)
+    out = _output(flux_mjy_sr.shape, out, dtype)
+
     # Convert MJy/sr to Jy for the given pixel area
-    flux_jy_pixel = flux_mjy_sr * pixar_sr * 1e6
+    np.multiply(flux_mjy_sr, pixar_sr * MJY_TO_JY, out=out, dtype=dtype)
 
     # Calculate AB magnitude
-    ab_mag = -2.5 * np.log10(flux_jy_pixel) + 8.9
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.log10(out, out=out, dtype=dtype)
+    np.multiply(out, -2.5, out=out, dtype=dtype)
+    np.add(out, AB_ZEROPOINT_JY, out=out, dtype=dtype)
+    out[np.isinf(out)] = np.nan
+    return _result(out)
+
+
+def mjy_sr_to_ujy(flux_mjy_sr, pixar_sr, out=None, dtype=np.float64):
+    """
+    Convert flux density from MJy/sr to micro-Janskys per pixel.
+
+    Parameters:
+    flux_mjy_sr (array): Flux density in MJy/sr
+    pixar_sr (float): Pixel area in steradians
+    out (array, optional): Output array (can be `flux_mjy_sr` itself)
+    dtype (np.dtype): Working and output dtype
+
+    Returns:
+    array: Flux density in uJy
+    """
+    flux_mjy_sr = np.asarray(flux_mjy_sr)
+    out = _output(flux_mjy_sr.shape, out, dtype)
+    return _result(np.multiply(flux_mjy_sr, pixar_sr * MJY_TO_JY * JY_TO_UJY, out=out, dtype=dtype))
+
+
+MOSAIC_UNITS = {
+    'abmag': (mjy_sr_to_ab_mag, 'mag(AB)'),
+    'ujy': (mjy_sr_to_ujy, 'uJy'),
+}
+
+
+def convert_mosaic(path, unit='ujy', ext=0, pixar_sr=None, output_path=None, chunk_rows=1024, dtype=np.float64):
+    """
+    Convert a whole MJy/sr mosaic to AB magnitudes or uJy in place, chunk by chunk.
+
+    The image is memory-mapped and every chunk of rows is converted into
+    itself, so no second full-size array is ever allocated.
+
+    Parameters:
+    path (str): Path to the FITS mosaic in MJy/sr
+    unit (str): 'abmag' or 'ujy'
+    ext (int or str): The FITS extension of the image
+    pixar_sr (float, optional): Pixel area in steradians. Default is the PIXAR_SR keyword
+        of the image header (or of the primary header)
+    output_path (str, optional): Write the converted mosaic to this file instead of
+        converting `path` itself
+    chunk_rows (int): Number of rows converted at a time
+    dtype (np.dtype): Working dtype of each chunk; the file keeps its own dtype
+
+    Returns:
+    str: Path of the converted mosaic
+    """
+    if unit not in MOSAIC_UNITS:
+        raise ValueError(f"Unknown unit '{unit}'. Use one of {list(MOSAIC_UNITS)}.")
+    convert, bunit = MOSAIC_UNITS[unit]
+
+    if output_path is not None:
+        shutil.copyfile(path, output_path)
+        path = output_path
+
+    with fits.open(path, mode='update', memmap=True) as hdul:
+        hdu = hdul[ext]
+        if pixar_sr is None:
+            pixar_sr = hdu.header.get('PIXAR_SR', hdul[0].header.get('PIXAR_SR'))
+        if pixar_sr is None:
+            logger.error(f"No PIXAR_SR keyword in {path}[{ext}]; pass pixar_sr explicitly.")
+            raise KeyError(f"No PIXAR_SR keyword in {path}[{ext}].")
+
+        data = hdu.data
+        if data.dtype.kind != 'f' or 'BSCALE' in hdu.header or 'BZERO' in hdu.header:
+            logger.error(f"{path}[{ext}] is not a plain floating-point image and cannot be converted in place.")
+            raise TypeError(f"{path}[{ext}] is not a plain floating-point image.")
+
+        logger.verbose(f"Converting {path}[{ext}] from MJy/sr to {bunit} in chunks of {chunk_rows} rows")
+        for start in range(0, data.shape[0], chunk_rows):
+            chunk = data[start:start + chunk_rows]
+            convert(chunk, pixar_sr, out=chunk, dtype=dtype)
+
+        hdu.header['BUNIT'] = bunit
+        hdu.header['HISTORY'] = f"Converted from MJy/sr to {bunit} with PIXAR_SR={pixar_sr}"
 
-    return ab_mag
\ No newline at end of file
+    logger.info(f"Converted {path} to {bunit}")
+    return path
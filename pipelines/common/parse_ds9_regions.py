@@ -1,8 +1,16 @@
+import os
 import re
+from typing import NamedTuple
 
+import numpy as np
 from astropy.coordinates import SkyCoord
 from astropy import units as u
-from photutils.aperture import SkyRectangularAperture
+from photutils.aperture import (CircularAperture, EllipticalAperture, RectangularAperture, SkyCircularAperture,
+                                SkyEllipticalAperture, SkyRectangularAperture)
+
+from ..logging.logger_config import setup_logger
+
+logger = setup_logger()
 
 def parse_ds9_reg_file(filename):
     # Regular expression to match region lines (simplified for circle, box, and ellipse)
@@ -43,3 +51,282 @@ def get_apertures(reg_file, frame='fk5') -> list[SkyRectangularAperture]:
 
     return apertures
 
+
+
+# DS9 coordinate systems and the matching astropy frames
+SKY_FRAMES = {
+    'fk5': 'fk5',
+    'j2000': 'fk5',
+    'fk4': 'fk4',
+    'b1950': 'fk4',
+    'icrs': 'icrs',
+    'galactic': 'galactic',
+    'ecliptic': 'barycentrictrueecliptic',
+}
+PIXEL_FRAMES = ('image', 'physical')
+
+# number of parameters after the centre of each shape
+SHAPE_PARAMS = {'circle': 1, 'box': 3, 'ellipse': 3}
+
+_SIZE_UNITS = {'"': 1.0, "'": 60.0, 'd': 3600.0, 'r': 180 / np.pi * 3600}
+_SEXAGESIMAL = re.compile(r"^([+-]?)(\d+)[:hd](\d+)[:m'](\d+(?:\.\d*)?)[s\"]?$")
+
+
+class RegionTable(NamedTuple):
+    """
+    Parsed regions of one shape in one coordinate system.
+
+    `lon` and `lat` are in degrees (sky frames) or 0-based pixels (image),
+    `params` holds the shape parameters (sizes in arcsec or pixels, angles in
+    DS9 degrees) with one row per region, and `index` the line order of the
+    regions in the file. For polygons, `lon` and `lat` hold all the vertices
+    and `params` the number of vertices of each polygon. `exclude` marks
+    DS9 exclude regions (written with a leading '-').
+    """
+    shape: str
+    frame: str
+    lon: np.ndarray
+    lat: np.ndarray
+    params: np.ndarray
+    index: np.ndarray
+    exclude: bool = False
+
+
+class RegionApertures(NamedTuple):
+    """
+    Apertures built from a region file.
+
+    `apertures` has one multi-position aperture per shape, frame and set of
+    shape parameters, `indices` the region numbers (in file order) of the
+    positions of each aperture, and `polygons` the vertices of the polygon
+    regions, which have no photutils aperture.
+    """
+    apertures: list
+    indices: list
+    polygons: list
+
+
+def _coordinate(value, hours=False):
+    value = value.strip()
+    match = _SEXAGESIMAL.match(value)
+    if match is None:
+        return float(value.rstrip('d'))
+    sign, first, minutes, seconds = match.groups()
+    degrees = float(first) + float(minutes) / 60 + float(seconds) / 3600
+    degrees = -degrees if sign == '-' else degrees
+    return degrees * 15 if hours else degrees
+
+
+def _size(value, pixel):
+    value = value.strip()
+    if pixel:
+        return float(value.rstrip('ip'))
+    if value[-1] in _SIZE_UNITS:
+        return float(value[:-1]) * _SIZE_UNITS[value[-1]]
+    if value[-1] in 'ip':
+        raise ValueError(f"Pixel size '{value}' in a sky region is not supported.")
+    # DS9's default unit for sizes in sky coordinates is degrees
+    return float(value) * 3600.0
+
+
+def _parse_region(name, args, frame):
+    pixel = frame in PIXEL_FRAMES
+    hours = frame in ('fk5', 'fk4', 'icrs') and any(':' in a or 'h' in a for a in args[:1])
+
+    if name == 'polygon':
+        lon = [_coordinate(a, hours) for a in args[0::2]]
+        lat = [_coordinate(a) for a in args[1::2]]
+        return lon, lat, [len(lon)]
+
+    n_params = SHAPE_PARAMS[name]
+    lon, lat = _coordinate(args[0], hours), _coordinate(args[1])
+    sizes = args[2:2 + n_params]
+    params = [_size(s, pixel) for s in sizes[:2]] + [float(a.rstrip('d')) for a in sizes[2:]]
+    if name in ('box', 'ellipse') and len(params) == 2:
+        params.append(0.0)
+    return lon, lat, params
+
+
+def _stream_regions(filename):
+    tables = {}
+    frame = 'fk5'
+    number = 0
+    with open(filename, 'r') as file:
+        for line in file:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+
+            for command in line.split(';'):
+                command = command.strip()
+                lowered = command.lower()
+                if lowered in SKY_FRAMES or lowered in PIXEL_FRAMES:
+                    frame = SKY_FRAMES.get(lowered, 'image')
+                    continue
+
+                start, stop = command.find('('), command.rfind(')')
+                if start < 0 or stop < 0:
+                    continue
+                prefix = command[:start].strip()
+                exclude = prefix.startswith('-')
+                name = prefix.lstrip('+-').lower()
+                if name not in SHAPE_PARAMS and name != 'polygon':
+                    continue
+
+                lon, lat, params = _parse_region(name, command[start + 1:stop].split(','), frame)
+                if frame == 'image':
+                    # DS9 image coordinates are 1-based
+                    lon = np.asarray(lon) - 1
+                    lat = np.asarray(lat) - 1
+
+                table = tables.setdefault((name, frame, exclude), ([], [], [], []))
+                if name == 'polygon':
+                    table[0].extend(np.atleast_1d(lon))
+                    table[1].extend(np.atleast_1d(lat))
+                else:
+                    table[0].append(float(lon))
+                    table[1].append(float(lat))
+                table[2].append(params)
+                table[3].append(number)
+                number += 1
+
+    return [RegionTable(name, frame, np.asarray(lon, dtype=float), np.asarray(lat, dtype=float),
+                        np.asarray(params, dtype=float), np.asarray(index, dtype=int), exclude)
+            for (name, frame, exclude), (lon, lat, params, index) in tables.items()]
+
+
+def _cache_path(filename):
+    return f"{filename}.npz"
+
+
+def _load_parsed(filename):
+    path = _cache_path(filename)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(filename):
+        return None
+    try:
+        with np.load(path) as stored:
+            return [RegionTable(str(stored[f'{num}_shape']), str(stored[f'{num}_frame']),
+                                *(stored[f'{num}_{field}'] for field in ('lon', 'lat', 'params', 'index')),
+                                bool(stored[f'{num}_exclude']))
+                    for num in range(int(stored['n_tables']))]
+    except Exception as e:
+        logger.error(f"Failed to load the parsed regions of {filename}: {e}")
+        return None
+
+
+def _save_parsed(filename, tables):
+    arrays = {'n_tables': len(tables)}
+    for num, table in enumerate(tables):
+        for field, value in table._asdict().items():
+            arrays[f'{num}_{field}'] = value
+    tmp_path = f"{_cache_path(filename)}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, _cache_path(filename))
+
+
+def read_ds9_regions(filename, cache=False):
+    """
+    Parse a DS9 region file into one table of regions per shape and coordinate system.
+
+    The file is streamed line by line and understands circle, box, ellipse and
+    polygon regions, coordinate-system lines (e.g. 'fk5', 'icrs', 'galactic',
+    'image', also as 'fk5;box(...)' prefixes), sexagesimal or decimal
+    coordinates, and size units ('"', "'", 'd', 'r'; degrees by default).
+    Exclude regions ('-circle(...)') are kept in separate tables with
+    `exclude` set.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the region file.
+    cache : bool
+        Save the parsed tables next to the region file (as '<filename>.npz')
+        and reuse them while the region file is unchanged. Default is False.
+
+    Returns
+    -------
+    tables : list of RegionTable
+        The parsed regions.
+    """
+    if cache:
+        tables = _load_parsed(filename)
+        if tables is not None:
+            logger.verbose(f"Loaded the parsed regions of {filename} from the cache.")
+            return tables
+
+    tables = _stream_regions(filename)
+    logger.verbose(f"Parsed {sum(len(t.index) for t in tables)} regions from {filename}")
+    if cache:
+        _save_parsed(filename, tables)
+    return tables
+
+
+def _make_aperture(shape, frame, positions, params):
+    if frame == 'image':
+        if shape == 'circle':
+            return CircularAperture(positions, r=params[0])
+        if shape == 'box':
+            return RectangularAperture(positions, w=params[0], h=params[1], theta=params[2] * u.deg)
+        return EllipticalAperture(positions, a=params[0], b=params[1], theta=params[2] * u.deg)
+
+    # sky angles are measured from North, DS9 angles from the x axis (see get_apertures)
+    if shape == 'circle':
+        return SkyCircularAperture(positions, r=params[0] * u.arcsec)
+    if shape == 'box':
+        return SkyRectangularAperture(positions, w=params[0] * u.arcsec, h=params[1] * u.arcsec,
+                                      theta=(params[2] - 90) * u.deg)
+    return SkyEllipticalAperture(positions, a=params[0] * u.arcsec, b=params[1] * u.arcsec,
+                                 theta=(params[2] - 90) * u.deg)
+
+
+def get_region_apertures(reg_file, cache=False):
+    """
+    Build multi-position apertures from a (large) DS9 region file.
+
+    Regions sharing a shape, coordinate system and shape parameters become a
+    single aperture with an array-valued SkyCoord (or pixel positions), so a
+    catalogue of 10^5 same-size boxes is a single aperture object. Exclude
+    regions are skipped.
+
+    Parameters
+    ----------
+    reg_file : str
+        Path to the region file.
+    cache : bool
+        Cache the parsed regions next to the file; see `read_ds9_regions`.
+
+    Returns
+    -------
+    result : RegionApertures
+        The apertures, the region numbers of their positions and the polygon vertices.
+    """
+    apertures, indices, polygons = [], [], []
+    for table in read_ds9_regions(reg_file, cache=cache):
+        if table.exclude:
+            logger.verbose(f"Skipping {len(table.index)} excluded {table.shape} regions in {reg_file}")
+            continue
+        if table.shape == 'polygon':
+            offsets = np.concatenate([[0], np.cumsum(table.params[:, 0].astype(int))])
+            for start, stop in zip(offsets[:-1], offsets[1:]):
+                lon, lat = table.lon[start:stop], table.lat[start:stop]
+                polygons.append(np.column_stack([lon, lat]) if table.frame == 'image'
+                                else SkyCoord(lon * u.deg, lat * u.deg, frame=table.frame))
+            continue
+
+        if table.frame == 'image':
+            positions = np.column_stack([table.lon, table.lat])
+        else:
+            positions = SkyCoord(table.lon * u.deg, table.lat * u.deg, frame=table.frame)
+
+        # one aperture per distinct set of shape parameters
+        groups, inverse = np.unique(table.params, axis=0, return_inverse=True)
+        order = np.argsort(inverse.ravel(), kind='stable')
+        bounds = np.searchsorted(inverse.ravel()[order], np.arange(len(groups) + 1))
+        for num, params in enumerate(groups):
+            members = order[bounds[num]:bounds[num + 1]]
+            apertures.append(_make_aperture(table.shape, table.frame, positions[members], params))
+            indices.append(table.index[members])
+
+    logger.verbose(f"Built {len(apertures)} apertures from {reg_file}")
+    return RegionApertures(apertures, indices, polygons)
@@ -0,0 +1,203 @@
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import SkyCoord, concatenate
+from astropy.wcs.utils import proj_plane_pixel_scales
+from photutils.aperture import SkyAperture
+
+from ..logging.logger_config import setup_logger
+from .img_utils import iter_tiles
+from .mask_cache import aperture_params
+
+logger = setup_logger()
+
+
+def _extent(aperture):
+    # radius of the circle circumscribing the aperture, in its own units
+    params = aperture_params(aperture)
+    for outer in ('r_out', 'r', 'a_out', 'a'):
+        if outer in params:
+            return getattr(aperture, outer)
+    w, h = ('w_out', 'h_out') if 'w_out' in params else ('w', 'h')
+    return np.hypot(getattr(aperture, w), getattr(aperture, h)) / 2
+
+
+def project_apertures(apertures, wcs, margin=1.0):
+    """
+    Project the positions of many apertures to pixels in a single WCS call.
+
+    Parameters
+    ----------
+    apertures : list
+        Sky or pixel apertures, each with one or several positions.
+    wcs : astropy.wcs.WCS
+        WCS of the image.
+    margin : float
+        Extra pixels added to every radius. Default is 1.
+
+    Returns
+    -------
+    x, y : np.ndarray
+        Pixel positions, one per aperture position, in the order of the apertures.
+    radius : np.ndarray
+        Conservative pixel radius (circumscribed circle plus `margin`) of each position.
+    aperture_id, position_id : np.ndarray
+        The aperture of each position and its index within that aperture.
+    """
+    pixel_scale = np.mean(proj_plane_pixel_scales(wcs.celestial)) * u.deg
+
+    counts, radii, sky, pixel = [], [], [], []
+    for num, aperture in enumerate(apertures):
+        n = 1 if aperture.isscalar else len(aperture)
+        counts.append(n)
+        extent = _extent(aperture)
+        if isinstance(aperture, SkyAperture):
+            extent = (extent / pixel_scale).decompose().value
+            sky.append((num, aperture.positions.icrs))
+        else:
+            pixel.append((num, np.atleast_2d(aperture.positions)))
+        radii.append(np.broadcast_to(extent, n))
+
+    counts = np.asarray(counts, dtype=int)
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    x, y = np.empty(starts[-1]), np.empty(starts[-1])
+
+    if sky:
+        # all the sky positions go through the WCS at once
+        coords = concatenate([SkyCoord(c.ra, c.dec, frame='icrs').reshape(-1) for _, c in sky])
+        sky_x, sky_y = wcs.world_to_pixel(coords)
+        rows = np.concatenate([np.arange(starts[num], starts[num + 1]) for num, _ in sky])
+        x[rows], y[rows] = sky_x, sky_y
+    for num, positions in pixel:
+        x[starts[num]:starts[num + 1]], y[starts[num]:starts[num + 1]] = positions[:, 0], positions[:, 1]
+
+    radius = np.concatenate(radii) + margin if radii else np.empty(0)
+    aperture_id = np.repeat(np.arange(len(counts)), counts)
+    position_id = np.arange(starts[-1]) - starts[aperture_id]
+    return x, y, radius, aperture_id, position_id
+
+
+class ApertureIndex:
+    """
+    Grid-bucket spatial index of aperture bounding boxes on an image.
+
+    All aperture positions are projected with `project_apertures`, and each
+    pixel bounding box is registered in every `cell_size` x `cell_size` cell it
+    overlaps. Queries for a tile then only look at the apertures of the cells
+    the tile covers, so a mosaic can be processed tile by tile without testing
+    every aperture against every tile.
+
+    The bounding boxes are conservative (they contain the circle circumscribing
+    each aperture), so a query can return apertures whose exact masks just miss
+    the tile, but never misses one that overlaps it.
+
+    Parameters
+    ----------
+    apertures : list
+        Sky or pixel apertures, each with one or several positions.
+    wcs : astropy.wcs.WCS
+        WCS of the image.
+    shape : tuple
+        Shape (ny, nx) of the image.
+    cell_size : int
+        Size of the index cells in pixels. Default is 256.
+    margin : float
+        Extra pixels added to every bounding box. Default is 1.
+    """
+
+    def __init__(self, apertures, wcs, shape, cell_size=256, margin=1.0):
+        self.apertures = list(apertures)
+        self.shape = tuple(shape)
+        self.cell_size = cell_size
+
+        self.x, self.y, self.radius, self.aperture_id, self.position_id = \
+            project_apertures(self.apertures, wcs, margin=margin)
+
+        # same rounding as photutils.aperture.BoundingBox.from_float
+        with np.errstate(invalid='ignore'):
+            self.ixmin = np.floor(self.x - self.radius + 0.5).astype(int)
+            self.ixmax = np.ceil(self.x + self.radius + 0.5).astype(int)
+            self.iymin = np.floor(self.y - self.radius + 0.5).astype(int)
+            self.iymax = np.ceil(self.y + self.radius + 0.5).astype(int)
+
+        ny, nx = self.shape
+        self.in_image = (np.isfinite(self.x) & np.isfinite(self.y)
+                         & (self.ixmax > 0) & (self.ixmin < nx) & (self.iymax > 0) & (self.iymin < ny))
+        self._build_cells()
+
+        logger.verbose(f"Indexed {len(self)} aperture positions ({self.in_image.sum()} on the image) "
+                       f"in {self._n_cells[0]} x {self._n_cells[1]} cells")
+
+    def __len__(self):
+        return len(self.x)
+
+    def _cell_range(self, imin, imax, n_cells):
+        return (np.clip(imin // self.cell_size, 0, n_cells - 1),
+                np.clip((imax - 1) // self.cell_size, 0, n_cells - 1))
+
+    def _build_cells(self):
+        ny, nx = self.shape
+        self._n_cells = (-(-ny // self.cell_size), -(-nx // self.cell_size))
+        ids = np.flatnonzero(self.in_image)
+
+        cy0, cy1 = self._cell_range(self.iymin[ids], self.iymax[ids], self._n_cells[0])
+        cx0, cx1 = self._cell_range(self.ixmin[ids], self.ixmax[ids], self._n_cells[1])
+        ncx = cx1 - cx0 + 1
+        counts = (cy1 - cy0 + 1) * ncx
+
+        # one (cell, aperture) pair per cell that a bounding box overlaps
+        owner = np.repeat(np.arange(len(ids)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = (cy0[owner] + k // ncx[owner]) * self._n_cells[1] + cx0[owner] + k % ncx[owner]
+
+        order = np.argsort(cells, kind='stable')
+        self._cell_ids = ids[owner[order]]
+        self._cell_ptr = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=np.prod(self._n_cells)))])
+
+    def query(self, slices):
+        """
+        The aperture positions whose bounding boxes overlap a region of the image.
+
+        Parameters
+        ----------
+        slices : tuple of slice
+            The (y, x) slices of the region, e.g. a tile from `iter_tiles`.
+
+        Returns
+        -------
+        ids : np.ndarray
+            Sorted indices of the overlapping positions (into `x`, `y`, `aperture_id`, ...).
+        """
+        ys, xs = slices
+        y0, y1 = ys.start or 0, self.shape[0] if ys.stop is None else ys.stop
+        x0, x1 = xs.start or 0, self.shape[1] if xs.stop is None else xs.stop
+
+        cy0, cy1 = (int(c) for c in self._cell_range(np.array(y0), np.array(y1), self._n_cells[0]))
+        cx0, cx1 = (int(c) for c in self._cell_range(np.array(x0), np.array(x1), self._n_cells[1]))
+        candidates = [self._cell_ids[self._cell_ptr[row * self._n_cells[1] + cx0]:
+                                     self._cell_ptr[row * self._n_cells[1] + cx1 + 1]]
+                      for row in range(cy0, cy1 + 1)]
+        ids = np.unique(np.concatenate(candidates)) if candidates else np.empty(0, dtype=int)
+
+        overlap = (self.ixmax[ids] > x0) & (self.ixmin[ids] < x1) & (self.iymax[ids] > y0) & (self.iymin[ids] < y1)
+        return ids[overlap]
+
+    def tiles(self, tile_size):
+        """
+        Iterate over the tiles of the image with the apertures overlapping each.
+
+        Yields
+        ------
+        inner : tuple of slice
+            The tile, as from `iter_tiles`.
+        ids : np.ndarray
+            The overlapping aperture positions.
+        """
+        for inner, _, _ in iter_tiles(self.shape, tile_size):
+            yield inner, self.query(inner)
+
+    def aperture(self, num):
+        """
+        The single-position aperture of an indexed position.
+        """
+        aperture = self.apertures[self.aperture_id[num]]
+        return aperture if aperture.isscalar else aperture[int(self.position_id[num])]
@@ -0,0 +1,268 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage as nd
+
+from ..logging.logger_config import setup_logger
+from .img_utils import iter_tiles
+
+logger = setup_logger()
+
+# scale factor that turns the median absolute deviation into a Gaussian sigma
+MAD_TO_STD = 1.482602218505602
+
+
+def finite_values(data, dtype=np.float32):
+    """
+    Return the finite values of `data` as a 1D array of the given dtype.
+    """
+    values = np.asarray(data, dtype=dtype).ravel()
+    return values[np.isfinite(values)]
+
+
+def fast_median(values):
+    """
+    Median of a 1D array of finite values using `np.partition` instead of a full sort.
+    """
+    n = values.size
+    if n == 0:
+        return np.nan
+    k = n // 2
+    if n % 2:
+        return float(np.partition(values, k)[k])
+    part = np.partition(values, (k - 1, k))
+    return 0.5 * (float(part[k - 1]) + float(part[k]))
+
+
+def mad_std(values, median=None):
+    """
+    Gaussian sigma estimated from the median absolute deviation of a 1D array of finite values.
+    """
+    if median is None:
+        median = fast_median(values)
+    return MAD_TO_STD * fast_median(np.abs(values - median))
+
+
+def clip_bounds(values, sigma_lower=3, sigma_upper=3, maxiters=5, stdfunc='std'):
+    """
+    Find the sigma-clipping bounds of a 1D array of finite values.
+
+    The clipping is iterated on the surviving values until nothing else is clipped
+    or `maxiters` is reached, like `astropy.stats.sigma_clip` with a median centre.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        1D array of finite values (e.g. from `finite_values`).
+    sigma_lower : float
+        The number of standard deviations for the lower clipping limit.
+    sigma_upper : float
+        The number of standard deviations for the upper clipping limit.
+    maxiters : int
+        The maximum number of clipping iterations.
+    stdfunc : str
+        'std' for the standard deviation or 'mad_std' for the MAD-based sigma.
+
+    Returns
+    -------
+    lower, upper : float
+        The clipping bounds; values outside [lower, upper] are clipped.
+    center, spread : float
+        The median and std (or MAD sigma) of the surviving values.
+    """
+    if stdfunc not in ('std', 'mad_std'):
+        raise ValueError(f"Unknown stdfunc '{stdfunc}'. Use 'std' or 'mad_std'.")
+
+    lower, upper = -np.inf, np.inf
+    center = spread = np.nan
+    for _ in range(maxiters):
+        if values.size == 0:
+            break
+
+        center = fast_median(values)
+        spread = float(values.std()) if stdfunc == 'std' else mad_std(values, center)
+
+        # pixels clipped in an earlier iteration stay clipped, so the bounds only shrink
+        lower = max(lower, center - sigma_lower * spread)
+        upper = min(upper, center + sigma_upper * spread)
+
+        keep = (values >= lower) & (values <= upper)
+        if keep.all():
+            break
+        values = values[keep]
+
+    return lower, upper, center, spread
+
+
+def _clip_to(data, lower, upper, out):
+    np.copyto(out, data, casting='unsafe')
+    with np.errstate(invalid='ignore'):
+        out[(out < lower) | (out > upper)] = np.nan
+    return out
+
+
+def sigma_clip_array(data, sigma_lower=3, sigma_upper=3, maxiters=5, stdfunc='std', dtype=np.float32, out=None):
+    """
+    Sigma clip an image against its global statistics, replacing clipped and
+    non-finite pixels with NaN.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The 2D image.
+    sigma_lower, sigma_upper : float
+        The number of standard deviations for the lower and upper clipping limits.
+    maxiters : int
+        The maximum number of clipping iterations.
+    stdfunc : str
+        'std' or 'mad_std'. See `clip_bounds`.
+    dtype : np.dtype
+        Working and output dtype. Default is float32.
+    out : np.ndarray, optional
+        Preallocated output array (can be `data` itself to clip in place).
+
+    Returns
+    -------
+    clipped : np.ndarray
+        The clipped image with NaN sentinels.
+    bounds : tuple
+        The (lower, upper) clipping bounds.
+    """
+    lower, upper, _, _ = clip_bounds(finite_values(data, dtype), sigma_lower, sigma_upper, maxiters, stdfunc)
+    if out is None:
+        out = np.empty(data.shape, dtype=dtype)
+    return _clip_to(data, lower, upper, out), (lower, upper)
+
+
+def _clip_tile(data, inner, sigma_lower, sigma_upper, maxiters, stdfunc, dtype, out):
+    tile = np.asarray(data[inner], dtype=dtype)
+    lower, upper, _, _ = clip_bounds(finite_values(tile, dtype), sigma_lower, sigma_upper, maxiters, stdfunc)
+    _clip_to(tile, lower, upper, out[inner])
+
+
+def sigma_clip_tiled(data, tile_size=1024, sigma_lower=3, sigma_upper=3, maxiters=5, stdfunc='std',
+                     dtype=np.float32, workers=None, out=None):
+    """
+    Sigma clip each tile of an image against its own statistics, in parallel.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The 2D image. Can be a memory-mapped array.
+    tile_size : int
+        Size of each tile in pixels. Default is 1024.
+    sigma_lower, sigma_upper, maxiters, stdfunc :
+        See `sigma_clip_array`.
+    dtype : np.dtype
+        Working and output dtype. Default is float32.
+    workers : int, optional
+        Number of threads. Default is the number of CPUs.
+    out : np.ndarray, optional
+        Preallocated output array.
+
+    Returns
+    -------
+    clipped : np.ndarray
+        The clipped image with NaN sentinels.
+    """
+    if out is None:
+        out = np.empty(data.shape, dtype=dtype)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_clip_tile, data, inner, sigma_lower, sigma_upper, maxiters, stdfunc, dtype, out)
+                   for inner, _, _ in iter_tiles(data.shape, tile_size)]
+        for future in futures:
+            future.result()
+
+    return out
+
+
+def background_map(data, box_size=256, sigma=3, maxiters=5, stdfunc='std', dtype=np.float32):
+    """
+    Estimate a smooth background and RMS map from sigma-clipped box statistics.
+
+    The clipped median and std of each `box_size` box are interpolated back to the
+    full resolution with linear interpolation.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The 2D image.
+    box_size : int
+        Size of the boxes in pixels. Default is 256.
+    sigma : float
+        Clipping threshold for the box statistics.
+    maxiters : int
+        The maximum number of clipping iterations.
+    stdfunc : str
+        'std' or 'mad_std'. See `clip_bounds`.
+    dtype : np.dtype
+        Output dtype. Default is float32.
+
+    Returns
+    -------
+    background, rms : np.ndarray
+        The background and RMS maps with the same shape as `data`.
+    """
+    ny, nx = data.shape
+    nby, nbx = -(-ny // box_size), -(-nx // box_size)
+    low_bkg = np.full((nby, nbx), np.nan)
+    low_rms = np.full((nby, nbx), np.nan)
+
+    for inner, _, _ in iter_tiles(data.shape, box_size):
+        j, i = inner[0].start // box_size, inner[1].start // box_size
+        _, _, low_bkg[j, i], low_rms[j, i] = clip_bounds(finite_values(data[inner], dtype), sigma, sigma,
+                                                         maxiters, stdfunc)
+
+    # fill empty boxes (e.g. mosaic edges) with the median of the others
+    for low in (low_bkg, low_rms):
+        low[~np.isfinite(low)] = np.nanmedian(low) if np.isfinite(low).any() else 0.0
+
+    background = nd.zoom(low_bkg, box_size, order=1, mode='nearest', grid_mode=True)[:ny, :nx].astype(dtype)
+    rms = nd.zoom(low_rms, box_size, order=1, mode='nearest', grid_mode=True)[:ny, :nx].astype(dtype)
+    return background, rms
+
+
+def sigma_clip_local(data, background=None, rms=None, box_size=256, sigma_lower=3, sigma_upper=3, maxiters=5,
+                     stdfunc='std', dtype=np.float32, out=None):
+    """
+    Sigma clip an image against a local background and RMS map instead of one global value.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The 2D image.
+    background, rms : np.ndarray, optional
+        Background and RMS maps with the same shape as `data`. If not given they
+        are estimated with `background_map`.
+    box_size : int
+        Box size for `background_map`. Default is 256.
+    sigma_lower, sigma_upper : float
+        The number of RMS for the lower and upper clipping limits.
+    maxiters, stdfunc :
+        Passed to `background_map`.
+    dtype : np.dtype
+        Working and output dtype. Default is float32.
+    out : np.ndarray, optional
+        Preallocated output array.
+
+    Returns
+    -------
+    clipped : np.ndarray
+        The clipped image with NaN sentinels.
+    """
+    if background is None or rms is None:
+        est_bkg, est_rms = background_map(data, box_size, sigma=max(sigma_lower, sigma_upper),
+                                          maxiters=maxiters, stdfunc=stdfunc, dtype=dtype)
+        background = est_bkg if background is None else background
+        rms = est_rms if rms is None else rms
+
+    if out is None:
+        out = np.empty(data.shape, dtype=dtype)
+    np.copyto(out, data, casting='unsafe')
+
+    with np.errstate(invalid='ignore'):
+        clipped = out < background - sigma_lower * rms
+        clipped |= out > background + sigma_upper * rms
+    out[clipped] = np.nan
+    return out
@@ -0,0 +1,234 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from ..logging.logger_config import setup_logger
+
+logger = setup_logger()
+
+
+class StreamingStats:
+    """
+    Single-pass, mergeable accumulator of image statistics.
+
+    Chunks of pixels are added with `update`, and accumulators built on
+    different chunks (or in different processes) are combined with `merge`.
+    The mean and variance use the parallel (Chan et al.) form of Welford's
+    update, so they stay accurate for large pixel counts. If `hist_range` is
+    given, a fixed-bin histogram is kept for approximate quantiles.
+
+    Parameters
+    ----------
+    hist_range : tuple, optional
+        (min, max) range of the histogram. Default is None (no histogram).
+    bins : int
+        Number of histogram bins. Default is 4096.
+    clip : tuple, optional
+        (lower, upper) limits; finite values outside them are counted as clipped
+        and left out of the statistics. Either limit can be None.
+    """
+
+    def __init__(self, hist_range=None, bins=4096, clip=None):
+        self.hist_range = tuple(hist_range) if hist_range is not None else None
+        self.bins = bins
+        self.clip = tuple(clip) if clip is not None else (None, None)
+
+        self.count = 0
+        self.n_nan = 0
+        self.n_clipped = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self._mean = 0.0
+        self._m2 = 0.0
+        self.hist = np.zeros(bins, dtype=np.int64) if hist_range is not None else None
+        self.n_below = 0
+        self.n_above = 0
+
+    def update(self, chunk):
+        """
+        Add a chunk of pixels (any shape) to the accumulator.
+        """
+        values = np.asarray(chunk).ravel()
+        finite = np.isfinite(values)
+        self.n_nan += values.size - int(np.count_nonzero(finite))
+        values = values[finite]
+
+        lower, upper = self.clip
+        if lower is not None or upper is not None:
+            keep = np.ones(values.size, dtype=bool)
+            if lower is not None:
+                keep &= values >= lower
+            if upper is not None:
+                keep &= values <= upper
+            self.n_clipped += values.size - int(np.count_nonzero(keep))
+            values = values[keep]
+
+        if values.size == 0:
+            return self
+
+        values = values.astype(np.float64, copy=False)
+        count = values.size
+        mean = values.mean()
+        m2 = float(np.square(values - mean).sum())
+        self._combine(count, mean, m2, values.min(), values.max())
+
+        if self.hist is not None:
+            lo, hi = self.hist_range
+            self.n_below += int(np.count_nonzero(values < lo))
+            self.n_above += int(np.count_nonzero(values > hi))
+            self.hist += np.histogram(values, bins=self.bins, range=self.hist_range)[0]
+
+        return self
+
+    def _combine(self, count, mean, m2, vmin, vmax):
+        total = self.count + count
+        delta = mean - self._mean
+        self._mean += delta * count / total
+        self._m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, float(vmin))
+        self.max = max(self.max, float(vmax))
+
+    def merge(self, other):
+        """
+        Merge another accumulator (with the same histogram setup) into this one.
+        """
+        if (self.hist is None) != (other.hist is None) or self.hist_range != other.hist_range \
+                or self.bins != other.bins:
+            raise ValueError("Can only merge accumulators with the same histogram range and bins.")
+
+        self.n_nan += other.n_nan
+        self.n_clipped += other.n_clipped
+        if other.count:
+            self._combine(other.count, other._mean, other._m2, other.min, other.max)
+        if self.hist is not None:
+            self.hist += other.hist
+            self.n_below += other.n_below
+            self.n_above += other.n_above
+        return self
+
+    @property
+    def mean(self):
+        return self._mean if self.count else np.nan
+
+    @property
+    def var(self):
+        return self._m2 / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def quantile(self, q):
+        """
+        Approximate quantile(s) from the histogram, interpolating linearly within a bin.
+
+        Values outside `hist_range` are placed at its edges.
+        """
+        if self.hist is None:
+            raise ValueError("Quantiles need a histogram; pass hist_range when creating the accumulator.")
+        if not self.count:
+            return np.full(np.shape(q), np.nan)
+
+        lo, hi = self.hist_range
+        edges = np.linspace(lo, hi, self.bins + 1)
+        cumulative = np.concatenate([[self.n_below], self.n_below + np.cumsum(self.hist)])
+        cumulative[-1] += self.n_above
+        return np.interp(np.asarray(q) * self.count, cumulative, edges)
+
+    @property
+    def median(self):
+        return float(self.quantile(0.5))
+
+    def as_dict(self):
+        summary = {
+            'count': self.count,
+            'n_nan': self.n_nan,
+            'n_clipped': self.n_clipped,
+            'mean': self.mean,
+            'std': self.std,
+            'min': self.min if self.count else np.nan,
+            'max': self.max if self.count else np.nan,
+        }
+        if self.hist is not None:
+            summary['median'] = self.median
+        return summary
+
+
+def accumulate(data, chunk_rows=1024, stats=None, **kwargs):
+    """
+    Accumulate the statistics of an array in chunks of rows.
+
+    Parameters
+    ----------
+    data : np.ndarray or astropy.io.fits.Section
+        The image; only `chunk_rows` rows are read at a time, so it can be a
+        memory-mapped array or a FITS section.
+    chunk_rows : int
+        Number of rows per chunk. Default is 1024.
+    stats : StreamingStats, optional
+        Accumulator to update. Default is a new one created with `kwargs`.
+
+    Returns
+    -------
+    stats : StreamingStats
+        The updated accumulator.
+    """
+    if stats is None:
+        stats = StreamingStats(**kwargs)
+    for start in range(0, data.shape[0], chunk_rows):
+        stats.update(data[start:start + chunk_rows])
+    return stats
+
+
+def _summarize_rows(path, ext, rows, chunk_rows, kwargs):
+    with fits.open(path, memmap=True) as hdul:
+        section = hdul[ext].section
+        stats = StreamingStats(**kwargs)
+        for start in range(rows.start, rows.stop, chunk_rows):
+            stats.update(section[start:min(start + chunk_rows, rows.stop)])
+    return stats
+
+
+def summarize_fits(path, ext=0, chunk_rows=1024, workers=1, **kwargs):
+    """
+    Summarise a whole FITS image without loading it into memory.
+
+    The rows are split between `workers` processes, each reading its own
+    memory-mapped section, and the partial accumulators are merged.
+
+    Parameters
+    ----------
+    path : str
+        Path to the FITS file.
+    ext : int or str
+        The FITS extension. Default is 0.
+    chunk_rows : int
+        Number of rows read at a time. Default is 1024.
+    workers : int
+        Number of processes. Default is 1.
+    **kwargs :
+        Passed to `StreamingStats` (hist_range, bins, clip).
+
+    Returns
+    -------
+    stats : StreamingStats
+        The accumulated statistics.
+    """
+    with fits.open(path, memmap=True) as hdul:
+        ny = hdul[ext].shape[0]
+
+    logger.verbose(f"Summarising {path}[{ext}] with {workers} worker(s)")
+
+    if workers == 1:
+        return _summarize_rows(path, ext, range(0, ny), chunk_rows, kwargs)
+
+    step = -(-ny // workers)
+    blocks = [range(start, min(start + step, ny)) for start in range(0, ny, step)]
+    stats = StreamingStats(**kwargs)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for partial in executor.map(_summarize_rows, [path] * len(blocks), [ext] * len(blocks), blocks,
+                                    [chunk_rows] * len(blocks), [kwargs] * len(blocks)):
+            stats.merge(partial)
+    return stats
@@ -1,7 +1,12 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+
 from scipy.ndimage import rotate
 import numpy as np
-import numpy.ma as ma
 from scipy import ndimage as nd
+from scipy import special
+
+from .masking import grow_mask, threshold_mask
 
 
 def imrotate(image, angle, interp_order=1, reshape=False):
@@ -27,47 +32,249 @@ def imrotate(image, angle, interp_order=1, reshape=False):
                   order=interp_order, reshape=reshape, prefilter=False)
 
 
+def imrotate_many(image, angles, interp_order=1):
+    """
+    Rotate an image by several angles at once.
+
+    Equivalent to ``imrotate(image, angle, interp_order, reshape=False)`` for
+    each angle, but the centred pixel grid is built once and all the rotated
+    coordinates are interpolated in a single `map_coordinates` call.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Input 2D data array
+    angles : array_like
+        Angles in degrees
+    interp_order : int, optional
+        Spline interpolation order [0, 5] (default 1: linear)
+
+    Returns
+    -------
+    output : `numpy.ndarray`
+        Rotated data arrays with shape (len(angles), ny, nx)
+    """
+    angles = -np.atleast_1d(np.asarray(angles, dtype=float))
+    center = (np.asarray(image.shape) - 1) / 2
+    grid = np.indices(image.shape, dtype=float).reshape(2, -1) - center[:, None]
+
+    # the same (exact-degree) rotation matrix as scipy.ndimage.rotate, one per angle
+    c, s = special.cosdg(angles), special.sindg(angles)
+    rot = np.array([[c, s], [-s, c]])
+    coords = np.einsum('ijn,jp->inp', rot, grid) + center[:, None, None]
+
+    output = nd.map_coordinates(image, coords, order=interp_order, prefilter=False)
+    return output.reshape((len(angles),) + image.shape)
+
+
+def block_sum(image, factor):
+    """
+    Sum an image (or a stack of images) over `factor` x `factor` blocks, conserving the flux.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Input data array; the binning is applied to the last two axes, whose
+        sizes must be multiples of `factor`
+    factor : int
+        Binning factor
 
-def create_mask(image, mask_above, exclude_adjacent: bool):
+    Returns
+    -------
+    output : `numpy.ndarray`
+        Binned data array
+    """
+    ny, nx = image.shape[-2:]
+    if ny % factor or nx % factor:
+        raise ValueError(f"An image of shape {image.shape[-2:]} cannot be binned by {factor}.")
+    shape = image.shape[:-2] + (ny // factor, factor, nx // factor, factor)
+    return image.reshape(shape).sum(axis=(-3, -1))
+
+
+
+def create_mask(image, mask_above, exclude_adjacent: bool, radius=1, structure=None, dtype=None):
     """
     Creates a mask for all pixels in `image` that are above the `mask_above` value.
     If `exclude_adjacent` is True, it also masks the pixels adjacent to the pixels
-    being masked.
+    being masked. The neighbourhood is set by `radius` and `structure`
+    (see `pipelines.images.masking.grow_mask`); the default is the 8 adjacent pixels.
+    The grown mask is 0/1 in the dtype of `image` unless `dtype` is given (e.g. bool).
     """
     # Mask all pixels above the given level
-    mask = ma.masked_greater(image, mask_above).mask
+    mask = threshold_mask(image, mask_above)
     if not exclude_adjacent:
         # Mask is good as is
         return mask
-    
+
     # Also mask off all pixels that are adjacent to pixels above the given level
-    mask_adj = np.zeros_like(image)
-    height, width = image.shape
-    for x in range(width):
-        for y in range(height):
-            if mask[y, x]:
-                # Mask out the pixel at (x, y) along with all adjacent pixels
-                for xdelta in (-1, 0, 1):
-                    for ydelta in (-1, 0, 1):
-                        i = y + ydelta
-                        j = x + xdelta
-                        if 0 <= i < height and 0 <= j < width:
-                            mask_adj[i, j] = 1
-    return mask_adj
-
-def median_filter(image, window_size: int, mask_above, exclude_adjacent=True):
+    mask = grow_mask(mask, radius=radius, structure=structure)
+    return mask.astype(np.asarray(image).dtype if dtype is None else dtype, copy=False)
+
+def _median_tile(slab, window_size):
+    return nd.median_filter(slab, size=window_size)
+
+
+def iter_tiles(shape, tile_size, halo=0):
+    """
+    Yield the tiles covering an image of the given `shape`.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape (ny, nx) of the image.
+    tile_size : int
+        Size of each (square) tile in pixels.
+    halo : int
+        Number of extra pixels to read around each tile.
+
+    Yields
+    ------
+    inner : tuple of slice
+        Slices of the tile in the image.
+    outer : tuple of slice
+        Slices of the halo-padded tile in the image, clipped to the image.
+    local : tuple of slice
+        Slices of the tile inside the halo-padded tile.
+    """
+    ny, nx = shape
+    for y0 in range(0, ny, tile_size):
+        y1 = min(y0 + tile_size, ny)
+        ys, ye = max(y0 - halo, 0), min(y1 + halo, ny)
+        for x0 in range(0, nx, tile_size):
+            x1 = min(x0 + tile_size, nx)
+            xs, xe = max(x0 - halo, 0), min(x1 + halo, nx)
+            yield ((slice(y0, y1), slice(x0, x1)),
+                   (slice(ys, ye), slice(xs, xe)),
+                   (slice(y0 - ys, y1 - ys), slice(x0 - xs, x1 - xs)))
+
+
+def tiled_median_filter(image, window_size: int, tile_size=1024, workers=None, use_processes=False, out=None):
+    """
+    Median filter `image` in halo-padded tiles, optionally in parallel.
+
+    Each tile is padded by half the window so the result is identical to
+    `scipy.ndimage.median_filter` on the full image, including at tile boundaries.
+    At most two tiles per worker are read ahead, so memory use is bounded by the
+    tile size rather than the image size.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The 2D image to filter. Can be a memory-mapped array.
+    window_size : int
+        Size of the median window in pixels.
+    tile_size : int
+        Size of each tile in pixels. Default is 1024.
+    workers : int, optional
+        Number of workers. Default is the number of CPUs.
+    use_processes : bool
+        Use a process pool instead of a thread pool. Default is False.
+    out : np.ndarray, optional
+        Preallocated output array with the same shape as `image`.
+
+    Returns
+    -------
+    out : np.ndarray
+        The median filtered image.
+    """
+    if out is None:
+        out = np.empty(image.shape, dtype=image.dtype)
+
+    halo = window_size // 2
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool(max_workers=workers) as executor:
+        # only read a few tiles ahead of the workers, so a memory-mapped image
+        # is never loaded into memory all at once
+        futures = {}
+        for inner, outer, local in iter_tiles(image.shape, tile_size, halo):
+            if len(futures) >= 2 * workers:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    done_inner, done_local = futures.pop(future)
+                    out[done_inner] = future.result()[done_local]
+            slab = np.asarray(image[outer])
+            futures[executor.submit(_median_tile, slab, window_size)] = (inner, local)
+
+        for future in as_completed(futures):
+            inner, local = futures.pop(future)
+            out[inner] = future.result()[local]
+
+    return out
+
+
+def binned_median_filter(image, window_size: int, bin_factor=4, out=None):
+    """
+    Approximate median filter for large windows.
+
+    The image is reduced to the median of `bin_factor` x `bin_factor` blocks,
+    median filtered with a window of ``window_size / bin_factor`` binned pixels,
+    and linearly interpolated back to the full resolution.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The 2D image to filter.
+    window_size : int
+        Size of the median window in (unbinned) pixels.
+    bin_factor : int
+        Binning factor. Default is 4.
+    out : np.ndarray, optional
+        Preallocated output array with the same shape as `image`.
+
+    Returns
+    -------
+    out : np.ndarray
+        The approximate median filtered image.
+    """
+    ny, nx = image.shape
+    pad_y, pad_x = -ny % bin_factor, -nx % bin_factor
+    padded = np.pad(image, ((0, pad_y), (0, pad_x)), mode='edge') if pad_y or pad_x else np.asarray(image)
+
+    nby, nbx = padded.shape[0] // bin_factor, padded.shape[1] // bin_factor
+    blocks = padded.reshape(nby, bin_factor, nbx, bin_factor).swapaxes(1, 2).reshape(nby, nbx, -1)
+    binned = np.median(blocks, axis=-1)
+
+    binned = nd.median_filter(binned, size=max(1, int(round(window_size / bin_factor))))
+    upsampled = nd.zoom(binned, bin_factor, order=1, mode='nearest', grid_mode=True)
+
+    if out is None:
+        out = np.empty(image.shape, dtype=image.dtype)
+    out[...] = upsampled[:ny, :nx]
+    return out
+
+
+def median_filter(image, window_size: int, mask_above, exclude_adjacent=True, mask=None,
+                  method='direct', tile_size=1024, workers=None, bin_factor=4):
     """
     Performs the median filter on `image` using the given `window_size` to determine how large the
     sliding window for median calculation is, and subtracts it off the image. Pixels that are above
     the `mask_above` value will be excluded from the subtraction to avoid affecting low signal-to-noise
     pixels. If `exclude_adjacent` is True, adjacent pixels to high-value pixels will also be excluded
-    from the subtraction.
+    from the subtraction. A precomputed boolean `mask` (e.g. combined with `masking.mask_union`)
+    can be passed instead, in which case `mask_above` and `exclude_adjacent` are ignored.
+
+    `method` selects how the median is computed: 'direct' filters the whole image in one call,
+    'tiled' uses `tiled_median_filter` with `tile_size` and `workers` (same result), and 'binned'
+    uses the approximate `binned_median_filter` with `bin_factor`.
     
     Process replicated from https://www.aanda.org/articles/aa/full_html/2016/06/aa27513-15/aa27513-15.html#S8
     """
-    median_filtered = nd.median_filter(image, size=window_size)
-    mask = create_mask(image, mask_above, exclude_adjacent)
-    return image - ma.filled(ma.masked_array(median_filtered, mask), 0)
+    if method == 'direct':
+        median_filtered = nd.median_filter(image, size=window_size)
+    elif method == 'tiled':
+        median_filtered = tiled_median_filter(image, window_size, tile_size=tile_size, workers=workers)
+    elif method == 'binned':
+        median_filtered = binned_median_filter(image, window_size, bin_factor=bin_factor)
+    else:
+        raise ValueError(f"Unknown median filter method '{method}'. Use 'direct', 'tiled' or 'binned'.")
+
+    if mask is None:
+        mask = create_mask(image, mask_above, exclude_adjacent, dtype=bool)
+
+    # subtract in place into the filtered array to avoid another full-size copy
+    np.putmask(median_filtered, mask, 0)
+    return np.subtract(image, median_filtered, out=median_filtered)
 
 def flatten_array(data, value=0):
     """
@@ -0,0 +1,219 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import SkyCoord
+from photutils.aperture import (ApertureMask, BoundingBox, CircularAnnulus, CircularAperture, EllipticalAnnulus,
+                                EllipticalAperture, RectangularAnnulus, RectangularAperture, SkyCircularAnnulus,
+                                SkyCircularAperture, SkyEllipticalAnnulus, SkyEllipticalAperture,
+                                SkyRectangularAnnulus, SkyRectangularAperture)
+
+from ..logging.logger_config import setup_logger
+
+logger = setup_logger()
+
+# the public attributes defining each supported aperture class
+APERTURE_PARAMS = (
+    ((CircularAperture, SkyCircularAperture), ('positions', 'r')),
+    ((CircularAnnulus, SkyCircularAnnulus), ('positions', 'r_in', 'r_out')),
+    ((RectangularAperture, SkyRectangularAperture), ('positions', 'w', 'h', 'theta')),
+    ((RectangularAnnulus, SkyRectangularAnnulus), ('positions', 'w_in', 'w_out', 'h_in', 'h_out', 'theta')),
+    ((EllipticalAperture, SkyEllipticalAperture), ('positions', 'a', 'b', 'theta')),
+    ((EllipticalAnnulus, SkyEllipticalAnnulus), ('positions', 'a_in', 'a_out', 'b_in', 'b_out', 'theta')),
+)
+
+
+def aperture_params(aperture):
+    """
+    Names of the public attributes that define an aperture.
+
+    Parameters
+    ----------
+    aperture : photutils.aperture.Aperture
+        A circular, rectangular or elliptical (sky or pixel) aperture or annulus.
+
+    Returns
+    -------
+    names : tuple of str
+        The attribute names, starting with 'positions'.
+    """
+    for classes, names in APERTURE_PARAMS:
+        if isinstance(aperture, classes):
+            return names
+    logger.error(f"Unsupported aperture type {type(aperture).__name__}.")
+    raise TypeError(f"Unsupported aperture type {type(aperture).__name__}; use a circular, "
+                    f"rectangular or elliptical aperture or annulus.")
+
+
+def wcs_fingerprint(wcs):
+    """
+    Hash a WCS so that images drizzled onto the same pixel grid share a key.
+
+    Parameters
+    ----------
+    wcs : astropy.wcs.WCS
+        The WCS to fingerprint.
+
+    Returns
+    -------
+    fingerprint : str
+        Hex digest of the projection (and pixel shape, if known).
+    """
+    # only hash the projection: observation dates and other metadata in the
+    # header differ between epochs that share the same pixel grid
+    celestial = wcs.celestial
+    params = [
+        list(celestial.wcs.ctype),
+        np.round(celestial.wcs.crval, 10).tolist(),
+        np.round(celestial.wcs.crpix, 6).tolist(),
+        np.round(celestial.pixel_scale_matrix, 14).tolist(),
+        round(float(celestial.wcs.lonpole), 10),
+        round(float(celestial.wcs.latpole), 10),
+        wcs.pixel_shape,
+    ]
+    if celestial.sip is not None:
+        params += [celestial.sip.a.tolist(), celestial.sip.b.tolist()]
+    return hashlib.sha1(repr(params).encode()).hexdigest()
+
+
+def _param_repr(value):
+    if isinstance(value, SkyCoord):
+        icrs = value.icrs
+        return repr((np.round(np.atleast_1d(icrs.ra.deg), 10).tolist(),
+                     np.round(np.atleast_1d(icrs.dec.deg), 10).tolist()))
+    if isinstance(value, u.Quantity):
+        return repr((np.round(np.atleast_1d(value.value), 10).tolist(), str(value.unit)))
+    return repr(np.round(np.atleast_1d(value), 10).tolist())
+
+
+def aperture_key(aperture, method='exact', fingerprint=''):
+    """
+    Build the cache key of an aperture mask.
+
+    Parameters
+    ----------
+    aperture : photutils.aperture.Aperture
+        The (sky or pixel) aperture.
+    method : str
+        The `to_mask` method.
+    fingerprint : str
+        The WCS fingerprint from `wcs_fingerprint`.
+
+    Returns
+    -------
+    key : str
+        Hex digest identifying the aperture, mask method and pixel grid.
+    """
+    params = [type(aperture).__name__, method, fingerprint]
+    params += [f"{name}={_param_repr(getattr(aperture, name))}" for name in aperture_params(aperture)]
+    return hashlib.sha1('|'.join(params).encode()).hexdigest()
+
+
+class ApertureMaskCache:
+    """
+    LRU cache of aperture masks keyed by WCS fingerprint and aperture parameters.
+
+    Images drizzled onto the same pixel grid share a WCS fingerprint, so the
+    (expensive) exact-overlap masks are computed once per grid and reused across
+    filters, epochs and residual images. If `cache_dir` is given, masks are also
+    stored on disk and reloaded by later runs.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of masks kept in memory. Default is 4096.
+    cache_dir : str, optional
+        Directory for the on-disk cache. Default is None (memory only).
+    """
+
+    def __init__(self, maxsize=4096, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._masks)
+
+    def clear(self):
+        with self._lock:
+            self._masks.clear()
+
+    def get_mask(self, aperture, wcs, method='exact', fingerprint=None):
+        """
+        Get the pixel mask of a sky aperture, computing it only on a cache miss.
+
+        Parameters
+        ----------
+        aperture : photutils.aperture.SkyAperture
+            The sky aperture.
+        wcs : astropy.wcs.WCS
+            The WCS of the image.
+        method : str
+            The `to_mask` method. Default is 'exact'.
+        fingerprint : str, optional
+            Precomputed `wcs_fingerprint(wcs)`, to avoid hashing the WCS for every aperture.
+
+        Returns
+        -------
+        mask : photutils.aperture.ApertureMask
+            The aperture mask.
+        """
+        if fingerprint is None:
+            fingerprint = wcs_fingerprint(wcs)
+        key = aperture_key(aperture, method, fingerprint)
+
+        with self._lock:
+            mask = self._masks.get(key)
+            if mask is not None:
+                self._masks.move_to_end(key)
+                self.hits += 1
+                return mask
+
+        mask = self._load(key)
+        if mask is None:
+            self.misses += 1
+            mask = aperture.to_pixel(wcs).to_mask(method=method)
+            self._save(key, mask)
+        else:
+            self.hits += 1
+
+        with self._lock:
+            self._masks[key] = mask
+            while len(self._masks) > self.maxsize:
+                self._masks.popitem(last=False)
+
+        return mask
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def _load(self, key):
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+
+        try:
+            with np.load(self._path(key)) as stored:
+                return ApertureMask(stored['data'], BoundingBox(*stored['bbox'].tolist()))
+        except Exception as e:
+            logger.error(f"Failed to load cached aperture mask {key}: {e}")
+            return None
+
+    def _save(self, key, mask):
+        if self.cache_dir is None or isinstance(mask, list):
+            return
+
+        bbox = mask.bbox
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, data=mask.data, bbox=np.array([bbox.ixmin, bbox.ixmax, bbox.iymin, bbox.iymax]))
+        # rename so that concurrent runs never read a partially written file
+        os.replace(tmp_path, self._path(key))
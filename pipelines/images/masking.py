@@ -0,0 +1,219 @@
+import numpy as np
+from scipy import ndimage as nd
+
+from ..logging.logger_config import setup_logger
+
+logger = setup_logger()
+
+
+def make_structure(radius=1, shape='square'):
+    """
+    Build a boolean structuring element for growing or eroding masks.
+
+    Parameters
+    ----------
+    radius : int
+        Growth radius in pixels. A radius of 1 with a square shape is the
+        3x3 neighbourhood (all 8 adjacent pixels).
+    shape : str
+        One of 'square', 'cross' or 'disk'.
+
+    Returns
+    -------
+    structure : np.ndarray
+        Boolean array of shape (2 * radius + 1, 2 * radius + 1).
+    """
+    if radius < 0:
+        raise ValueError("The radius must be non-negative.")
+
+    size = 2 * radius + 1
+    if shape == 'square':
+        return np.ones((size, size), dtype=bool)
+
+    y, x = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+    if shape == 'cross':
+        return (x == 0) | (y == 0)
+    if shape == 'disk':
+        return x ** 2 + y ** 2 <= radius ** 2
+
+    raise ValueError(f"Unknown structuring element shape '{shape}'. Use 'square', 'cross' or 'disk'.")
+
+
+def threshold_mask(image, mask_above):
+    """
+    Mask all pixels in `image` that are above the `mask_above` value.
+    NaN pixels are never masked, matching `numpy.ma.masked_greater`.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to threshold.
+    mask_above : float
+        The threshold value.
+
+    Returns
+    -------
+    mask : np.ndarray
+        Boolean mask with the same shape as `image`.
+    """
+    with np.errstate(invalid='ignore'):
+        return np.greater(image, mask_above)
+
+
+def grow_mask(mask, radius=1, structure=None):
+    """
+    Grow a boolean mask by a structuring element (binary dilation).
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        Boolean mask to grow.
+    radius : int
+        Growth radius in pixels, used when `structure` is None.
+    structure : np.ndarray or str, optional
+        Structuring element, or the name of a shape understood by
+        `make_structure`. Default is a square of the given radius.
+
+    Returns
+    -------
+    grown : np.ndarray
+        The grown boolean mask.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if structure is None or isinstance(structure, str):
+        shape = structure or 'square'
+        if radius == 0:
+            return mask.copy()
+        if shape == 'square':
+            # a square dilation is separable, so a running maximum is much faster
+            return nd.maximum_filter(mask, size=2 * radius + 1, mode='constant', cval=False)
+        structure = make_structure(radius, shape)
+
+    return nd.binary_dilation(mask, structure=structure)
+
+
+def erode_mask(mask, radius=1, structure=None):
+    """
+    Erode a boolean mask by a structuring element (binary erosion).
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        Boolean mask to erode.
+    radius : int
+        Erosion radius in pixels, used when `structure` is None.
+    structure : np.ndarray or str, optional
+        Structuring element, or the name of a shape understood by
+        `make_structure`. Default is a square of the given radius.
+
+    Returns
+    -------
+    eroded : np.ndarray
+        The eroded boolean mask.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if structure is None or isinstance(structure, str):
+        shape = structure or 'square'
+        if radius == 0:
+            return mask.copy()
+        if shape == 'square':
+            return nd.minimum_filter(mask, size=2 * radius + 1, mode='constant', cval=False)
+        structure = make_structure(radius, shape)
+
+    return nd.binary_erosion(mask, structure=structure)
+
+
+def mask_union(*masks):
+    """
+    Combine masks so that a pixel is masked if it is masked in any input.
+    """
+    if not masks:
+        raise ValueError("At least one mask is required.")
+    result = np.array(masks[0], dtype=bool)
+    for mask in masks[1:]:
+        np.logical_or(result, mask, out=result)
+    return result
+
+
+def mask_intersection(*masks):
+    """
+    Combine masks so that a pixel is masked only if it is masked in every input.
+    """
+    if not masks:
+        raise ValueError("At least one mask is required.")
+    result = np.array(masks[0], dtype=bool)
+    for mask in masks[1:]:
+        np.logical_and(result, mask, out=result)
+    return result
+
+
+def pack_mask(mask):
+    """
+    Bit-pack a boolean mask along its last axis, using one bit per pixel.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        Boolean mask to pack.
+
+    Returns
+    -------
+    packed : np.ndarray
+        uint8 array with the last axis packed eight pixels per byte.
+    shape : tuple
+        Shape of the original mask, needed by `unpack_mask`.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    return np.packbits(mask, axis=-1), mask.shape
+
+
+def unpack_mask(packed, shape):
+    """
+    Restore a boolean mask packed with `pack_mask`.
+
+    Parameters
+    ----------
+    packed : np.ndarray
+        uint8 array returned by `pack_mask`.
+    shape : tuple
+        Shape of the original mask.
+
+    Returns
+    -------
+    mask : np.ndarray
+        The boolean mask.
+    """
+    return np.unpackbits(packed, axis=-1, count=shape[-1]).astype(bool).reshape(shape)
+
+
+def build_mask(image, mask_above, radius=0, structure=None, packed=False):
+    """
+    Build a threshold mask and optionally grow it into its neighbourhood.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to mask.
+    mask_above : float
+        Pixels above this value are masked.
+    radius : int
+        Growth radius in pixels. Default is 0 (no growth).
+    structure : np.ndarray or str, optional
+        Structuring element used to grow the mask. See `grow_mask`.
+    packed : bool
+        If True, return the bit-packed mask and its shape instead of a boolean array.
+
+    Returns
+    -------
+    mask : np.ndarray or tuple
+        Boolean mask, or (packed, shape) if `packed` is True.
+    """
+    logger.verbose(f"Building mask above {mask_above} with growth radius {radius}")
+
+    mask = threshold_mask(image, mask_above)
+    if radius or structure is not None:
+        mask = grow_mask(mask, radius=radius, structure=structure)
+
+    if packed:
+        return pack_mask(mask)
+    return mask
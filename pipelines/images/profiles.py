@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from astropy.io import fits
 from astropy.wcs import WCS
 from photutils.aperture import SkyRectangularAperture
@@ -5,11 +7,78 @@ import numpy as np
 
 from ..logging.logger_config import setup_logger
 from ..images.img_utils import flatten_array
+from ..images.mask_cache import wcs_fingerprint
+from ..images.slits import sample_slit, slit_sample_grid
 
 logger = setup_logger()
 
 
-def get_flux_profiles(filters, img_dict, apertures, axis=0, img_ext=0, header_ext=0, crop=slice(None, None), crop2=slice(None, None)):
+def masked_cutout(data, mask):
+    """
+    Multiply an aperture mask with the data in its bounding box.
+
+    Only the bounding-box slab of `data` is read, so `data` can be a
+    memory-mapped array or an `astropy.io.fits` section.
+
+    Parameters
+    ----------
+    data : np.ndarray or astropy.io.fits.Section
+        The 2D image data.
+    mask : photutils.aperture.ApertureMask
+        The aperture mask.
+
+    Returns
+    -------
+    cutout : np.ndarray or None
+        The mask-weighted cutout with the shape of the mask, with zeros outside
+        the aperture and the image. None if the aperture does not overlap the image.
+    """
+    slices_large, slices_small = mask.get_overlap_slices(data.shape)
+    if slices_small is None:
+        return None
+
+    cutout = np.zeros(mask.shape, dtype=float)
+    cutout[slices_small] = data[slices_large]
+
+    with np.errstate(invalid='ignore'):
+        cutout *= mask.data
+    cutout[mask.data == 0] = 0
+
+    return cutout
+
+
+def _filter_profiles(img_path, apertures, axis, img_ext, header_ext, crop, crop2, memmap, mask_cache):
+    with fits.open(img_path, memmap=memmap) as hdul:
+        # the section only reads (and scales) the slab each aperture touches
+        data = hdul[img_ext].section if memmap else hdul[img_ext].data
+        wcs = WCS(hdul[header_ext].header)
+        fingerprint = wcs_fingerprint(wcs) if mask_cache is not None else None
+
+        profiles = []
+        for aperture in apertures:
+            if mask_cache is not None:
+                mask = mask_cache.get_mask(aperture, wcs, method='exact', fingerprint=fingerprint)
+            else:
+                ap_pix = aperture.to_pixel(wcs)
+                mask = ap_pix.to_mask(method='exact')
+
+            cutout_data = masked_cutout(data, mask)
+            if cutout_data is None:
+                logger.error(f"Aperture at {aperture.positions} does not overlap the image {img_path}.")
+                raise ValueError(f"Aperture at {aperture.positions} does not overlap the image {img_path}.")
+
+            cutout_data = np.rot90(cutout_data, k=1)
+            cutout_data = flatten_array(cutout_data)
+            cutout_data = cutout_data[crop, crop2]
+            cutout_data = np.clip(cutout_data, 0, None)
+
+            profiles.append(np.sum(cutout_data, axis=axis))
+
+    return profiles
+
+
+def get_flux_profiles(filters, img_dict, apertures, axis=0, img_ext=0, header_ext=0, crop=slice(None, None), crop2=slice(None, None),
+                      memmap=True, workers=1, mask_cache=None):
     """
     Gets the flux profiles of the data for a given set of filters and apertures.
 
@@ -26,41 +95,103 @@ def get_flux_profiles(filters, img_dict, apertures, axis=0, img_ext=0, header_ex
         apertures to pixel coordinates.
     axis : int
         Axis to sum the data along. Default is 0.
-    
+    memmap : bool
+        Memory-map the images and only read the bounding box of each aperture.
+        Default is True.
+    workers : int
+        Number of filters to process concurrently. Default is 1.
+    mask_cache : ApertureMaskCache, optional
+        Cache of aperture masks, so that filters on the same pixel grid reuse them.
+
     Returns
     -------
     data_prof : dict
         Dictionary with the profiles of the data for each filter and aperture.
         It will be in the form of {filter: [profile1, profile2, ...]}.
     """
-    # make a empty dictionary to store the data of the profiles with each filter as key
-    data_prof = {filter: [] for filter in filters}
+    for aperture in apertures:
+        if not isinstance(aperture, SkyRectangularAperture):
+            logger.error("The apertures should be of type SkyRectangularAperture.")
+            raise TypeError("The apertures should be of type SkyRectangularAperture.")
 
-    for filt in filters:
+    def run(filt):
         logger.verbose(f"Getting flux profiles for filter {filt}")
+        return _filter_profiles(img_dict[filt], apertures, axis, img_ext, header_ext, crop, crop2, memmap, mask_cache)
 
-        img_path = img_dict[filt]
-        hdul = fits.open(img_path)
+    if workers == 1:
+        return {filt: run(filt) for filt in filters}
 
-        data = hdul[img_ext].data
-        wcs = WCS(hdul[header_ext].header)
+    # reading the slabs is I/O bound, so threads are enough to overlap the filters
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(filters, executor.map(run, filters)))
 
-        for aperture in apertures:
-            if not isinstance(aperture, SkyRectangularAperture):
-                logger.error("The apertures should be of type SkyRectangularAperture.")
-                raise TypeError("The apertures should be of type SkyRectangularAperture.")
 
-            ap_pix = aperture.to_pixel(wcs)
-            mask = ap_pix.to_mask(method='exact')
+def get_slit_profiles(filters, img_dict, apertures, axis=0, img_ext=0, header_ext=0, step=1.0, order=1,
+                      memmap=True, workers=1):
+    """
+    Gets the flux profiles by sampling each rectangular aperture directly on a
+    regular grid along and across the slit, instead of cutting out, rotating and
+    flattening the aperture mask.
 
-            cutout_data = mask.multiply(data)
-            cutout_data = np.rot90(cutout_data, k=1)
-            cutout_data = flatten_array(cutout_data)
-            cutout_data = cutout_data[crop, crop2]
-            cutout_data = np.clip(cutout_data, 0, None)
+    The profiles are in the frame of each slit (along its `w` or `h` side), so
+    they differ from the `get_flux_profiles` ones, which collapse the pixel
+    mask along image rows or columns, for any slit that is not aligned with
+    the image axes.
+
+    The sample grids are computed once per distinct WCS and reused for every
+    filter drizzled onto the same pixel grid.
+
+    Parameters
+    ----------
+    filters : list
+        List of filters to get the profiles for.
+    img_dict : dict
+        Dictionary with the paths to the images for each filter.
+        It will be in the form of {filter: path}.
+    apertures : list[SkyRectangularAperture]
+        List of apertures to get the profiles for.
+    axis : int
+        Axis of the sample grid to sum over. Default is 0, which sums across
+        the `h` side and returns the profile along the `w` side of the slit.
+    step : float
+        Sample spacing in pixels. Default is 1.
+    order : int
+        Spline order of the interpolation. Default is 1 (linear).
+    memmap : bool
+        Memory-map the images and only read the slab each aperture touches.
+        Default is True.
+    workers : int
+        Number of filters to process concurrently. Default is 1.
+
+    Returns
+    -------
+    data_prof : dict
+        Dictionary with the profiles of the data for each filter and aperture.
+        It will be in the form of {filter: [profile1, profile2, ...]}.
+    """
+    for aperture in apertures:
+        if not isinstance(aperture, SkyRectangularAperture):
+            logger.error("The apertures should be of type SkyRectangularAperture.")
+            raise TypeError("The apertures should be of type SkyRectangularAperture.")
+
+    grids = {}
+
+    def run(filt):
+        logger.verbose(f"Getting slit profiles for filter {filt}")
+        with fits.open(img_dict[filt], memmap=memmap) as hdul:
+            data = hdul[img_ext].section if memmap else hdul[img_ext].data
+            header = hdul[header_ext].header
+            wcs = WCS(header)
+
+            key = (wcs.to_header_string(), data.shape)
+            if key not in grids:
+                grids[key] = [slit_sample_grid(aperture, wcs, data.shape, step=step, order=order)
+                              for aperture in apertures]
+
+            return [sample_slit(data, grid, axis=axis, order=order) for grid in grids[key]]
 
-            # append to the data dictionary
-            profile = np.sum(cutout_data, axis=axis)
-            data_prof[filt].append(profile)
+    if workers == 1:
+        return {filt: run(filt) for filt in filters}
 
-    return data_prof
\ No newline at end of file
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(filters, executor.map(run, filters)))
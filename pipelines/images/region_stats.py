@@ -0,0 +1,186 @@
+import numpy as np
+from astropy.table import Table
+
+from ..logging.logger_config import setup_logger
+from .aperture_index import project_apertures
+from .clipping import MAD_TO_STD
+
+logger = setup_logger()
+
+
+def _single_apertures(apertures):
+    for aperture in apertures:
+        if aperture.isscalar:
+            yield aperture
+        else:
+            yield from aperture
+
+
+def label_apertures(apertures, wcs, shape, method='center'):
+    """
+    Rasterise apertures into a label image.
+
+    Pixels inside the n-th aperture (counting from 1) are set to n, and pixels
+    outside every aperture are 0. Where apertures overlap, the later one wins.
+    Apertures with several positions get one label per position. All the
+    positions are projected in one WCS call first, so apertures that cannot
+    overlap the image are skipped without building their masks.
+
+    Parameters
+    ----------
+    apertures : list
+        List of sky apertures.
+    wcs : astropy.wcs.WCS
+        WCS of the image.
+    shape : tuple
+        Shape (ny, nx) of the image.
+    method : str
+        The `to_mask` method deciding which pixels belong to an aperture.
+        Default is 'center'.
+
+    Returns
+    -------
+    labels : np.ndarray
+        int32 label image with the given shape.
+    """
+    labels = np.zeros(shape, dtype=np.int32)
+    x, y, radius, _, _ = project_apertures(apertures, wcs)
+    ny, nx = shape
+    with np.errstate(invalid='ignore'):
+        near = (x + radius > -0.5) & (x - radius < nx - 0.5) & (y + radius > -0.5) & (y - radius < ny - 0.5)
+
+    for num, aperture in enumerate(_single_apertures(apertures), start=1):
+        if not near[num - 1]:
+            logger.verbose(f"Aperture {num} does not overlap the image.")
+            continue
+        mask = aperture.to_pixel(wcs).to_mask(method=method)
+        slices_large, slices_small = mask.get_overlap_slices(shape)
+        if slices_small is None:
+            logger.verbose(f"Aperture {num} does not overlap the image.")
+            continue
+
+        region = labels[slices_large]
+        region[mask.data[slices_small] > 0] = num
+
+    return labels
+
+
+def _segment_median(values, labels, counts):
+    # values must be sorted by (label, value); labels start at 1
+    starts = np.cumsum(counts) - counts
+    median = np.full(counts.shape, np.nan)
+    has = counts > 0
+    lo = starts[has] + (counts[has] - 1) // 2
+    hi = starts[has] + counts[has] // 2
+    median[has] = 0.5 * (values[lo] + values[hi])
+    return median
+
+
+def label_statistics(image, labels, n_labels=None, nsigma=3.0, clip_sigma=3.0):
+    """
+    Compute statistics of every labelled region in a few vectorized passes.
+
+    Non-finite pixels are ignored.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The 2D image.
+    labels : np.ndarray
+        Label image with the same shape as `image`, 0 for the background.
+    n_labels : int, optional
+        Number of labels. Default is ``labels.max()``.
+    nsigma : float
+        Threshold, in units of the region's std, for the fraction of outlying pixels.
+    clip_sigma : float
+        Clipping threshold, in units of the region's MAD-based sigma, for the clipped mean.
+
+    Returns
+    -------
+    stats : astropy.table.Table
+        One row per label with the number of pixels, mean, std, median, MAD,
+        clipped mean and fraction of pixels beyond `nsigma` std from the median.
+    """
+    if n_labels is None:
+        n_labels = int(labels.max())
+
+    valid = labels > 0
+    valid &= np.isfinite(image)
+    lab = labels[valid]
+    vals = np.asarray(image[valid], dtype=float)
+
+    nbins = n_labels + 1
+    counts = np.bincount(lab, minlength=nbins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(lab, vals, minlength=nbins) / counts
+        std = np.sqrt(np.bincount(lab, (vals - mean[lab]) ** 2, minlength=nbins) / counts)
+
+        # sorted-segment reductions for the median and the MAD
+        order = np.lexsort((vals, lab))
+        median = _segment_median(vals[order], lab[order], counts)
+
+        deviation = np.abs(vals - median[lab])
+        order = np.lexsort((deviation, lab))
+        mad = _segment_median(deviation[order], lab[order], counts)
+
+        keep = deviation <= clip_sigma * MAD_TO_STD * mad[lab]
+        clipped_mean = (np.bincount(lab[keep], vals[keep], minlength=nbins)
+                        / np.bincount(lab[keep], minlength=nbins))
+
+        beyond = deviation > nsigma * std[lab]
+        frac_beyond = np.bincount(lab[beyond], minlength=nbins) / counts
+
+    return Table({
+        'label': np.arange(1, nbins),
+        'npix': counts[1:],
+        'mean': mean[1:],
+        'std': std[1:],
+        'median': median[1:],
+        'mad': mad[1:],
+        'clipped_mean': clipped_mean[1:],
+        'frac_beyond': frac_beyond[1:],
+    })
+
+
+def aperture_statistics(actual_img, residual_img, wcs, apertures, method='center', nsigma=3.0, clip_sigma=3.0):
+    """
+    Compute residual QA statistics for every aperture of a (large) catalogue.
+
+    The apertures are rasterised into a label image once, and the statistics of
+    the original and residual images are computed per label with `label_statistics`.
+
+    Parameters
+    ----------
+    actual_img : np.ndarray
+        The original image.
+    residual_img : np.ndarray
+        The residual image.
+    wcs : astropy.wcs.WCS
+        WCS of the images.
+    apertures : list
+        List of sky apertures.
+    method : str
+        The `to_mask` method used for the rasterisation. Default is 'center'.
+    nsigma : float
+        Threshold for the fraction of outlying pixels. Default is 3.
+    clip_sigma : float
+        Clipping threshold for the clipped mean. Default is 3.
+
+    Returns
+    -------
+    stats : astropy.table.Table
+        One row per aperture, with the statistics of the original image prefixed
+        with 'original_' and those of the residual image with 'residual_'.
+    """
+    logger.verbose(f"Computing the residual statistics of {len(apertures)} apertures.")
+
+    labels = label_apertures(apertures, wcs, actual_img.shape, method=method)
+    n_labels = sum(1 if aperture.isscalar else len(aperture) for aperture in apertures)
+
+    stats = Table({'aperture': np.arange(n_labels)})
+    for prefix, image in (('original', actual_img), ('residual', residual_img)):
+        table = label_statistics(image, labels, n_labels=n_labels, nsigma=nsigma, clip_sigma=clip_sigma)
+        for name in table.colnames[1:]:
+            stats[f"{prefix}_{name}"] = table[name]
+
+    return stats
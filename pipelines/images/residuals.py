@@ -1,13 +1,96 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
+from astropy.table import Table
 
 from ..logging.logger_config import setup_logger
+from .mask_cache import wcs_fingerprint
 
 # Configure logger for this module
 logger = setup_logger()
 
-def get_residuals(actual_img, residual_img, wcs, apertures, filename):
+
+def _aperture_masks(wcs, apertures, mask_cache=None):
+    fingerprint = wcs_fingerprint(wcs) if mask_cache is not None else None
+    for aperture in apertures:
+        if mask_cache is not None:
+            yield mask_cache.get_mask(aperture, wcs, method='exact', fingerprint=fingerprint)
+        else:
+            ap_pix = aperture.to_pixel(wcs)
+            yield ap_pix.to_mask(method='exact')
+
+
+def _stats_row(mask_data, mask_res):
+    return mask_res.size, np.std(mask_res), np.median(mask_data), np.median(mask_res)
+
+
+def _stats_table(rows):
+    names = ('npix', 'noise_std', 'original_median', 'residual_median')
+    stats = Table(rows=rows, names=names) if rows else Table(names=names)
+    stats.add_column(np.arange(len(rows)), name='aperture', index=0)
+    return stats
+
+
+def residual_stats(actual_img, residual_img, wcs, apertures, mask_cache=None):
+    """
+    Computes the residual statistics for each aperture without any plotting.
+
+    Parameters:
+    - actual_img (numpy.ndarray): The original image array.
+    - residual_img (numpy.ndarray): The residual image array.
+    - wcs (WCS object): WCS object for the images.
+    - apertures (list): List of aperture objects.
+    - mask_cache (ApertureMaskCache, optional): Cache of aperture masks shared with other images on the same grid.
+
+    Returns:
+    - stats (astropy.table.Table): One row per aperture with the number of pixels, the
+      residual noise std, and the original and residual medians.
+    """
+    rows = []
+    for mask in _aperture_masks(wcs, apertures, mask_cache):
+        mask_data = mask.get_values(actual_img)
+        mask_res = mask.get_values(residual_img)
+        rows.append(_stats_row(mask_data, mask_res))
+
+    return _stats_table(rows)
+
+
+def _plot_residual_page(cutout_data, cutout_res, mask_data, mask_res):
+    from matplotlib import pyplot as plt
+
+    noise_std = np.std(mask_res)
+
+    fig, ax = plt.subplots(1, 3, figsize=(10, 5), dpi=300)
+    ax[0].imshow(cutout_data, origin='lower')
+    ax[0].set_title('Original')
+    ax[1].imshow(cutout_res, origin='lower')
+    ax[1].set_title('Residual')
+
+    ax[2].hist(mask_res.flatten(), bins=100, range=(-8*noise_std, 8*noise_std),
+               align='left', color='k', label='Residual Image Values')
+    ax[2].axvline(np.median(mask_data), color='r', label='Original Median')
+    ax[2].axvline(np.median(mask_res), color='b', label='Residual Median')
+    ax[2].legend(loc='upper left', fontsize=6)
+
+    plt.tight_layout(rect=[0, 0, 0.75, 1])
+    return fig
+
+
+def _render_residual_page(cutout_data, cutout_res, mask_data, mask_res, path):
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+
+    fig = _plot_residual_page(cutout_data, cutout_res, mask_data, mask_res)
+    fig.savefig(path, bbox_inches='tight', dpi=300)
+    plt.close(fig)
+    return path
+
+
+def get_residuals(actual_img, residual_img, wcs, apertures, filename, mask_cache=None, stats_only=False,
+                  workers=1, page_dir=None):
     """
     Saves plots for each aperture to a single PDF file, including residual histograms.
 
@@ -17,39 +100,62 @@ def get_residuals(actual_img, residual_img, wcs, apertures, filename):
     - wcs (WCS object): WCS object for the images.
     - apertures (list): List of aperture objects.
     - filename (str): Path to the output PDF file.
+    - mask_cache (ApertureMaskCache, optional): Cache of aperture masks shared with other images on the same grid.
+    - stats_only (bool): Only compute the per-aperture statistics and skip the plots (and matplotlib) entirely.
+    - workers (int): Number of processes rendering the pages. With more than one, each page is
+      rendered to a PNG in `page_dir` and the PNGs are merged into the PDF at the end.
+    - page_dir (str, optional): Directory for the per-page PNGs. Default is a temporary directory.
+
+    Returns:
+    - stats (astropy.table.Table): The per-aperture statistics from `residual_stats`.
     """
+    if stats_only:
+        logger.verbose(f"Computing residual statistics for {len(apertures)} apertures.")
+        return residual_stats(actual_img, residual_img, wcs, apertures, mask_cache=mask_cache)
+
+    from matplotlib import pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
     logger.verbose(f"Creating residual plots PDF: {filename} with {len(apertures)} apertures from the images.")
+    rows = []
     try:
         with PdfPages(filename) as pdf:
-            for aperture in apertures:
-                ap_pix = aperture.to_pixel(wcs)
-                mask = ap_pix.to_mask(method='exact')
-
-                mask_data = mask.get_values(actual_img)
-                mask_res = mask.get_values(residual_img)
+            if workers == 1:
+                for mask in _aperture_masks(wcs, apertures, mask_cache):
+                    mask_data = mask.get_values(actual_img)
+                    mask_res = mask.get_values(residual_img)
+                    rows.append(_stats_row(mask_data, mask_res))
 
-                noise_std = np.std(mask_res)
+                    fig = _plot_residual_page(mask.cutout(actual_img), mask.cutout(residual_img), mask_data, mask_res)
+                    pdf.savefig(fig, bbox_inches='tight')
+                    plt.close(fig)
+            else:
+                with tempfile.TemporaryDirectory() as tmp_dir, ProcessPoolExecutor(max_workers=workers) as executor:
+                    out_dir = page_dir or tmp_dir
+                    os.makedirs(out_dir, exist_ok=True)
 
-                cutout_data = mask.cutout(actual_img)
-                cutout_res = mask.cutout(residual_img)
+                    # only the small cutouts are sent to the workers, not the full images
+                    futures = []
+                    for num, mask in enumerate(_aperture_masks(wcs, apertures, mask_cache)):
+                        mask_data = mask.get_values(actual_img)
+                        mask_res = mask.get_values(residual_img)
+                        rows.append(_stats_row(mask_data, mask_res))
 
-                fig, ax = plt.subplots(1, 3, figsize=(10, 5), dpi=300)
-                ax[0].imshow(cutout_data, origin='lower')
-                ax[0].set_title('Original')
-                ax[1].imshow(cutout_res, origin='lower')
-                ax[1].set_title('Residual')
+                        path = os.path.join(out_dir, f"residual_page_{num:05d}.png")
+                        futures.append(executor.submit(_render_residual_page, mask.cutout(actual_img),
+                                                       mask.cutout(residual_img), mask_data, mask_res, path))
 
-                ax[2].hist(mask_res.flatten(), bins=100, range=(-8*noise_std, 8*noise_std),
-                           align='left', color='k', label='Residual Image Values')
-                ax[2].axvline(np.median(mask_data), color='r', label='Original Median')
-                ax[2].axvline(np.median(mask_res), color='b', label='Residual Median')
-                ax[2].legend(loc='upper left', fontsize=6)
-
-                plt.tight_layout(rect=[0, 0, 0.75, 1])
-                pdf.savefig(fig, bbox_inches='tight')
-                plt.close(fig)
+                    # merge the pages in aperture order
+                    for future in futures:
+                        page = plt.imread(future.result())
+                        fig = plt.figure(figsize=(page.shape[1] / 300, page.shape[0] / 300), dpi=300)
+                        fig.figimage(page)
+                        pdf.savefig(fig, dpi=300)
+                        plt.close(fig)
 
             logger.info("Successfully created the PDF with residual plots.")
     except Exception as e:
         logger.error(f"Failed to create residual plots PDF: {str(e)}")
         raise
+
+    return _stats_table(rows)
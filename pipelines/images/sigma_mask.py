@@ -3,11 +3,16 @@ import numpy.ma as ma
 from astropy.stats import sigma_clip
 
 from ..logging.logger_config import setup_logger
+from .clipping import fast_median, finite_values, sigma_clip_array, sigma_clip_local, sigma_clip_tiled
+from .image_stats import accumulate
+from .masking import grow_mask, mask_union
 
 logger = setup_logger()
 
 
-def apply_sigma_mask(hdu, ext_img, sigma_lower=3, sigma_upper=3, iters=5):
+def apply_sigma_mask(hdu, ext_img, sigma_lower=3, sigma_upper=3, iters=5, grow_radius=0, grow_structure=None,
+                     engine='astropy', mode='global', dtype=np.float32, tile_size=1024, workers=None,
+                     background=None, rms=None):
     """
     Apply a sigma clipping algorithm to mask out outliers in an image using separate upper and lower bounds.
     Handles NaN values and returns statistical information about the clipping process.
@@ -21,6 +26,25 @@ def apply_sigma_mask(hdu, ext_img, sigma_lower=3, sigma_upper=3, iters=5):
         The number of standard deviations for the upper clipping limit.
     iters : int
         The number of iterations to perform clipping.
+    grow_radius : int
+        Also mask pixels within this many pixels of a clipped pixel. Default is 0.
+    grow_structure : np.ndarray or str, optional
+        Structuring element used to grow the clipped mask (see `masking.grow_mask`).
+    engine : str
+        'astropy' to use `astropy.stats.sigma_clip` on a masked array, or 'fast' to use the
+        partition-based engine in `clipping` on plain float arrays with NaN sentinels.
+    mode : str
+        Only for the 'fast' engine. 'global' clips against the statistics of the whole image,
+        'tiled' clips each `tile_size` tile against its own statistics in parallel, and 'local'
+        clips against a `background` and `rms` map (estimated in `tile_size` boxes if not given).
+    dtype : numpy.dtype
+        Only for the 'fast' engine. Working and output dtype. Default is float32.
+    tile_size : int
+        Only for the 'fast' engine. Tile (or background box) size in pixels. Default is 1024.
+    workers : int, optional
+        Only for the 'fast' engine. Number of threads for the 'tiled' mode.
+    background, rms : numpy.ndarray, optional
+        Only for the 'fast' engine. Background and RMS maps for the 'local' mode.
 
     Returns:
     masked_image : numpy.ndarray
@@ -30,25 +54,28 @@ def apply_sigma_mask(hdu, ext_img, sigma_lower=3, sigma_upper=3, iters=5):
     """
     logger.verbose(f"Applying sigma clipping of sigma={sigma_lower} to {sigma_upper} to image at extension {ext_img}")
 
+    if engine == 'fast':
+        return _fast_sigma_mask(hdu[ext_img].data, sigma_lower, sigma_upper, iters, grow_radius, grow_structure,
+                                mode, dtype, tile_size, workers, background, rms)
+    if engine != 'astropy':
+        raise ValueError(f"Unknown sigma clipping engine '{engine}'. Use 'astropy' or 'fast'.")
+
     # handle NaN values
     masked_array = ma.masked_invalid(hdu[ext_img].data)
     clipped_data = sigma_clip(masked_array, sigma_lower=sigma_lower, sigma_upper=sigma_upper, maxiters=iters)
 
+    if grow_radius or grow_structure is not None:
+        # grow the clipped pixels into their neighbourhood, keeping the NaN mask as is
+        grown = grow_mask(ma.getmaskarray(clipped_data) & ~ma.getmaskarray(masked_array),
+                          radius=grow_radius, structure=grow_structure)
+        clipped_data.mask = mask_union(ma.getmaskarray(clipped_data), grown)
+
     # Fill masked values with NaN for output
     masked_image = ma.filled(clipped_data, np.nan)
 
     # get statistical information
-    num_clipped = np.count_nonzero(clipped_data.mask)
-
-    stats = {
-        'number_of_clipped_pixels': num_clipped,
-        'mean_original': np.nanmean(masked_array),
-        'mean_clipped': np.nanmean(clipped_data),
-        'std_original': np.nanstd(masked_array),
-        'std_clipped': np.nanstd(clipped_data),
-        'median_original': np.nanmedian(masked_array),
-        'median_clipped': np.nanmedian(clipped_data),
-    }
+    stats = _clip_summary(hdu[ext_img].data, masked_image)
+    num_clipped = stats['number_of_clipped_pixels']
 
     logger.info(f"Sigma clipping applied with {sigma_lower} lower and {sigma_upper} upper bounds. "
                 f"Number of pixels clipped: {num_clipped}.")
@@ -56,3 +83,47 @@ def apply_sigma_mask(hdu, ext_img, sigma_lower=3, sigma_upper=3, iters=5):
     return masked_image, stats
 
 
+def _clip_summary(data, masked_image, dtype=None):
+    # one streaming pass each for the moments and counts; the medians are exact,
+    # in the precision of the data unless the caller chose a working dtype
+    if dtype is None:
+        dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float64
+    original = accumulate(data)
+    clipped = accumulate(masked_image)
+
+    return {
+        'number_of_clipped_pixels': clipped.n_nan,
+        'mean_original': original.mean,
+        'mean_clipped': clipped.mean,
+        'std_original': original.std,
+        'std_clipped': clipped.std,
+        'median_original': fast_median(finite_values(data, dtype)),
+        'median_clipped': fast_median(finite_values(masked_image, dtype)),
+    }
+
+
+def _fast_sigma_mask(data, sigma_lower, sigma_upper, iters, grow_radius, grow_structure,
+                     mode, dtype, tile_size, workers, background, rms):
+    if mode == 'global':
+        masked_image, _ = sigma_clip_array(data, sigma_lower, sigma_upper, maxiters=iters, dtype=dtype)
+    elif mode == 'tiled':
+        masked_image = sigma_clip_tiled(data, tile_size, sigma_lower, sigma_upper, maxiters=iters,
+                                        dtype=dtype, workers=workers)
+    elif mode == 'local':
+        masked_image = sigma_clip_local(data, background, rms, box_size=tile_size, sigma_lower=sigma_lower,
+                                        sigma_upper=sigma_upper, maxiters=iters, dtype=dtype)
+    else:
+        raise ValueError(f"Unknown sigma clipping mode '{mode}'. Use 'global', 'tiled' or 'local'.")
+
+    if grow_radius or grow_structure is not None:
+        # grow the clipped pixels into their neighbourhood, keeping the NaN pixels as they are
+        clipped = np.isnan(masked_image) & np.isfinite(data)
+        masked_image[grow_mask(clipped, radius=grow_radius, structure=grow_structure)] = np.nan
+
+    stats = _clip_summary(data, masked_image, dtype)
+    num_clipped = stats['number_of_clipped_pixels']
+
+    logger.info(f"Sigma clipping applied with {sigma_lower} lower and {sigma_upper} upper bounds ({mode} mode). "
+                f"Number of pixels clipped: {num_clipped}.")
+
+    return masked_image, stats
@@ -0,0 +1,118 @@
+from typing import NamedTuple
+
+import astropy.units as u
+import numpy as np
+from scipy import ndimage as nd
+
+from ..logging.logger_config import setup_logger
+
+logger = setup_logger()
+
+
+class SlitGrid(NamedTuple):
+    """
+    Sample positions of a rectangular aperture in an image.
+
+    coords : np.ndarray
+        Pixel coordinates of the samples relative to the slab, with shape
+        (2, n_h, n_w) in (y, x) order. Axis 1 runs along the aperture's `h`
+        side and axis 2 along its `w` side.
+    slices : tuple of slice
+        Slices of the image slab that contains all the samples.
+    area : float
+        Pixel area represented by each sample.
+    """
+    coords: np.ndarray
+    slices: tuple
+    area: float
+
+
+def slit_sample_grid(aperture, wcs, shape, step=1.0, order=1):
+    """
+    Precompute the regular sample grid of a rotated rectangular aperture.
+
+    The grid only depends on the aperture and the WCS, so it can be reused for
+    every image drizzled onto the same pixel grid.
+
+    Parameters
+    ----------
+    aperture : SkyRectangularAperture or RectangularAperture
+        The aperture to sample. Sky apertures are converted with `wcs`.
+    wcs : astropy.wcs.WCS
+        WCS of the images that will be sampled.
+    shape : tuple
+        Shape (ny, nx) of the images that will be sampled.
+    step : float
+        Sample spacing in pixels along and across the slit. Default is 1.
+    order : int
+        Spline order that will be used by `sample_slit`. Default is 1.
+
+    Returns
+    -------
+    grid : SlitGrid
+        The precomputed sample grid.
+    """
+    ap_pix = aperture.to_pixel(wcs) if hasattr(aperture, 'to_pixel') else aperture
+    x0, y0 = np.atleast_2d(ap_pix.positions)[0]
+    theta = u.Quantity(ap_pix.theta, u.rad).value
+
+    n_w = max(int(round(ap_pix.w / step)), 1)
+    n_h = max(int(round(ap_pix.h / step)), 1)
+    du = (np.arange(n_w) + 0.5) * (ap_pix.w / n_w) - ap_pix.w / 2
+    dv = (np.arange(n_h) + 0.5) * (ap_pix.h / n_h) - ap_pix.h / 2
+
+    cos_t, sin_t = np.cos(theta), np.sin(theta)
+    x = x0 + du[None, :] * cos_t - dv[:, None] * sin_t
+    y = y0 + du[None, :] * sin_t + dv[:, None] * cos_t
+
+    # read only the slab that the interpolation touches
+    margin = order + 1
+    ys = max(int(np.floor(y.min())) - margin, 0)
+    ye = min(int(np.ceil(y.max())) + margin + 1, shape[0])
+    xs = max(int(np.floor(x.min())) - margin, 0)
+    xe = min(int(np.ceil(x.max())) + margin + 1, shape[1])
+    if ys >= ye or xs >= xe:
+        logger.error(f"Aperture at {aperture.positions} does not overlap the image.")
+        raise ValueError(f"Aperture at {aperture.positions} does not overlap the image.")
+
+    coords = np.stack([y - ys, x - xs])
+    area = (ap_pix.w / n_w) * (ap_pix.h / n_h)
+
+    return SlitGrid(coords=coords, slices=(slice(ys, ye), slice(xs, xe)), area=area)
+
+
+def sample_slit(data, grid, axis=0, order=1, clip=True):
+    """
+    Sample an image on a precomputed slit grid and collapse it to a 1-D profile.
+
+    Parameters
+    ----------
+    data : np.ndarray or astropy.io.fits.Section
+        The 2D image. Only the slab in `grid.slices` is read.
+    grid : SlitGrid
+        The sample grid from `slit_sample_grid`.
+    axis : int
+        Axis of the grid to sum over. Default is 0, which sums across the `h`
+        side and returns the profile along the `w` side. The profile is in the
+        frame of the slit, so unlike `get_flux_profiles` (which collapses the
+        pixel mask along image rows or columns) it does not depend on the
+        orientation of the slit in the image.
+    order : int
+        Spline order of the interpolation. Default is 1 (linear).
+    clip : bool
+        Clip negative samples to zero before summing. Default is True.
+
+    Returns
+    -------
+    profile : np.ndarray
+        The 1-D flux profile.
+    """
+    slab = np.asarray(data[grid.slices], dtype=float)
+    samples = nd.map_coordinates(slab, grid.coords, order=order, mode='constant', cval=0.0,
+                                 prefilter=order > 1)
+    if clip:
+        np.clip(samples, 0, None, out=samples)
+
+    profile = samples.sum(axis=axis)
+    profile *= grid.area
+    return profile
@@ -1,5 +1,12 @@
+import csv
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from astropy.io import fits
 from astropy.wcs import WCS
 
+from ..common.utils import generate_filename
 from ..logging.logger_config import setup_logger
 
 # Assuming the logger has been set up globally or passed as an argument
@@ -39,3 +46,200 @@ def trim_image(hdu, ext_img, ext_header, x_range, y_range):
         # Log any errors that occur
         logger.error(f"Failed to trim image: {e}", exc_info=True)
         return None
+
+
+def _trimmed_header(header, wcs, x_range, y_range):
+    trimmed_wcs = wcs[y_range[0] : y_range[1], x_range[0] : x_range[1]]
+
+    trimmed_header = header.copy()
+    trimmed_header.update(trimmed_wcs.to_header())
+    trimmed_header.add_comment(f"Image has been trimmed with range: {x_range[0]}:{x_range[1]}, {y_range[0]}:{y_range[1]}")
+
+    return trimmed_wcs, trimmed_header
+
+
+def write_trimmed(output_path, img, header, ext_name):
+    """
+    Write a trimmed image to its own FITS file, keeping the extension name.
+    """
+    new_hdu = fits.PrimaryHDU(data=img, header=header)
+    new_hdu.header['EXTNAME'] = ext_name
+    fits.HDUList([new_hdu]).writeto(output_path, overwrite=True, output_verify='fix')
+    return output_path
+
+
+def trim_sections(path, ext_img, ext_header, cutouts, output_paths=None, workers=None):
+    """
+    Trim several regions out of a FITS image, reading only the requested sections.
+
+    The file is memory-mapped and each cutout is read through the HDU section, so
+    the full mosaic is never loaded. The WCS is parsed once for all cutouts, and the
+    cutouts are read in row order so the file is traversed in a single pass.
+
+    Parameters
+    ----------
+    path : str
+        Path to the FITS file.
+    ext_img : int or str
+        The image extension.
+    ext_header : int or str
+        The extension with the WCS header.
+    cutouts : list of tuple
+        List of (x_range, y_range) pairs, each range being (start, end) in pixels.
+    output_paths : list of str, optional
+        If given, each cutout is written to the matching path (concurrently).
+    workers : int, optional
+        Number of threads writing the outputs. Default is the number of CPUs.
+
+    Returns
+    -------
+    results : list
+        One (trimmed_img, wcs, header) tuple per cutout, in the input order, or
+        None for cutouts that exceed the image dimensions.
+    """
+    logger.verbose(f"Trimming {len(cutouts)} sections from {path} at extensions {ext_img} with header {ext_header}")
+
+    results = [None] * len(cutouts)
+    with fits.open(path, memmap=True) as hdu:
+        section = hdu[ext_img].section
+        shape = hdu[ext_img].shape
+        fitting_header = hdu[ext_header].header
+        wcs = WCS(fitting_header)
+        ext_name = ext_img if isinstance(ext_img, str) else fitting_header.get('EXTNAME', 'UNKNOWN')
+
+        order = sorted(range(len(cutouts)), key=lambda num: (cutouts[num][1][0], cutouts[num][0][0]))
+        for num in order:
+            x_range, y_range = cutouts[num]
+            if x_range[1] > shape[1] or y_range[1] > shape[0]:
+                logger.error(f"Trim range {x_range}, {y_range} exceeds image dimensions")
+                continue
+
+            trimmed_img = section[y_range[0] : y_range[1], x_range[0] : x_range[1]]
+            trimmed_wcs, trimmed_header = _trimmed_header(fitting_header, wcs, x_range, y_range)
+            results[num] = (trimmed_img, trimmed_wcs, trimmed_header)
+
+    if output_paths is not None:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(write_trimmed, output_path, result[0], result[2], ext_name)
+                       for output_path, result in zip(output_paths, results) if result is not None]
+            for future in futures:
+                future.result()
+
+    logger.info(f"Trimmed {sum(result is not None for result in results)} of {len(cutouts)} sections from {path}.")
+
+    return results
+
+
+MANIFEST_COLUMNS = ('mosaic', 'x_start', 'x_end', 'y_start', 'y_end', 'output_directory', 'output_filename')
+
+
+def _extension(ext):
+    ext = str(ext).strip()
+    return int(ext) if ext.isdigit() else ext
+
+
+def read_trim_manifest(path):
+    """
+    Read a CSV or YAML manifest of trim jobs.
+
+    Each job has the same fields as the `runs/trim_imgs.py` arguments: `mosaic`,
+    `x_start`, `x_end`, `y_start`, `y_end`, `output_directory`, `output_filename`
+    and the optional `img_ext` and `hdr_ext` (default 0). A CSV manifest has one
+    job per row with these column names; a YAML manifest is a list of mappings
+    (or a mapping with a `jobs` list).
+
+    Parameters
+    ----------
+    path : str
+        Path to the .csv, .yaml or .yml manifest.
+
+    Returns
+    -------
+    jobs : list of dict
+        The parsed jobs.
+    """
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            logger.error("PyYAML is not installed. Please install it to read YAML manifests.")
+            raise ImportError("PyYAML is not installed. Please install it to read YAML manifests.")
+
+        with open(path, 'r') as file:
+            rows = yaml.safe_load(file)
+        if isinstance(rows, dict):
+            rows = rows['jobs']
+    else:
+        with open(path, 'r', newline='') as file:
+            rows = list(csv.DictReader(line for line in file if not line.startswith('#')))
+
+    jobs = []
+    for num, row in enumerate(rows):
+        missing = [column for column in MANIFEST_COLUMNS if row.get(column) in (None, '')]
+        if missing:
+            logger.error(f"Manifest entry {num} is missing {missing}")
+            raise ValueError(f"Manifest entry {num} is missing {missing}")
+
+        jobs.append({
+            'mosaic': str(row['mosaic']).strip(),
+            'img_ext': _extension(row.get('img_ext') or 0),
+            'hdr_ext': _extension(row.get('hdr_ext') or 0),
+            'x_range': (int(row['x_start']), int(row['x_end'])),
+            'y_range': (int(row['y_start']), int(row['y_end'])),
+            'output_directory': str(row['output_directory']).strip(),
+            'output_filename': str(row['output_filename']).strip(),
+        })
+
+    logger.verbose(f"Read {len(jobs)} trim jobs from {path}")
+    return jobs
+
+
+def _trim_group(path, ext_img, ext_header, cutouts, output_paths):
+    results = trim_sections(path, ext_img, ext_header, cutouts, output_paths=output_paths)
+    written = [output_path for output_path, result in zip(output_paths, results) if result is not None]
+    return written, sum(os.path.getsize(output_path) for output_path in written)
+
+
+def run_trim_jobs(jobs, workers=None):
+    """
+    Run trim jobs grouped by mosaic, so each file is opened once.
+
+    The groups (one per mosaic and extension pair) run in a process pool, and
+    each group reads all its cutouts in one pass with `trim_sections`.
+
+    Parameters
+    ----------
+    jobs : list of dict
+        Jobs as returned by `read_trim_manifest`.
+    workers : int, optional
+        Number of processes. Default is the number of CPUs.
+
+    Returns
+    -------
+    written : list of str
+        Paths of the written cutouts.
+    n_bytes : int
+        Total size of the written cutouts in bytes.
+    n_groups : int
+        Number of mosaic groups that were processed.
+    """
+    groups = defaultdict(lambda: ([], []))
+    for job in jobs:
+        cutouts, output_paths = groups[(job['mosaic'], job['img_ext'], job['hdr_ext'])]
+        cutouts.append((job['x_range'], job['y_range']))
+        # resolve (and create) the output paths here rather than in every worker
+        output_paths.append(generate_filename(job['output_filename'], 'fits', job['output_directory']))
+
+    logger.info(f"Running {len(jobs)} trim jobs over {len(groups)} mosaic(s)")
+
+    written, n_bytes = [], 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_trim_group, path, ext_img, ext_header, cutouts, output_paths)
+                   for (path, ext_img, ext_header), (cutouts, output_paths) in groups.items()]
+        for future in futures:
+            group_written, group_bytes = future.result()
+            written += group_written
+            n_bytes += group_bytes
+
+    return written, n_bytes, len(groups)
+
@@ -1,11 +1,12 @@
 from pipelines.PSFs.convolve import create_kernels, convolve_image
+from pipelines.PSFs.kernel_cache import KernelCache
 from pipelines.plotting.psf_plots import display_kernel
 from astropy.io import fits
 
 p1 = fits.open('output/test_psf_f090_20240427.fits')
 p2 = fits.open('output/test_psf_f444_20240427.fits')
 
-k = create_kernels(p2[-1].data, p1[-1].data, alpha=0.35, beta=0.3)
+k = create_kernels(p2[-1].data, p1[-1].data, alpha=0.35, beta=0.3, cache=KernelCache('output/kernel_cache'))
 
 ax = display_kernel(k, return_ax=True)
 from matplotlib import pyplot as plt
@@ -1,21 +1,23 @@
 import argparse
+import time
 from dataclasses import dataclass
-from typing import Union
-from astropy.io import fits
+from typing import Optional, Union
 from pipelines.common import utils
 from pipelines.images import trim_images
 
 @dataclass
 class Args:
-    path: str
-    x_start: int
-    x_end: int
-    y_start: int
-    y_end: int
-    output_directory: str
-    output_filename: str
+    path: Optional[str] = None
+    x_start: Optional[int] = None
+    x_end: Optional[int] = None
+    y_start: Optional[int] = None
+    y_end: Optional[int] = None
+    output_directory: Optional[str] = None
+    output_filename: Optional[str] = None
     img_ext: Union[int, str] = '0'
     hdr_ext: Union[int, str] = '0'
+    manifest: Optional[str] = None
+    workers: Optional[int] = None
 
 def validate_extension_arg(ext: str) -> Union[int, str]:
     if ext.isdigit():
@@ -25,48 +27,60 @@ def validate_extension_arg(ext: str) -> Union[int, str]:
 def parse_arguments() -> Args:
     parser = argparse.ArgumentParser(
         description='Process and trim FITS images based on specified coordinates and extensions.',
-        epilog='Example: ./process_fits.py file.fits 100 200 100 200 output trimmed_image --img_ext 0 --hdr_ext 0'
+        epilog='Example: ./process_fits.py file.fits 100 200 100 200 output trimmed_image --img_ext 0 --hdr_ext 0\n'
+               'Batch:   ./process_fits.py --manifest jobs.csv --workers 6'
     )
-    parser.add_argument('path', type=str, help='Path to the input FITS file')
-    parser.add_argument('x_start', type=int, help='Start x-coordinate of the range to trim')
-    parser.add_argument('x_end', type=int, help='End x-coordinate of the range to trim')
-    parser.add_argument('y_start', type=int, help='Start y-coordinate of the range to trim')
-    parser.add_argument('y_end', type=int, help='End y-coordinate of the range to trim')
-    parser.add_argument('output_directory', type=str, help='Directory to save the output FITS file')
-    parser.add_argument('output_filename', type=str, help='Filename for the output FITS file')
+    parser.add_argument('path', type=str, nargs='?', help='Path to the input FITS file')
+    parser.add_argument('x_start', type=int, nargs='?', help='Start x-coordinate of the range to trim')
+    parser.add_argument('x_end', type=int, nargs='?', help='End x-coordinate of the range to trim')
+    parser.add_argument('y_start', type=int, nargs='?', help='Start y-coordinate of the range to trim')
+    parser.add_argument('y_end', type=int, nargs='?', help='End y-coordinate of the range to trim')
+    parser.add_argument('output_directory', type=str, nargs='?', help='Directory to save the output FITS file')
+    parser.add_argument('output_filename', type=str, nargs='?', help='Filename for the output FITS file')
     parser.add_argument('--img_ext', type=str, default='0', help='Image extension to use; default is 0 (primary HDU)')
     parser.add_argument('--hdr_ext', type=str, default='0', help='Header extension to use if different from image extension; default is 0')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='CSV or YAML manifest of trim jobs (mosaic, x_start, x_end, y_start, y_end, '
+                             'output_directory, output_filename, img_ext, hdr_ext); replaces the positional arguments')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes for the manifest mode; default is the number of CPUs')
 
     parsed_args = parser.parse_args()
     args_dict = vars(parsed_args)
+
+    positional = ('path', 'x_start', 'x_end', 'y_start', 'y_end', 'output_directory', 'output_filename')
+    if parsed_args.manifest is None and any(args_dict[name] is None for name in positional):
+        parser.error('the positional arguments are required unless --manifest is given')
     
     # Convert dictionary to Args dataclass
     args = Args(**args_dict)
     return args
 
+def run_manifest(args: Args) -> None:
+    start = time.perf_counter()
+    jobs = trim_images.read_trim_manifest(args.manifest)
+    written, n_bytes, n_groups = trim_images.run_trim_jobs(jobs, workers=args.workers)
+    elapsed = time.perf_counter() - start
+
+    print(f"Trimmed {len(written)} of {len(jobs)} cutouts from {n_groups} mosaic(s) in {elapsed:.1f} s "
+          f"({len(written) / elapsed:.1f} cutouts/s, {n_bytes / 1e6 / elapsed:.1f} MB/s written)")
+
 def main(args: Args) -> None:
+    if args.manifest is not None:
+        run_manifest(args)
+        return
+
     x_range = (args.x_start, args.x_end)
     y_range = (args.y_start, args.y_end)
     img_ext = validate_extension_arg(args.img_ext)
     hdr_ext = validate_extension_arg(args.hdr_ext)
 
-    hdu = fits.open(args.path)
-    img, _, head = trim_images.trim_image(hdu, img_ext, hdr_ext, x_range, y_range)
     full_output_path = utils.generate_filename(args.output_filename, 'fits', args.output_directory)
 
-    # Preserve the extension name if img_ext is a string (name of the extension)
-    if isinstance(img_ext, str):
-        ext_name = img_ext
-    else:
-        ext_name = head.get('EXTNAME', 'UNKNOWN')
-
-    # Create a new HDU with the trimmed image and original header
-    new_hdu = fits.PrimaryHDU(data=img, header=head)
-    new_hdu.header['EXTNAME'] = ext_name
-
-    # Write the new HDU to the output file
-    new_hdul = fits.HDUList([new_hdu])
-    new_hdul.writeto(full_output_path, overwrite=True, output_verify='fix')
+    # only the requested section is read from the (memory-mapped) file
+    result, = trim_images.trim_sections(args.path, img_ext, hdr_ext, [(x_range, y_range)],
+                                        output_paths=[full_output_path])
+    if result is None:
+        raise SystemExit("Trim range exceeds image dimensions")
 
     print(f"File saved as {full_output_path}")
 
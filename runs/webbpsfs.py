@@ -4,6 +4,7 @@ from typing import Optional, Union
 from astropy.io import fits
 from pipelines.common import utils
 from pipelines.PSFs import makewebbpsf
+from pipelines.PSFs.psf_library import PSFLibrary
 from pipelines.plotting.psf_plots import save_psf_plots
 
 @dataclass
@@ -18,6 +19,7 @@ class Args:
     ovsam: int = 3
     fov_pix: Optional[int] = None
     fov_as: Optional[float] = None
+    psf_library: Optional[str] = None
 
 def parse_arguments() -> Args:
     parser = argparse.ArgumentParser(
@@ -35,6 +37,7 @@ def parse_arguments() -> Args:
     parser.add_argument('--ovsam', type=int, default=3, help='Oversampling factor for the WebbPSF; default is 3')
     parser.add_argument('--fov_pix', type=int, default=None, help='Field of view in pixels for the WebbPSF; default is None')
     parser.add_argument('--fov_as', type=float, default=None, help='Field of view in arcseconds for the WebbPSF; default is None')
+    parser.add_argument('--psf_library', type=str, default=None, help='Directory of a PSF library to reuse earlier WebbPSF calculations; default is None')
 
     parsed_args = parser.parse_args()
     args_dict = vars(parsed_args)
@@ -54,11 +57,12 @@ def main(args: Args) -> None:
     fov_arcsec = args.fov_as
     output_directory = args.output_directory
     output_filename = args.output_filename
+    library = PSFLibrary(args.psf_library) if args.psf_library else None
 
     hdu = fits.open(fp)
     psf = makewebbpsf.generate_webbpsf(filter=filter, img_hdu=hdu, ext=img_ext,
                                         pixscl=pixscl, oversample=oversample, fov_pixels=fov_pixels,
-                                        fov_arcsec=fov_arcsec)
+                                        fov_arcsec=fov_arcsec, library=library)
     
     psf_rot = makewebbpsf.rotate_webbpsf(psf, img_hdu=hdu, ext=img_ext, pa=pa)  
 
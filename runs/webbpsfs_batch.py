@@ -0,0 +1,82 @@
+import argparse
+import os
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+from astropy.io import fits
+from pipelines.PSFs import makewebbpsf
+from pipelines.PSFs.psf_library import PSFLibrary
+from pipelines.plotting.psf_plots import save_psf_plots
+
+@dataclass
+class Args:
+    output_directory: str
+    filters: List[str] = field(default_factory=list)
+    images: List[str] = field(default_factory=list)
+    img_ext: int = 0
+    ps: Optional[float] = None
+    ovsam: int = 3
+    fov_pix: Optional[int] = None
+    fov_as: Optional[float] = None
+    max_cores: Optional[int] = None
+    threads_per_job: int = 1
+    psf_library: Optional[str] = None
+    plots: bool = False
+    bin_detsamp: bool = False
+
+def parse_arguments() -> Args:
+    parser = argparse.ArgumentParser(
+        description='Generate and rotate WebbPSFs for several filters and epochs in parallel.',
+        epilog='Example: ./webbpsfs_batch.py output --filters F090W F200W F444W --images epoch1.fits epoch2.fits '
+               '--ps 0.03 --ovsam 3 --fov_pix 256 --max_cores 16 --psf_library psf_library'
+    )
+
+    parser.add_argument('output_directory', type=str, help='Directory to save the output FITS files')
+    parser.add_argument('--filters', type=str, nargs='+', required=True, help='Filters to generate the WebbPSFs for')
+    parser.add_argument('--images', type=str, nargs='+', required=True, help='Image FITS files, one per epoch')
+    parser.add_argument('--img_ext', type=int, default=0, help='Image extension to use; default is 0 (primary HDU)')
+    parser.add_argument('--ps', type=float, default=None, help='Pixel scale for the WebbPSFs; default is the image pixel scale')
+    parser.add_argument('--ovsam', type=int, default=3, help='Oversampling factor for the WebbPSFs; default is 3')
+    parser.add_argument('--fov_pix', type=int, default=None, help='Field of view in pixels for the WebbPSFs; default is None')
+    parser.add_argument('--fov_as', type=float, default=None, help='Field of view in arcseconds for the WebbPSFs; default is None')
+    parser.add_argument('--max_cores', type=int, default=None, help='Core budget for the PSF calculations; default is the number of CPUs')
+    parser.add_argument('--threads_per_job', type=int, default=1, help='Threads per PSF calculation; default is 1')
+    parser.add_argument('--psf_library', type=str, default=None, help='Directory of a PSF library to reuse earlier WebbPSF calculations; default is None')
+    parser.add_argument('--bin_detsamp', action='store_true', help='Bin the rotated oversampled PSF to get the rotated detector-sampled PSF')
+    parser.add_argument('--plots', action='store_true', help='Also save a PDF of plots for every PSF')
+
+    parsed_args = parser.parse_args()
+    args_dict = vars(parsed_args)
+
+    # Convert dictionary to Args dataclass
+    args = Args(**args_dict)
+    return args
+
+def main(args: Args) -> None:
+    start = time.perf_counter()
+    library = PSFLibrary(args.psf_library) if args.psf_library else None
+
+    paths = makewebbpsf.generate_webbpsf_batch(args.filters, args.images, args.output_directory, ext=args.img_ext,
+                                               pixscl=args.ps, oversample=args.ovsam, fov_pixels=args.fov_pix,
+                                               fov_arcsec=args.fov_as, max_cores=args.max_cores,
+                                               threads_per_job=args.threads_per_job, library=library,
+                                               bin_detsamp=args.bin_detsamp)
+
+    if args.plots:
+        # the PSFs are returned image by image, filter by filter
+        for path, filt in zip(paths, [filt for _ in args.images for filt in args.filters]):
+            if path is None:
+                continue
+            with fits.open(path) as psf:
+                # PSFs of images without PA_APER are written unrotated
+                names = {hdu.name for hdu in psf}
+                ext = [e for e in ('DET_SAMP', 'OVERSAMP', 'ROTATED_OVERSAMP', 'ROTATED_DET_SAMP') if e in names]
+                save_psf_plots(psf, path=os.path.splitext(path)[0] + '.pdf', filt=filt, ext=ext)
+
+    elapsed = time.perf_counter() - start
+    n_written = sum(path is not None for path in paths)
+    print(f"Saved {n_written} of {len(paths)} PSFs to {args.output_directory} in {elapsed:.1f} s")
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)